@@ -1,5 +1,5 @@
 import json
-from typing import Annotated, Union
+from typing import Annotated, Optional, Union
 
 from django.core.serializers.json import DjangoJSONEncoder
 from django.shortcuts import redirect
@@ -19,13 +19,15 @@ from c3nav.mapdata.models import Source
 from c3nav.mapdata.models.locations import DynamicLocation, LocationRedirect, Position
 from c3nav.mapdata.schemas.filters import BySearchableFilter, RemoveGeometryFilter
 from c3nav.mapdata.schemas.model_base import AnyLocationID, AnyPositionID, CustomLocationID
-from c3nav.mapdata.schemas.models import (AnyPositionStatusSchema, FullListableLocationSchema, FullLocationSchema,
-                                          LocationDisplay, ProjectionPipelineSchema, ProjectionSchema,
-                                          SlimListableLocationSchema, SlimLocationSchema, all_location_definitions,
-                                          listable_location_definitions)
+from c3nav.mapdata.schemas.models import (AnyPositionStatusSchema, CustomLocationLocationSchema,
+                                          FullListableLocationSchema, FullLocationSchema, LocationDisplay,
+                                          ProjectionPipelineSchema, ProjectionSchema, SlimListableLocationSchema,
+                                          SlimLocationSchema, all_location_definitions, listable_location_definitions)
 from c3nav.mapdata.schemas.responses import LocationGeometry, WithBoundsSchema
-from c3nav.mapdata.utils.locations import (get_location_by_id_for_request, get_location_by_slug_for_request,
-                                           searchable_locations_for_request, visible_locations_for_request)
+from c3nav.mapdata.utils.cache.stats import increment_cache_key
+from c3nav.mapdata.utils.locations import (get_custom_locations_for_request, get_location_by_id_for_request,
+                                           get_location_by_slug_for_request, searchable_locations_for_request,
+                                           visible_locations_for_request)
 from c3nav.mapdata.utils.user import can_access_editor
 
 map_api_router = APIRouter(tags=["map"])
@@ -197,6 +199,43 @@ def location_by_id_geometry(request, location_id: AnyLocationID):
     )
 
 
+DESCRIBE_COORDINATES_MAX = 1000
+
+
+class DescribeCoordinatesParametersSchema(BaseSchema):
+    ids: list[CustomLocationID] = APIField(
+        title="custom location IDs",
+        description="coordinates to describe, in the same format as custom location IDs",
+    )
+
+
+@map_api_router.post('/describe/', summary="describe many coordinates",
+                     description="get the custom locations for many coordinates at once, "
+                                 "unknown levels or invalid IDs return null",
+                     response={200: list[Optional[CustomLocationLocationSchema]],
+                               **validate_responses, **auth_responses})
+def describe_coordinates(request, parameters: DescribeCoordinatesParametersSchema):
+    if len(parameters.ids) > DESCRIBE_COORDINATES_MAX:
+        raise APIRequestValidationFailed("At most %d coordinates can be described at once." %
+                                         DESCRIBE_COORDINATES_MAX)
+
+    locations = get_custom_locations_for_request(parameters.ids, request)
+    found = [location for location in locations if location is not None]
+    if found:
+        from c3nav.routing.router import Router
+        for location, description in zip(found, Router.load().describe_custom_locations(found)):
+            location.description = description
+
+    increment_cache_key('apistats__location_describe')
+
+    return [location.serialize(simple_geometry=True) if location is not None else None for location in locations]
+
+
+if settings.METRICS:
+    from c3nav.mapdata.metrics import APIStatsCollector
+    APIStatsCollector.add_stat('location_describe')
+
+
 @map_api_router.get('/locations/by-slug/{location_slug}/', summary="location by slug (slim)",
                     description=("Get location by slug (with most important attributes set)\n\n"
                                  "Possible location types:\n"+all_location_definitions),
@@ -0,0 +1,20 @@
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'delete outdated tiles from the packed tile store and shrink it'
+
+    def handle(self, *args, **options):
+        from c3nav.mapdata.utils.cache import CachePackage
+        from c3nav.mapdata.utils.cache.tilestore import PackedTileStore
+
+        if settings.TILE_STORE != 'packed':
+            raise CommandError('tile_store is not set to packed.')
+
+        logger = logging.getLogger('c3nav')
+
+        PackedTileStore.open_cached().compact(CachePackage.open())
+        logger.info('Tile store compacted.')
@@ -0,0 +1,75 @@
+import argparse
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import gettext_lazy as _
+from django.utils.translation import ngettext_lazy
+
+from c3nav.mapdata.models import Level
+
+
+class Command(BaseCommand):
+    help = 'render all tiles that are missing in the tile cache or outdated'
+
+    @staticmethod
+    def levels_value(value):
+        if value == '*':
+            return None
+
+        values = set(v for v in value.split(',') if v)
+        levels = Level.objects.filter(on_top_of__isnull=True, short_label__in=values)
+
+        not_found = values - set(level.short_label for level in levels)
+        if not_found:
+            raise argparse.ArgumentTypeError(
+                ngettext_lazy('Unknown level: %s', 'Unknown levels: %s', len(not_found)) % ', '.join(not_found)
+            )
+
+        return set(level.pk for level in levels)
+
+    @staticmethod
+    def themes_value(value):
+        if value == '*':
+            return None
+        try:
+            return set((None if v in ('0', 'none', 'default') else int(v)) for v in value.split(',') if v)
+        except ValueError:
+            raise argparse.ArgumentTypeError(_('Invalid themes: %s') % value)
+
+    @staticmethod
+    def permissions_value(value):
+        try:
+            return set(int(v) for v in value.split(',') if v)
+        except ValueError:
+            raise argparse.ArgumentTypeError(_('Invalid access restrictions: %s') % value)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--levels', default='*', type=self.levels_value,
+                            help=_('levels to render, e.g. 0,1,2 or * for all levels (default)'))
+        parser.add_argument('--themes', default='*', type=self.themes_value,
+                            help=_('theme ids to render, 0 for the default theme or * for all themes (default)'))
+        parser.add_argument('--min-zoom', default=-2, type=int, choices=range(-2, 6),
+                            help=_('lowest zoom level to render (default: -2)'))
+        parser.add_argument('--max-zoom', default=2, type=int, choices=range(-2, 6),
+                            help=_('highest zoom level to render (default: 2)'))
+        parser.add_argument('--permissions', default='', type=self.permissions_value,
+                            help=_('access restriction ids to render the tiles for (default: none)'))
+        parser.add_argument('--processes', default=os.cpu_count(), type=int,
+                            help=_('number of worker processes (default: number of CPUs)'))
+        parser.add_argument('--rate', default=None, type=float,
+                            help=_('maximum number of tiles to render per second (default: no limit)'))
+
+    def handle(self, *args, **options):
+        from c3nav.mapdata.render.seed import seed_tiles
+
+        if not settings.CACHE_TILES:
+            raise CommandError(_('Tile caching is disabled.'))
+
+        if options['min_zoom'] > options['max_zoom']:
+            raise CommandError(_('min-zoom can\'t be higher than max-zoom.'))
+
+        seed_tiles(zooms=range(options['min_zoom'], options['max_zoom'] + 1),
+                   levels=options['levels'], themes=options['themes'],
+                   access_permissions=options['permissions'],
+                   processes=options['processes'], rate=options['rate'])
@@ -0,0 +1,22 @@
+import logging
+
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext_lazy as _
+
+
+class Command(BaseCommand):
+    help = 'precompute shortest paths for the most common routing profiles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', type=int, default=None,
+                            help=_('number of most requested profiles to precompute (default: from settings)'))
+
+    def handle(self, *args, **options):
+        from c3nav.mapdata.models import MapUpdate
+        from c3nav.routing.router import Router
+        from c3nav.routing.warmup import warm_up_router
+
+        logger = logging.getLogger('c3nav')
+
+        warm_up_router(MapUpdate.last_processed_update(), Router.load(), num_profiles=options['profiles'])
+        logger.info('Router warm-up done.')
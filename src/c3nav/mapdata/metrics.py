@@ -3,7 +3,6 @@ from typing import Optional, Sequence
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.cache import cache
 
 from c3nav.mapdata.models.report import Report
 
@@ -24,38 +23,36 @@ if settings.METRICS:
         name_registry: dict[str, None | Sequence[str]] = dict()
 
         def collect(self):
+            from c3nav.mapdata.utils.cache.stats import get_stats, stats_buffer
             metrics: dict[str, CounterMetricFamily] = dict()
-            if settings.CACHES['default']['BACKEND'] == 'django.core.cache.backends.redis.RedisCache':
-                client = cache._cache.get_client()
-                for key in client.keys(f"*{settings.CACHES['default'].get('KEY_PREFIX', '')}apistats__*"):
-                    key: str = key.decode('utf-8').split(':', 2)[2]
-                    value = cache.get(key)
-                    key = key[10:]  # trim apistats__ from the beginning
-
-                    # some routing stats don't use double underscores to separate fields, workaround for now
-                    if key.startswith('route_tuple_'):
-                        key = re.sub(r'^route_tuple_(.*)_(.*)$', r'route_tuple__\1__\2', key)
-                    if key.startswith('route_origin_') or key.startswith('route_destination_'):
-                        key = re.sub(r'^route_(origin|destination)_(.*)$', r'route_\1__\2', key)
-
-                    name, *labels = key.split('__')
-                    try:
-                        label_names = self.name_registry[name]
-                    except KeyError:
-                        continue
-
-                    if label_names is None:
-                        label_names = list()
-
-                    if len(label_names) != len(labels):
-                        raise ValueError('configured labels and number of extracted labels doesn\'t match.')
-
-                    try:
-                        counter = metrics[name]
-                    except KeyError:
-                        counter = metrics[name] = CounterMetricFamily(f'c3nav_{name}', f'c3nav_{name}',
-                                                                      labels=label_names)
-                    counter.add_metric(labels, value)
+            stats_buffer.flush()
+            for key, value in get_stats(prefix='apistats__').items():
+                key = key[10:]  # trim apistats__ from the beginning
+
+                # some routing stats don't use double underscores to separate fields, workaround for now
+                if key.startswith('route_tuple_'):
+                    key = re.sub(r'^route_tuple_(.*)_(.*)$', r'route_tuple__\1__\2', key)
+                if key.startswith('route_origin_') or key.startswith('route_destination_'):
+                    key = re.sub(r'^route_(origin|destination)_(.*)$', r'route_\1__\2', key)
+
+                name, *labels = key.split('__')
+                try:
+                    label_names = self.name_registry[name]
+                except KeyError:
+                    continue
+
+                if label_names is None:
+                    label_names = list()
+
+                if len(label_names) != len(labels):
+                    raise ValueError('configured labels and number of extracted labels doesn\'t match.')
+
+                try:
+                    counter = metrics[name]
+                except KeyError:
+                    counter = metrics[name] = CounterMetricFamily(f'c3nav_{name}', f'c3nav_{name}',
+                                                                  labels=label_names)
+                counter.add_metric(labels, value)
             return metrics.values()
 
         def describe(self):
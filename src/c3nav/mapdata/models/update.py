@@ -12,7 +12,7 @@ from django.utils.http import int_to_base36
 from django.utils.timezone import make_naive
 from django.utils.translation import gettext_lazy as _
 
-from c3nav.mapdata.tasks import process_map_updates
+from c3nav.mapdata.tasks import process_map_updates, seed_tile_cache
 
 
 class MapUpdate(models.Model):
@@ -142,6 +142,11 @@ class MapUpdate(models.Model):
             if not new_updates:
                 return ()
 
+            last_processed_update = cls.last_processed_update(force=True)
+
+            # changed geometries per level, allows the router to only recalculate affected spaces
+            changed_areas = {}
+
             if any(update.geometries_changed for update in new_updates):
                 from c3nav.mapdata.utils.cache.changes import changed_geometries
                 changed_geometries.reset()
@@ -153,8 +158,6 @@ class MapUpdate(models.Model):
 
                 logger.info('%.3f m² of altitude areas affected.' % changed_geometries.area)
 
-                last_processed_update = cls.last_processed_update(force=True)
-
                 for new_update in new_updates:
                     logger.info('Applying changed geometries from MapUpdate #%(id)s (%(type)s)...' %
                                 {'id': new_update.pk, 'type': new_update.type})
@@ -168,6 +171,7 @@ class MapUpdate(models.Model):
 
                 logger.info('%.3f m² of geometries affected in total.' % changed_geometries.area)
 
+                changed_areas = changed_geometries.get_geometries()
                 changed_geometries.save(last_processed_update, new_updates[-1].to_tuple)
 
                 logger.info('Rebuilding level render data...')
@@ -177,14 +181,33 @@ class MapUpdate(models.Model):
             else:
                 logger.info('No geometries affected.')
 
+            if any(update.type == 'management' for update in new_updates):
+                # manage.py clearmapcache should always rebuild everything
+                changed_areas = None
+
+            if settings.CACHE_TILES and settings.TILE_STORE == 'packed':
+                logger.info('Invalidating affected tiles...')
+                from c3nav.mapdata.utils.cache.tilestore import PackedTileStore
+                PackedTileStore.open_cached().invalidate_changes(changed_areas)
+
             logger.info('Rebuilding router...')
             from c3nav.routing.router import Router
-            router = Router.rebuild(new_updates[-1].to_tuple)
+            router = Router.rebuild(new_updates[-1].to_tuple,
+                                    previous_update=last_processed_update, changed_areas=changed_areas)
+
+            if settings.ROUTING_CONTRACTION:
+                logger.info('Building contraction hierarchies...')
+                from c3nav.routing.contraction import RouterHierarchies
+                RouterHierarchies.rebuild(new_updates[-1].to_tuple, router)
 
             logger.info('Rebuilding locator...')
             from c3nav.routing.locator import Locator
             Locator.rebuild(new_updates[-1].to_tuple, router)
 
+            logger.info('Warming up router...')
+            from c3nav.routing.warmup import warm_up_router
+            warm_up_router(new_updates[-1].to_tuple, router)
+
             for new_update in reversed(new_updates):
                 new_update.processed = True
                 new_update.save()
@@ -193,6 +216,11 @@ class MapUpdate(models.Model):
                 lambda: cache.set('mapdata:last_processed_update', new_updates[-1].to_tuple, None)
             )
 
+            if settings.HAS_CELERY and settings.SEED_TILES and settings.CACHE_TILES:
+                transaction.on_commit(
+                    lambda: seed_tile_cache.delay()
+                )
+
             return new_updates
 
     def save(self, **kwargs):
@@ -13,7 +13,7 @@ from c3nav.mapdata.render.engines.svg import SVGEngine  # noqa
 @checks.register()
 def check_image_renderer(app_configs, **kwargs):
     errors = []
-    if settings.IMAGE_RENDERER not in ('svg', 'opengl'):
+    if settings.IMAGE_RENDERER not in ('svg', 'opengl', 'pillow'):
         errors.append(
             checks.Error(
                 'Invalid image renderer: '+settings.IMAGE_RENDERER,
@@ -26,6 +26,8 @@ def check_image_renderer(app_configs, **kwargs):
 
 if settings.IMAGE_RENDERER == 'opengl':
     from c3nav.mapdata.render.engines.opengl import OpenGLEngine as ImageRenderEngine  # noqa
+elif settings.IMAGE_RENDERER == 'pillow':
+    from c3nav.mapdata.render.engines.pillow import PillowEngine as ImageRenderEngine  # noqa
 else:
     from c3nav.mapdata.render.engines.svg import SVGEngine as ImageRenderEngine  # noqa
 
@@ -0,0 +1,151 @@
+import io
+import math
+from itertools import chain
+from typing import Optional
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+from shapely.affinity import translate
+from shapely.geometry import LineString, Polygon
+
+from c3nav.mapdata.render.engines.base import FillAttribs, RenderEngine, StrokeAttribs
+from c3nav.mapdata.render.engines.svg import unwrap_hybrid_geom
+from c3nav.mapdata.utils.color import color_to_rgb
+
+
+class PillowEngine(RenderEngine):
+    """
+    Rasterizes geometries in-process with Pillow, without building an SVG and starting an external renderer.
+    Everything is drawn at a higher resolution and scaled down afterwards for anti-aliasing.
+    """
+    filetype = 'png'
+    supersample = 2
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # pixel coordinates in the supersampled image, including the buffer
+        self.px_scale = self.scale * self.supersample
+        self.np_scale = np.array((self.px_scale, -self.px_scale))
+        self.np_offset = np.array(((self.buffer - self.minx * self.scale) * self.supersample,
+                                   (self.buffer + self.maxy * self.scale) * self.supersample))
+
+        self.image = Image.new('RGB', (self.buffered_width * self.supersample, self.buffered_height * self.supersample),
+                               tuple(int(i*255) for i in self.background_rgb))
+
+    def render(self, filename=None):
+        img = self.image.reduce(self.supersample) if self.supersample > 1 else self.image
+        img = img.crop((self.buffer, self.buffer, self.buffer + self.width, self.buffer + self.height))
+
+        f = io.BytesIO()
+        img.save(f, 'PNG')
+        f.seek(0)
+        return f.read()
+
+    def _to_pixels(self, coords, origin):
+        return (np.asarray(coords)[:, :2]*self.np_scale+(self.np_offset-origin)).ravel().tolist()
+
+    def _get_mask_box(self, geometry, margin=0):
+        # pixel area of the image that this geometry (plus margin pixels around it) can touch, or None
+        minx, miny, maxx, maxy = geometry.bounds
+        (left, top), (right, bottom) = np.array(((minx, maxy), (maxx, miny)))*self.np_scale+self.np_offset
+        width, height = self.image.size
+        left = max(int(math.floor(left - margin)), 0)
+        top = max(int(math.floor(top - margin)), 0)
+        right = min(int(math.ceil(right + margin)) + 1, width)
+        bottom = min(int(math.ceil(bottom + margin)) + 1, height)
+        if left >= right or top >= bottom:
+            return None
+        return left, top, right, bottom
+
+    def _fill_mask(self, draw, geometry, value, origin):
+        polygons = [geom for geom in getattr(geometry, 'geoms', (geometry, )) if isinstance(geom, Polygon)]
+        # a polygon can only lie inside the hole of a bigger polygon, so drawing the biggest ones first makes sure
+        # that holes never cut away other polygons
+        polygons.sort(key=lambda polygon: Polygon(polygon.exterior).area, reverse=True)
+        for polygon in polygons:
+            draw.polygon(self._to_pixels(polygon.exterior.coords, origin), fill=value)
+            for interior in polygon.interiors:
+                draw.polygon(self._to_pixels(interior.coords, origin), fill=0)
+
+    def _stroke_mask(self, draw, geometry, value, width, origin):
+        lines = chain(*(
+            ((geom.exterior, *geom.interiors) if isinstance(geom, Polygon) else
+             (geom, ) if isinstance(geom, LineString) else ())
+            for geom in getattr(geometry, 'geoms', (geometry, ))
+        ))
+        for line in lines:
+            draw.line(self._to_pixels(line.coords, origin), fill=value, width=width, joint='curve')
+
+    def _paste(self, color, alpha, box, draw_mask, blur=None):
+        # draw into a mask of the affected area and blend the color into the image using it
+        left, top, right, bottom = box
+        mask = Image.new('L', (right-left, bottom-top), 0)
+        draw_mask(ImageDraw.Draw(mask), int(round(alpha*255)), np.array((left, top)))
+        if blur:
+            mask = mask.filter(ImageFilter.GaussianBlur(blur))
+        self.image.paste(color, box, mask)
+
+    def add_shadow(self, geometry, elevation):
+        # same shadow as the SVG engine: offset, buffered and blurred black shape with 20% opacity
+        elevation = float(min(elevation, 2))
+        blur_radius = elevation / 3 * 0.25
+
+        shadow_geom = translate(geometry.buffer(blur_radius),
+                                xoff=(elevation / 3 * 0.12), yoff=-(elevation / 3 * 0.12))
+        blur_px = blur_radius * self.px_scale
+        box = self._get_mask_box(shadow_geom, margin=int(math.ceil(blur_px*3)))
+        if box is None:
+            return
+        self._paste((0, 0, 0), 0.2, box, lambda draw, value, origin: self._fill_mask(draw, shadow_geom, value, origin),
+                    blur=blur_px)
+
+    def darken(self, area):
+        if area:
+            self.add_geometry(geometry=area, fill=FillAttribs('#000000', 0.1), category='darken')
+
+    @staticmethod
+    def _get_color(color, opacity):
+        r, g, b, a = color_to_rgb(color)
+        if opacity:
+            a *= opacity
+        return (int(r*255), int(g*255), int(b*255)), a
+
+    def _add_geometry(self, geometry, fill: Optional[FillAttribs], stroke: Optional[StrokeAttribs],
+                      altitude=None, height=None, shape_cache_key=None, **kwargs):
+        geometry = self.buffered_bbox.intersection(unwrap_hybrid_geom(geometry))
+
+        if geometry.is_empty:
+            return
+
+        if altitude is not None and stroke is None:
+            stroke = StrokeAttribs('rgba(0, 0, 0, 0.15)', 0.05, min_px=0.2)
+
+        if height is not None:
+            self.add_shadow(geometry, height)
+
+        if fill:
+            box = self._get_mask_box(geometry)
+            if box is not None:
+                color, alpha = self._get_color(fill.color, fill.opacity)
+                self._paste(color, alpha, box,
+                            lambda draw, value, origin: self._fill_mask(draw, geometry, value, origin))
+
+        if stroke:
+            width = stroke.width*self.scale
+            if stroke.min_px:
+                width = max(width, stroke.min_px)
+            width *= self.supersample
+            color, alpha = self._get_color(stroke.color, stroke.opacity)
+
+            # if the width would be <1px, emulate it through opacity on a 1px width
+            if width < 1:
+                alpha *= width
+                width = 1
+            else:
+                width = int(round(width))
+
+            box = self._get_mask_box(geometry, margin=width)
+            if box is not None:
+                self._paste(color, alpha, box,
+                            lambda draw, value, origin: self._stroke_mask(draw, geometry, value, width, origin))
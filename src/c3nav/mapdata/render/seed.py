@@ -0,0 +1,124 @@
+import logging
+import math
+import multiprocessing
+import time
+from contextlib import nullcontext
+
+from django.conf import settings
+
+from c3nav.mapdata.utils.cache import CachePackage
+from c3nav.mapdata.utils.tiles import build_access_cache_key, build_base_cache_key, get_metatile, get_tile_bounds
+
+logger = logging.getLogger('c3nav')
+
+
+def get_tiles(cache_package, zooms, level_themes):
+    """
+    all tiles within the bounds of the cache package as (level, zoom, x, y, theme) tuples.
+    """
+    minx, miny, maxx, maxy = cache_package.bounds
+    for zoom in zooms:
+        size = 256 / 2 ** zoom
+        for level, theme in level_themes:
+            for y in range(math.floor(-maxy / size) - 1, math.floor(-miny / size) + 1):
+                for x in range(math.floor(minx / size) - 1, math.floor(maxx / size) + 1):
+                    if cache_package.bounds_valid(*get_tile_bounds(zoom, x, y)):
+                        yield level, zoom, x, y, theme
+
+
+def get_outdated_tiles(cache_package, tiles, access_permissions):
+    """
+    filter out all tiles that are in the tile cache for the current last update of their bounds.
+    with metatiles, only one tile per metatile is returned.
+    """
+    from c3nav.mapdata.views import read_tile_cache
+    metatiles = set()
+    for level, zoom, x, y, theme in tiles:
+        if settings.METATILE_SIZE > 1:
+            metatile = (level, zoom, *get_metatile(x, y, settings.METATILE_SIZE), theme)
+            if metatile in metatiles:
+                continue
+
+        level_data = cache_package.levels[(level, theme)]
+        minx, miny, maxx, maxy = get_tile_bounds(zoom, x, y)
+        base_cache_key = build_base_cache_key(level_data.history.last_update(minx, miny, maxx, maxy))
+        access_cache_key = build_access_cache_key(access_permissions &
+                                                  set(level_data.restrictions[minx:maxx, miny:maxy]))
+        if read_tile_cache(level, zoom, x, y, str(theme), base_cache_key, access_cache_key) is not None:
+            continue
+
+        if settings.METATILE_SIZE > 1:
+            metatiles.add(metatile)
+        yield level, zoom, x, y, theme
+
+
+def _rate_limited(jobs, rate):
+    start = time.monotonic()
+    for i, job in enumerate(jobs):
+        if rate:
+            delay = start + i / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        yield job
+
+
+def _init_worker():
+    import django
+    django.setup()
+
+
+def _render_tile(job):
+    from c3nav.mapdata.views import render_tile
+    level, zoom, x, y, theme, access_permissions = job
+    try:
+        render_tile(CachePackage.open_cached(), level, zoom, x, y, theme, access_permissions)
+    except Exception:
+        logger.exception('Rendering tile %d/%d/%d/%d (theme %s) failed.' % (level, zoom, x, y, theme))
+        return False
+    return True
+
+
+def seed_tiles(zooms, levels=None, themes=None, access_permissions=frozenset(), processes=1, rate=None,
+               progress_interval=10):
+    """
+    render all tiles within the map bounds that are missing in the tile cache or outdated.
+    :param zooms: zoom levels to render
+    :param levels: level ids to render, all levels if None
+    :param themes: theme ids to render (None being the default theme), all themes if None
+    :param access_permissions: access permissions to render the tiles for, only public tiles by default
+    :param processes: number of worker processes, 1 renders in this process
+    :param rate: maximum number of tiles (or metatiles) to render per second
+    :param progress_interval: seconds between progress log messages
+    :return: number of rendered tiles (or metatiles)
+    """
+    if not settings.CACHE_TILES:
+        raise ValueError('Tile caching is disabled.')
+
+    cache_package = CachePackage.open_cached()
+    level_themes = tuple((level, theme) for level, theme in cache_package.levels.keys()
+                         if (levels is None or level in levels) and (themes is None or theme in themes))
+    access_permissions = set(access_permissions)
+
+    logger.info('Looking for outdated tiles...')
+    jobs = tuple((*tile, access_permissions)
+                 for tile in get_outdated_tiles(cache_package, get_tiles(cache_package, zooms, level_themes),
+                                                access_permissions))
+    unit = 'metatiles' if settings.METATILE_SIZE > 1 else 'tiles'
+    logger.info('%d %s to render.' % (len(jobs), unit))
+    if not jobs:
+        return 0
+
+    start = last_report = time.monotonic()
+    done = failed = 0
+    pool = multiprocessing.get_context('spawn').Pool(processes, initializer=_init_worker) if processes > 1 else None
+    with (pool or nullcontext()):
+        results = (pool.imap_unordered if pool else map)(_render_tile, _rate_limited(jobs, rate))
+        for success in results:
+            done += 1
+            failed += not success
+            now = time.monotonic()
+            if now - last_report >= progress_interval or done == len(jobs):
+                last_report = now
+                logger.info('%d/%d %s rendered, %d failed (%.1f per second).' %
+                            (done, len(jobs), unit, failed, done / max(now - start, 0.001)))
+    return done - failed
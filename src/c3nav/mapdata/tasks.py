@@ -2,6 +2,7 @@ import logging
 import time
 
 from celery.exceptions import MaxRetriesExceededError
+from django.conf import settings
 from django.core.cache import cache
 from django.utils.formats import date_format
 from django.utils.translation import gettext_lazy as _
@@ -47,3 +48,11 @@ def process_map_updates(self):
             'date': date_format(updates[-1].datetime, 'DATETIME_FORMAT'),
             'id': updates[-1].pk,
         })
+
+
+@app.task(bind=True, max_retries=0)
+def seed_tile_cache(self):
+    from c3nav.mapdata.render.seed import seed_tiles
+    logger.info('Rendering outdated tiles...')
+    rendered = seed_tiles(zooms=range(-2, settings.SEED_TILES_MAX_ZOOM + 1), rate=settings.SEED_TILES_RATE)
+    logger.info('%d tiles rendered.' % rendered)
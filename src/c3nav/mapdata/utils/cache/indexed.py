@@ -1,4 +1,5 @@
 import math
+import os
 import struct
 
 import numpy as np
@@ -21,6 +22,8 @@ class GeometryIndexed:
     # x bytes data, line after line. (cell size depends on subclass)
     dtype = np.uint16
     variant_id = 0
+    # cells per side of the blocks that get_geometry_cells checks before looking at single cells
+    rasterize_block_size = 16
 
     def __init__(self, resolution=None, x=0, y=0, data=None, filename=None):
         if resolution is None:
@@ -43,8 +46,32 @@ class GeometryIndexed:
         instance.filename = filename
         return instance
 
+    @classmethod
+    def open_mmap(cls, filename, offset=0):
+        """
+        open without reading the cell data, it gets memory mapped read-only instead.
+        :param offset: where the data starts inside the file, e.g. for files inside an uncompressed tar archive
+        """
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            kwargs, width, height = cls._read_header(f)
+            data_offset = f.tell()
+        if width and height:
+            kwargs['data'] = np.memmap(filename, dtype=cls.dtype, mode='r', offset=data_offset, shape=(height, width))
+        instance = cls(**kwargs)
+        instance.filename = filename
+        return instance
+
     @classmethod
     def read(cls, f):
+        kwargs, width, height = cls._read_header(f)
+        # noinspection PyTypeChecker
+        kwargs['data'] = np.frombuffer(bytearray(f.read(width*height*cls.dtype().itemsize)),
+                                       cls.dtype).reshape((height, width))
+        return cls(**kwargs)
+
+    @classmethod
+    def _read_header(cls, f):
         variant_id, resolution, x, y, width, height = struct.unpack('<BBhhHH', f.read(10))
         if variant_id != cls.variant_id:
             raise ValueError('variant id does not match')
@@ -55,10 +82,7 @@ class GeometryIndexed:
             'y': y,
         }
         cls._read_metadata(f, kwargs)
-
-        # noinspection PyTypeChecker
-        kwargs['data'] = np.fromstring(f.read(width*height*cls.dtype().itemsize), cls.dtype).reshape((height, width))
-        return cls(**kwargs)
+        return kwargs, width, height
 
     @classmethod
     def _read_metadata(cls, f, kwargs):
@@ -70,8 +94,11 @@ class GeometryIndexed:
         if filename is None:
             raise ValueError('Missing filename.')
 
-        with open(filename, 'wb') as f:
+        # write to a temporary file first, the old file might be memory mapped by another process
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
             self.write(f)
+        os.replace(tmp_filename, filename)
 
     def write(self, f):
         f.write(struct.pack('<BBhhHH', self.variant_id, self.resolution, self.x, self.y, *reversed(self.data.shape)))
@@ -121,17 +148,44 @@ class GeometryIndexed:
         maxx = min(maxx, self.x + width)
         maxy = min(maxy, self.y + height)
 
-        from shapely import prepared
-        from shapely.geometry import box
-
         cells = np.zeros_like(self.data, dtype=bool)
-        prep = prepared.prep(geometry)
-        res = self.resolution
-        for iy, y in enumerate(range(miny * res, maxy * res, res), start=miny - self.y):
-            for ix, x in enumerate(range(minx * res, maxx * res, res), start=minx - self.x):
-                if prep.intersects(box(x, y, x + res, y + res)):
-                    cells[iy, ix] = True
+        if minx >= maxx or miny >= maxy:
+            return cells
 
+        import shapely
+        prepared = shapely.is_prepared(geometry)
+        if not prepared:
+            shapely.prepare(geometry)
+
+        # first check coarse blocks of cells: cells in blocks that are contained in the geometry are all touched,
+        # cells in blocks that don't intersect the geometry can't be touched. only the remaining blocks are
+        # checked cell by cell.
+        res = self.resolution
+        block = self.rasterize_block_size
+        block_x = np.arange(minx, maxx, block)
+        block_y = np.arange(miny, maxy, block)
+        block_x, block_y = np.meshgrid(block_x, block_y)
+        blocks = shapely.box(block_x * res, block_y * res,
+                             np.minimum(block_x + block, maxx) * res, np.minimum(block_y + block, maxy) * res)
+        blocks_touched = shapely.intersects(geometry, blocks)
+        blocks_contained = blocks_touched & shapely.contains(geometry, blocks)
+
+        def to_cells(block_mask):
+            return block_mask.repeat(block, axis=0).repeat(block, axis=1)[:maxy-miny, :maxx-minx]
+
+        touched = to_cells(blocks_contained)
+        candidate_y, candidate_x = np.nonzero(to_cells(blocks_touched & ~blocks_contained))
+        if candidate_x.size:
+            candidate_x += minx
+            candidate_y += miny
+            candidates = shapely.box(candidate_x * res, candidate_y * res,
+                                     (candidate_x + 1) * res, (candidate_y + 1) * res)
+            touched[candidate_y - miny, candidate_x - minx] = shapely.intersects(geometry, candidates)
+
+        if not prepared:
+            shapely.destroy_prepared(geometry)
+
+        cells[miny-self.y:maxy-self.y, minx-self.x:maxx-self.x] = touched
         return cells
 
     @property
@@ -225,6 +279,9 @@ class LevelGeometryIndexed(GeometryIndexed):
             if result is not None:
                 return result
 
-        result = cls.open_level(level_id, mode)
+        try:
+            result = cls.open_mmap(cls.level_filename(level_id, mode))
+        except FileNotFoundError:
+            result = cls.open_level(level_id, mode)
         cls.cached.data[(level_id, mode)] = result
         return result
@@ -16,6 +16,7 @@ except ImportError:
     from threading import local as LocalContext
 
 ZSTD_MAGIC_NUMBER = b"\x28\xb5\x2f\xfd"
+FLAT_MAGIC_NUMBER = b"c3pk"
 CachePackageLevel = namedtuple('CachePackageLevel', ('history', 'restrictions'))
 
 
@@ -38,10 +39,13 @@ class CachePackage:
             else:
                 filename = settings.CACHE_ROOT / 'package.tar'
 
+        # write to a temporary file first, the old package might be memory mapped by another process
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+
         filemode = 'w'
         fileobj = None
         if compression == 'zst':
-            fileobj = ZstdFile(filename, filemode, level_or_option={
+            fileobj = ZstdFile(tmp_filename, filemode, level_or_option={
                 CParameter.compressionLevel: 9,
                 CParameter.checksumFlag: 1,
             })
@@ -49,7 +53,7 @@ class CachePackage:
             filemode += ':' + compression
 
         try:
-            with TarFile.open(filename, filemode, fileobj=fileobj) as f:
+            with TarFile.open(tmp_filename, filemode, fileobj=fileobj) as f:
                 self._add_bytesio(f, 'bounds',
                                   BytesIO(struct.pack('<iiii', *(int(i*100) for i in self.bounds))))
 
@@ -63,6 +67,7 @@ class CachePackage:
         finally:
             if fileobj is not None:
                 fileobj.close()
+        os.replace(tmp_filename, filename)
 
     def _add_bytesio(self, f: TarFile, filename: str, data: BytesIO):
         data.seek(0, os.SEEK_END)
@@ -80,10 +85,65 @@ class CachePackage:
         for compression in (None, 'gz', 'xz', 'zst'):
             self.save(filename, compression)
 
+    def save_flat(self, filename):
+        """
+        save as flat uncompressed file that can be opened with open_flat() without reading the level data.
+        format (everything little-endian):
+        4 bytes: magic number
+        16 bytes (4x int32): bounds in centimeters
+        4 bytes (uint32): number of levels
+        n levels times:
+            4 bytes (uint32): level id
+            4 bytes (uint32): theme id (or 0 for no theme)
+            8 bytes (uint64): offset of the map history
+            8 bytes (uint64): offset of the access restrictions
+        after that: map histories and access restrictions in GeometryIndexed binary format
+        """
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            f.write(FLAT_MAGIC_NUMBER)
+            f.write(struct.pack('<iiiiI', *(int(i*100) for i in self.bounds), len(self.levels)))
+            index_offset = f.tell()
+            f.seek(index_offset + len(self.levels) * 24)
+
+            index = []
+            for (level_id, theme_id), level_data in self.levels.items():
+                history_offset = f.tell()
+                level_data.history.write(f)
+                restrictions_offset = f.tell()
+                level_data.restrictions.write(f)
+                index.append((level_id, theme_id or 0, history_offset, restrictions_offset))
+
+            f.seek(index_offset)
+            for entry in index:
+                f.write(struct.pack('<IIQQ', *entry))
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def open_flat(cls, filename: str | os.PathLike) -> Self:
+        """
+        open a package saved with save_flat(), all level data is memory mapped.
+        """
+        with open(filename, 'rb') as f:
+            if f.read(4) != FLAT_MAGIC_NUMBER:
+                raise ValueError('not a flat cache package')
+            *bounds, num_levels = struct.unpack('<iiiiI', f.read(20))
+            index = [struct.unpack('<IIQQ', f.read(24)) for i in range(num_levels)]
+
+        levels = {}
+        for level_id, theme_id, history_offset, restrictions_offset in index:
+            levels[(level_id, theme_id or None)] = CachePackageLevel(
+                history=MapHistory.open_mmap(filename, offset=history_offset),
+                restrictions=AccessRestrictionAffected.open_mmap(filename, offset=restrictions_offset),
+            )
+
+        return cls(tuple(i/100 for i in bounds), levels)
+
     @classmethod
     def read(cls, f: BinaryIO) -> Self:
         # test if it's a zstd compressed archive
         # read magic bytes
+        raw_f = f
         magic_number = f.read(4)
         f.seek(0)
         if magic_number == ZSTD_MAGIC_NUMBER:
@@ -97,8 +157,19 @@ class CachePackage:
                 # Not a zst file or a broken file. Let's give Tarfile a try with the original file
                 f = _f
 
-        f = TarFile.open(fileobj=f)
-        files = {info.name: info for info in f.getmembers()}
+        tar = TarFile.open(fileobj=f)
+        files = {info.name: info for info in tar.getmembers()}
+
+        # if this is an uncompressed archive on disk, the level data can be memory mapped instead of read
+        mmap_filename = None
+        if tar.fileobj is raw_f and isinstance(getattr(f, 'name', None), (str, os.PathLike)):
+            mmap_filename = f.name
+        f = tar
+
+        def read_geometryindexed(cls, filename):
+            if mmap_filename is not None:
+                return cls.open_mmap(mmap_filename, offset=files[filename].offset_data)
+            return cls.read(f.extractfile(files[filename]))
 
         bounds = tuple(i/100 for i in struct.unpack('<iiii', f.extractfile(files['bounds']).read()))
 
@@ -113,8 +184,8 @@ class CachePackage:
                 level_id = int(key)
                 theme_id = None
             levels[(level_id, theme_id)] = CachePackageLevel(
-                history=MapHistory.read(f.extractfile(files['history_%s' % key])),
-                restrictions=AccessRestrictionAffected.read(f.extractfile(files['restrictions_%s' % key]))
+                history=read_geometryindexed(MapHistory, 'history_%s' % key),
+                restrictions=read_geometryindexed(AccessRestrictionAffected, 'restrictions_%s' % key),
             )
 
         return cls(bounds, levels)
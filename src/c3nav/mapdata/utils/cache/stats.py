@@ -1,5 +1,14 @@
+import atexit
+import os
+import threading
+import time
+import zlib
+from collections import Counter
+from contextlib import contextmanager, suppress
+from itertools import chain
 from operator import itemgetter
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.cache import cache
 from django.utils import timezone
@@ -13,22 +22,169 @@ from c3nav.mapdata.models.locations import LocationRedirect
 from c3nav.mapdata.utils.locations import CustomLocation, get_location_by_id_for_request
 
 
-def increment_cache_key(cache_key):
-    print('increment_cache_key', cache_key)
+STATS_CACHE_KEY = 'apistats'
+# cache backends without a hash type store the stats as dicts, split up so no single value gets too big
+STATS_SHARDS = 64
+
+# subtracts the given values from the stats hash and removes the fields that end up at zero, atomically
+STATS_RESET_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    if redis.call('HINCRBY', KEYS[1], ARGV[i], -tonumber(ARGV[i + 1])) == 0 then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+end
+"""
+
+
+def _get_redis_client():
+    if settings.CACHES['default']['BACKEND'] == 'django.core.cache.backends.redis.RedisCache':
+        return cache._cache.get_client(write=True)
+    return None
+
+
+def _get_shard_key(name):
+    return '%s_%d' % (STATS_CACHE_KEY, zlib.crc32(name.encode()) % STATS_SHARDS)
+
+
+@contextmanager
+def _stats_lock(shard_key):
+    """
+    short lock for read-modify-write of a stats shard on cache backends without a hash type.
+    yields whether the lock was acquired, the lock is only released by whoever acquired it.
+    """
+    lock_key = shard_key + '_lock'
+    for i in range(100):
+        if cache.add(lock_key, 1, 10):
+            break
+        time.sleep(0.01)
+    else:
+        yield False
+        return
     try:
-        cache.incr(cache_key)
-    except ValueError:
-        cache.set(cache_key, 1, None)
+        yield True
+    finally:
+        cache.delete(lock_key)
+
+
+def add_stats(counts) -> Counter:
+    """
+    add counters to the shared stats, which are a redis hash or sharded dicts for other cache backends
+    :return: counts that could not be added because a shard stayed locked, to retry them later
+    """
+    client = _get_redis_client()
+    if client is not None:
+        key = cache.make_key(STATS_CACHE_KEY)
+        pipeline = client.pipeline(transaction=False)
+        for name, amount in counts.items():
+            pipeline.hincrby(key, name, amount)
+        pipeline.execute()
+        return Counter()
+
+    shards = {}
+    for name, amount in counts.items():
+        shards.setdefault(_get_shard_key(name), {})[name] = amount
+
+    remaining = Counter()
+    for shard_key, shard_counts in shards.items():
+        with _stats_lock(shard_key) as locked:
+            if not locked:
+                remaining.update(shard_counts)
+                continue
+            stats = cache.get(shard_key, {})
+            for name, amount in shard_counts.items():
+                stats[name] = stats.get(name, 0) + amount
+            cache.set(shard_key, stats, None)
+    return remaining
+
+
+def get_stats(prefix='', reset=False) -> dict[str, int]:
+    """
+    get all shared stats starting with the given prefix, optionally subtracting them so they start at zero again
+    """
+    client = _get_redis_client()
+    if client is not None:
+        key = cache.make_key(STATS_CACHE_KEY)
+        all_stats = {name.decode(): int(value) for name, value in client.hgetall(key).items()}
+        all_stats = {name: value for name, value in all_stats.items() if name.startswith(prefix)}
+        if reset and all_stats:
+            # subtract instead of deleting, so increments since reading them are kept.
+            # fields that are at zero already are passed too, so they get removed.
+            client.register_script(STATS_RESET_SCRIPT)(keys=[key], args=list(chain(*all_stats.items())))
+        return {name: value for name, value in all_stats.items() if value}
+
+    stats = {}
+    for shard_key in ('%s_%d' % (STATS_CACHE_KEY, i) for i in range(STATS_SHARDS)):
+        if not reset:
+            stats.update((name, value) for name, value in cache.get(shard_key, {}).items()
+                         if name.startswith(prefix) and value)
+            continue
+        with _stats_lock(shard_key) as locked:
+            if not locked:
+                # leave this shard as it is, its stats will be returned next time
+                continue
+            all_stats = cache.get(shard_key, {})
+            shard_stats = {name: value for name, value in all_stats.items() if name.startswith(prefix) and value}
+            if shard_stats:
+                cache.set(shard_key, {name: value for name, value in all_stats.items() if name not in shard_stats},
+                          None)
+            stats.update(shard_stats)
+    return stats
+
+
+class StatsBuffer:
+    """
+    Counts stats in-process and adds them to the shared stats in one batch every flush_interval seconds.
+    """
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.thread_pid = None
+
+    def increment(self, key, amount=1):
+        with self.lock:
+            self.counts[key] += amount
+            if self.thread_pid != os.getpid():
+                # start the flush thread lazily in every (forked) worker process
+                self.thread_pid = os.getpid()
+                threading.Thread(target=self._flush_periodically, daemon=True).start()
+
+    def flush(self):
+        with self.lock:
+            counts, self.counts = self.counts, Counter()
+        if not counts:
+            return
+        try:
+            remaining = add_stats(counts)
+        except Exception:
+            # keep the counts for the next flush
+            with self.lock:
+                self.counts.update(counts)
+            raise
+        if remaining:
+            with self.lock:
+                self.counts.update(remaining)
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            with suppress(Exception):
+                self.flush()
+
+
+stats_buffer = StatsBuffer(flush_interval=settings.STATS_FLUSH_INTERVAL)
+atexit.register(stats_buffer.flush)
+
+
+def increment_cache_key(cache_key, amount=1):
+    stats_buffer.increment(cache_key, amount)
 
 
 def stats_snapshot(reset=True):
+    stats_buffer.flush()
     last_now = cache.get('apistats_last_reset', '', None)
     now = timezone.now()
-    results = {}
-    for key in cache.keys('apistats__*'):
-        results[key] = cache.get(key)
-        if reset:
-            cache.delete(key)
+    results = get_stats(prefix='apistats__', reset=reset)
     if reset:
         cache.set('apistats_last_reset', now, None)
     results = dict(sorted(results.items()))
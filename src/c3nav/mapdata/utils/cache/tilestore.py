@@ -0,0 +1,123 @@
+import logging
+import math
+import os
+import sqlite3
+import threading
+from itertools import groupby
+from typing import Optional, Self
+
+from c3nav.mapdata.utils.tiles import build_base_cache_key, get_tile_bounds
+
+logger = logging.getLogger('c3nav')
+
+
+class PackedTileStore:
+    """
+    Tile cache in a single indexed SQLite file, instead of one directory per tile.
+    Only the latest version of each tile is kept, it is only returned if its base cache key still matches.
+    """
+    zooms = range(-2, 6)
+
+    def __init__(self, filename: str | os.PathLike):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, timeout=60)
+        # no WAL journal, it needs shared memory, which doesn't work on network file systems
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS tiles (
+                level INTEGER NOT NULL,
+                zoom INTEGER NOT NULL,
+                x INTEGER NOT NULL,
+                y INTEGER NOT NULL,
+                access_key TEXT NOT NULL,
+                theme TEXT NOT NULL,
+                base_cache_key TEXT NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (level, zoom, x, y, access_key, theme)
+            ) WITHOUT ROWID
+        ''')
+
+    # sqlite connections can't be shared between threads or forked processes
+    cached = threading.local()
+
+    @classmethod
+    def open_cached(cls) -> Self:
+        from django.conf import settings
+        if getattr(cls.cached, 'pid', None) != os.getpid():
+            cls.cached.pid = os.getpid()
+            cls.cached.data = cls(settings.TILES_ROOT / 'tiles.sqlite3')
+        return cls.cached.data
+
+    def read(self, level, zoom, x, y, theme_key, base_cache_key, access_cache_key) -> Optional[bytes]:
+        result = self.connection.execute(
+            'SELECT data FROM tiles '
+            'WHERE level = ? AND zoom = ? AND x = ? AND y = ? AND access_key = ? AND theme = ? AND base_cache_key = ?',
+            (level, zoom, x, y, access_cache_key, theme_key, base_cache_key)
+        ).fetchone()
+        return None if result is None else result[0]
+
+    def write(self, level, zoom, x, y, theme_key, base_cache_key, access_cache_key, data: bytes):
+        # replaces outdated versions of this tile
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO tiles (level, zoom, x, y, access_key, theme, base_cache_key, data) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (level, zoom, x, y, access_cache_key, theme_key, base_cache_key, data)
+            )
+
+    def invalidate_region(self, minx, miny, maxx, maxy, level=None):
+        """
+        delete all tiles that intersect with the given bounds, on every level if no level is given.
+        """
+        query = 'DELETE FROM tiles WHERE zoom = ? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?'
+        if level is not None:
+            query += ' AND level = ?'
+        with self.connection:
+            for zoom in self.zooms:
+                # tiles overlap by one pixel, include one more tile on each side to be sure
+                size = 256 / 2 ** zoom
+                params = (zoom, math.floor(minx / size) - 1, math.floor(maxx / size),
+                          math.floor(-maxy / size) - 1, math.floor(-miny / size))
+                self.connection.execute(query, params if level is None else (*params, level))
+
+    def invalidate_changes(self, changed_areas: Optional[dict]):
+        """
+        delete all tiles affected by the changed geometries of a map update, all tiles if changed_areas is None.
+        upper levels contain the geometries of the levels below, so tiles on every level are deleted.
+        """
+        if changed_areas is None:
+            self.clear()
+            return
+        for geometry in changed_areas.values():
+            if not geometry.is_empty:
+                self.invalidate_region(*geometry.bounds)
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM tiles')
+
+    def compact(self, cache_package):
+        """
+        delete all tiles that are outdated according to the given cache package and shrink the file.
+        :return: number of deleted tiles
+        """
+        stale = []
+        tiles = self.connection.execute(
+            'SELECT level, zoom, x, y, theme, base_cache_key FROM tiles ORDER BY level, theme'
+        )
+        for (level, theme_key), level_tiles in groupby(tiles, key=lambda tile: (tile[0], tile[4])):
+            level_data = cache_package.levels.get((level, None if theme_key == 'None' else int(theme_key)))
+            for level, zoom, x, y, theme_key, base_cache_key in level_tiles:
+                if level_data is None or base_cache_key != build_base_cache_key(
+                        level_data.history.last_update(*get_tile_bounds(zoom, x, y))):
+                    stale.append((level, zoom, x, y, theme_key, base_cache_key))
+
+        with self.connection:
+            self.connection.executemany(
+                'DELETE FROM tiles '
+                'WHERE level = ? AND zoom = ? AND x = ? AND y = ? AND theme = ? AND base_cache_key = ?',
+                stale
+            )
+        logger.info('Deleted %d outdated tiles, compacting...' % len(stale))
+        self.connection.execute('VACUUM')
+        return len(stale)
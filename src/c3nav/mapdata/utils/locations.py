@@ -263,14 +263,27 @@ def get_location_by_slug_for_request(slug: str, request) -> Optional[Union[Locat
 
 
 def get_custom_location_for_request(slug: str, request):
+    return _get_custom_location(slug, levels_by_short_label_for_request(request),
+                                AccessPermission.get_for_request(request))
+
+
+def get_custom_locations_for_request(slugs: List[str], request) -> List[Optional["CustomLocation"]]:
+    """
+    get the custom locations for many slugs, with the levels and access permissions only resolved once
+    """
+    levels = levels_by_short_label_for_request(request)
+    permissions = AccessPermission.get_for_request(request)
+    return [_get_custom_location(slug, levels, permissions) for slug in slugs]
+
+
+def _get_custom_location(slug: str, levels: Mapping[str, Level], permissions):
     match = re.match(r'^c:(?P<level>[a-z0-9-_]+):(?P<x>-?\d+(\.\d+)?):(?P<y>-?\d+(\.\d+)?)$', slug)
     if match is None:
         return None
-    level = levels_by_short_label_for_request(request).get(match.group('level'))
+    level = levels.get(match.group('level'))
     if not isinstance(level, Level):
         return None
-    return CustomLocation(level, float(match.group('x')), float(match.group('y')),
-                          AccessPermission.get_for_request(request))
+    return CustomLocation(level, float(match.group('x')), float(match.group('y')), permissions)
 
 
 @dataclass
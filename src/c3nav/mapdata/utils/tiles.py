@@ -18,6 +18,18 @@ def get_tile_bounds(zoom, x, y):
     return minx, miny, maxx, maxy
 
 
+def get_metatile(x, y, metatile_size):
+    # get the top left tile of the metatile that contains this tile
+    return x // metatile_size * metatile_size, y // metatile_size * metatile_size
+
+
+def get_metatile_bounds(zoom, x, y, metatile_size):
+    # bounds of metatile_size×metatile_size tiles starting with the given top left tile, including the overlap pixel
+    minx, miny = get_tile_bounds(zoom, x, y + metatile_size - 1)[:2]
+    maxx, maxy = get_tile_bounds(zoom, x + metatile_size - 1, y)[2:]
+    return minx, miny, maxx, maxy
+
+
 def build_tile_access_cookie(access_permissions, tile_secret):
     value = '-'.join(str(i) for i in access_permissions) + ':' + str(int(time.time()) + 60)
     key = hashlib.sha1(tile_secret.encode()).digest()
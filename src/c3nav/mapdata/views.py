@@ -1,6 +1,7 @@
 import base64
 import os
 from collections import Counter
+from io import BytesIO
 from shutil import rmtree
 from typing import Optional
 from wsgiref.util import FileWrapper
@@ -12,6 +13,7 @@ from django.http import Http404, HttpResponse, HttpResponseNotModified, Streamin
 from django.shortcuts import get_object_or_404
 from django.utils.http import content_disposition_header
 from django.views.decorators.http import etag
+from PIL import Image
 from shapely import LineString, Point, box, unary_union
 
 from c3nav.mapdata.middleware import no_language
@@ -21,8 +23,10 @@ from c3nav.mapdata.render.engines import ImageRenderEngine
 from c3nav.mapdata.render.engines.base import FillAttribs, StrokeAttribs
 from c3nav.mapdata.render.renderer import MapRenderer
 from c3nav.mapdata.utils.cache import CachePackage, MapHistory
+from c3nav.mapdata.utils.cache.tilestore import PackedTileStore
 from c3nav.mapdata.utils.tiles import (build_access_cache_key, build_base_cache_key, build_tile_access_cookie,
-                                       build_tile_etag, get_tile_bounds, parse_tile_access_cookie)
+                                       build_tile_etag, get_metatile, get_metatile_bounds, get_tile_bounds,
+                                       parse_tile_access_cookie)
 
 PREVIEW_HIGHLIGHT_FILL_OPACITY = 0.1
 PREVIEW_HIGHLIGHT_STROKE_WIDTH = 0.5
@@ -325,6 +329,120 @@ def preview_route(request, slug, slug2):
                          render_preview)
 
 
+def get_tile_cache_files(level, zoom, x, y, theme_key, access_cache_key):
+    tile_directory = settings.TILES_ROOT / str(level) / str(zoom) / str(x) / str(y) / access_cache_key
+    return tile_directory, tile_directory / 'last_update', tile_directory / f'{theme_key}.png'
+
+
+def read_tile_cache(level, zoom, x, y, theme_key, base_cache_key, access_cache_key):
+    # get cached tile, or None if it's not cached or outdated. outdated tile directories get deleted.
+    if settings.TILE_STORE == 'packed':
+        return PackedTileStore.open_cached().read(level, zoom, x, y, theme_key, base_cache_key, access_cache_key)
+
+    tile_directory, last_update_file, tile_file = get_tile_cache_files(level, zoom, x, y, theme_key,
+                                                                       access_cache_key)
+
+    # get tile cache last update
+    tile_cache_update_cache_key = 'mapdata:tile-cache-update:%d-%d-%d-%d' % (level, zoom, x, y)
+    tile_cache_update = cache.get(tile_cache_update_cache_key, None)
+    if tile_cache_update is None:
+        try:
+            tile_cache_update = last_update_file.read_text()
+        except FileNotFoundError:
+            pass
+
+    if tile_cache_update != base_cache_key:
+        try:
+            old_tile_directory = tile_directory.rename(tile_directory.parent /
+                                                       (tile_directory.name + '_old_tile_dir'))
+            rmtree(old_tile_directory)
+        except FileNotFoundError:
+            pass
+        return None
+
+    try:
+        return tile_file.read_bytes()
+    except FileNotFoundError:
+        return None
+
+
+def write_tile_cache(level, zoom, x, y, theme_key, base_cache_key, access_cache_key, data):
+    if settings.TILE_STORE == 'packed':
+        PackedTileStore.open_cached().write(level, zoom, x, y, theme_key, base_cache_key, access_cache_key, data)
+        return
+
+    tile_directory, last_update_file, tile_file = get_tile_cache_files(level, zoom, x, y, theme_key,
+                                                                       access_cache_key)
+    os.makedirs(tile_directory, exist_ok=True)
+    tile_file.write_bytes(data)
+    last_update_file.write_text(base_cache_key)
+    cache.set('mapdata:tile-cache-update:%d-%d-%d-%d' % (level, zoom, x, y), base_cache_key, 60)
+
+
+def render_metatile(cache_package, level, zoom, x, y, theme, access_permissions):
+    """
+    render the whole metatile that contains the given tile in one pass, slice it into tiles,
+    put all of them into the tile cache and return the requested one.
+    """
+    size = settings.METATILE_SIZE
+    meta_x, meta_y = get_metatile(x, y, size)
+    renderer = MapRenderer(level, *get_metatile_bounds(zoom, meta_x, meta_y, size), scale=2 ** zoom,
+                           access_permissions=access_permissions)
+    image = Image.open(BytesIO(renderer.render(ImageRenderEngine, theme=theme).render()))
+    image.load()
+
+    level_data = cache_package.levels[(level, theme)]
+    theme_key = str(theme)
+    result = None
+    for tile_y in range(meta_y, meta_y+size):
+        for tile_x in range(meta_x, meta_x+size):
+            minx, miny, maxx, maxy = get_tile_bounds(zoom, tile_x, tile_y)
+            if not cache_package.bounds_valid(minx, miny, maxx, maxy):
+                continue
+
+            # tiles are 256px with one pixel overlap
+            left, top = (tile_x-meta_x) * 256, (tile_y-meta_y) * 256
+            f = BytesIO()
+            image.crop((left, top, left + 257, top + 257)).save(f, 'PNG')
+            data = f.getvalue()
+
+            # each tile gets cached using the access permissions that are relevant for it
+            base_cache_key = build_base_cache_key(level_data.history.last_update(minx, miny, maxx, maxy))
+            access_cache_key = build_access_cache_key(
+                access_permissions & set(level_data.restrictions[minx:maxx, miny:maxy])
+            )
+            if (tile_x, tile_y) == (x, y):
+                result = data
+            elif read_tile_cache(level, zoom, tile_x, tile_y, theme_key,
+                                 base_cache_key, access_cache_key) is not None:
+                continue
+            write_tile_cache(level, zoom, tile_x, tile_y, theme_key, base_cache_key, access_cache_key, data)
+    return result
+
+
+def render_tile(cache_package, level, zoom, x, y, theme, access_permissions):
+    """
+    render the given tile and put it into the tile cache, if tile caching is enabled.
+    only the access permissions that are relevant for the tile are used.
+    """
+    if settings.CACHE_TILES and settings.METATILE_SIZE > 1:
+        return render_metatile(cache_package, level, zoom, x, y, theme, access_permissions)
+
+    level_data = cache_package.levels[(level, theme)]
+    minx, miny, maxx, maxy = get_tile_bounds(zoom, x, y)
+    access_permissions = access_permissions & set(level_data.restrictions[minx:maxx, miny:maxy])
+
+    renderer = MapRenderer(level, minx, miny, maxx, maxy, scale=2 ** zoom, access_permissions=access_permissions)
+    image = renderer.render(ImageRenderEngine, theme=theme)
+    data = image.render()
+
+    if settings.CACHE_TILES:
+        base_cache_key = build_base_cache_key(level_data.history.last_update(minx, miny, maxx, maxy))
+        write_tile_cache(level, zoom, x, y, str(theme), base_cache_key, build_access_cache_key(access_permissions),
+                         data)
+    return data
+
+
 @no_language()
 def tile(request, level, zoom, x, y, theme, access_permissions: Optional[set] = None):
     if access_permissions is not None:
@@ -380,46 +498,11 @@ def tile(request, level, zoom, x, y, theme, access_permissions: Optional[set] =
         return HttpResponseNotModified()
 
     data = None
-    tile_directory, last_update_file, tile_file, tile_cache_update_cache_key = '', '', '', ''
-
-    # get tile cache last update
     if settings.CACHE_TILES:
-        tile_directory = settings.TILES_ROOT / str(level) / str(zoom) / str(x) / str(y) / access_cache_key
-        last_update_file = tile_directory / 'last_update'
-        tile_file = tile_directory / f'{theme_key}.png'
-
-        # get tile cache last update
-        tile_cache_update_cache_key = 'mapdata:tile-cache-update:%d-%d-%d-%d' % (level, zoom, x, y)
-        tile_cache_update = cache.get(tile_cache_update_cache_key, None)
-        if tile_cache_update is None:
-            try:
-                tile_cache_update = last_update_file.read_text()
-            except FileNotFoundError:
-                pass
-
-        if tile_cache_update != base_cache_key:
-            try:
-                old_tile_directory = tile_directory.rename(tile_directory.parent /
-                                                           (tile_directory.name + '_old_tile_dir'))
-                rmtree(old_tile_directory)
-            except FileNotFoundError:
-                pass
-        else:
-            try:
-                data = tile_file.read_bytes()
-            except FileNotFoundError:
-                pass
+        data = read_tile_cache(level, zoom, x, y, theme_key, base_cache_key, access_cache_key)
 
     if data is None:
-        renderer = MapRenderer(level, minx, miny, maxx, maxy, scale=2 ** zoom, access_permissions=access_permissions)
-        image = renderer.render(ImageRenderEngine, theme=theme)
-        data = image.render()
-
-        if settings.CACHE_TILES:
-            os.makedirs(tile_directory, exist_ok=True)
-            tile_file.write_bytes(data)
-            last_update_file.write_text(base_cache_key)
-            cache.set(tile_cache_update_cache_key, base_cache_key, 60)
+        data = render_tile(cache_package, level, zoom, x, y, theme, access_permissions)
 
     response = HttpResponse(data, 'image/png')
     response['ETag'] = tile_etag
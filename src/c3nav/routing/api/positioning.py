@@ -1,3 +1,4 @@
+from collections import Counter
 from typing import Annotated, Union
 
 from django.conf import settings
@@ -6,7 +7,8 @@ from ninja import Field as APIField
 from ninja import Router as APIRouter
 from pydantic_extra_types.mac_address import MacAddress
 
-from c3nav.api.auth import auth_responses
+from c3nav.api.auth import auth_responses, validate_responses
+from c3nav.api.exceptions import APIRequestValidationFailed
 from c3nav.api.schema import BaseSchema
 from c3nav.mapdata.models.access import AccessPermission
 from c3nav.mapdata.schemas.models import CustomLocationSchema
@@ -36,6 +38,12 @@ class PositioningResult(BaseSchema):
     )
 
 
+def increment_locate_stats(locations):
+    # one increment per location instead of one per scan
+    for pk, amount in Counter(location.pk for location in locations if location is not None).items():
+        increment_cache_key('apistats__locate__%s' % pk, amount)
+
+
 @positioning_api_router.post('/locate/', summary="determine position",
                              description="determine position based on wireless measurements "
                                          "(including ranging, if available)",
@@ -44,9 +52,7 @@ def get_position(request, parameters: LocateRequestSchema):
     try:
         location = Locator.load().locate(parameters.dict()["wifi_peers"],
                                          permissions=AccessPermission.get_for_request(request))
-        if location is not None:
-            # todo: this will overload us probably, group these
-            increment_cache_key('apistats__locate__%s' % location.pk)
+        increment_locate_stats((location, ))
     except ValidationError:
         # todo: validation error, seriously? this shouldn't happen anyways
         raise
@@ -56,6 +62,42 @@ def get_position(request, parameters: LocateRequestSchema):
     }
 
 
+LOCATE_BATCH_MAX = 1000
+
+
+class BatchLocateRequestSchema(BaseSchema):
+    scans: list[LocateRequestSchema] = APIField(
+        title="list of scans",
+        description="scans to determine positions for, e.g. from a tracking gateway or replayed logs",
+    )
+
+
+class BatchPositioningResult(BaseSchema):
+    locations: list[Union[
+        Annotated[CustomLocationSchema, APIField(title="location")],
+        Annotated[None, APIField(title="null", description="position could not be determined")]
+    ]] = APIField(
+        title="locations",
+        description="positioning result for each scan, in the same order",
+    )
+
+
+@positioning_api_router.post('/locate/batch/', summary="determine many positions",
+                             description="determine positions for many sets of wireless measurements at once",
+                             response={200: BatchPositioningResult, **validate_responses, **auth_responses})
+def get_positions(request, parameters: BatchLocateRequestSchema):
+    if len(parameters.scans) > LOCATE_BATCH_MAX:
+        raise APIRequestValidationFailed("At most %d scans can be located at once." % LOCATE_BATCH_MAX)
+
+    locations = Locator.load().locate_many([scan["wifi_peers"] for scan in parameters.dict()["scans"]],
+                                           permissions=AccessPermission.get_for_request(request))
+    increment_locate_stats(locations)
+
+    return {
+        "locations": [location.serialize(simple_geometry=True) if location else None for location in locations],
+    }
+
+
 if settings.METRICS:
     from c3nav.mapdata.metrics import APIStatsCollector
     APIStatsCollector.add_stat('locate', 'location')
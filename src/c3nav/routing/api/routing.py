@@ -1,6 +1,8 @@
 from enum import StrEnum
+from itertools import chain
 from typing import Annotated, Any, Optional, Union
 
+import numpy as np
 from django.core.exceptions import ValidationError
 from django.conf import settings
 from django.urls import reverse
@@ -19,7 +21,7 @@ from c3nav.mapdata.models.access import AccessPermission
 from c3nav.mapdata.models.locations import Position
 from c3nav.mapdata.schemas.model_base import AnyLocationID, Coordinates3D
 from c3nav.mapdata.utils.cache.stats import increment_cache_key
-from c3nav.mapdata.utils.locations import visible_locations_for_request
+from c3nav.mapdata.utils.locations import get_location_by_id_for_request, visible_locations_for_request
 from c3nav.routing.exceptions import LocationUnreachable, NoRouteFound, NotYetRoutable
 from c3nav.routing.forms import RouteForm
 from c3nav.routing.models import RouteOptions
@@ -252,12 +254,194 @@ def get_route(request, parameters: RouteParametersSchema):
     )
 
 
+BATCH_ROUTES_MAX = 1000
+
+ROUTE_ERRORS = {
+    NotYetRoutable: _('Not yet routable, try again shortly.'),
+    LocationUnreachable: _('Unreachable location.'),
+    NoRouteFound: _('No route found.'),
+}
+
+
+class RoutePairSchema(BaseSchema):
+    origin: AnyLocationID
+    destination: AnyLocationID
+
+
+class BatchRouteParametersSchema(BaseSchema):
+    pairs: list[RoutePairSchema] = APIField(
+        default_factory=list,
+        title="origin/destination pairs",
+        description="list of origin/destination pairs to route between",
+    )
+    origins: list[AnyLocationID] = APIField(
+        default_factory=list,
+        title="origins",
+        description="together with destinations: route from each of these origins to each destination",
+    )
+    destinations: list[AnyLocationID] = APIField(
+        default_factory=list,
+        title="destinations",
+        description="together with origins: route from each origin to each of these destinations",
+    )
+    options_override: Optional[UpdateRouteOptionsSchema] = APIField(
+        None,
+        title="override routing options",
+    )
+
+
+class BatchRouteItemSchema(BaseSchema):
+    origin: AnyLocationID
+    destination: AnyLocationID
+    result: Union[
+        Annotated[RouteSchema, APIField(title="route found")],
+        Annotated[None, APIField(title="null", description="route could not be determined")],
+    ] = APIField(None, title="route")
+    error: Union[
+        Annotated[NonEmptyStr, APIField(title="error description",
+                                        description="reason why it was not possible to determine a route")],
+        Annotated[None, APIField(title="null", description="route was found")],
+    ] = APIField(None, title="error")
+
+
+class BatchRouteResponse(BaseSchema):
+    options: RouteOptionsSchema
+    routes: list[BatchRouteItemSchema]
+
+
+def get_locations_for_request(location_ids, request):
+    locations = {}
+    for location_id in location_ids:
+        if location_id not in locations:
+            location = get_location_by_id_for_request(location_id, request)
+            if location is None:
+                raise APIRequestValidationFailed("Unknown location: %s" % location_id)
+            locations[location_id] = location
+    return locations
+
+
+@routing_api_router.post('/routes/', summary="query many routes",
+                         description="query routes between many origin/destination pairs at once, either as a list "
+                                     "of pairs or from each of the given origins to each of the given destinations",
+                         auth=APIKeyAuth(is_readonly=True),
+                         response={200: BatchRouteResponse, **validate_responses, **auth_responses})
+def get_routes(request, parameters: BatchRouteParametersSchema):
+    pairs = [(pair.origin, pair.destination) for pair in parameters.pairs]
+    pairs.extend((origin, destination) for origin in parameters.origins for destination in parameters.destinations)
+    if not pairs:
+        raise APIRequestValidationFailed("No origin/destination pairs given.")
+    if len(pairs) > BATCH_ROUTES_MAX:
+        raise APIRequestValidationFailed("At most %d routes can be queried at once." % BATCH_ROUTES_MAX)
+
+    locations = get_locations_for_request(set(chain(*pairs)), request)
+
+    options = RouteOptions.get_for_request(request)
+    if parameters.options_override is not None:
+        _new_update_route_options(options, parameters.options_override)
+
+    routes = Router.load().get_routes(
+        pairs=[(locations[origin], locations[destination]) for origin, destination in pairs],
+        permissions=AccessPermission.get_for_request(request),
+        options=options,
+    )
+
+    increment_cache_key('apistats__route_batch')
+
+    visible_locations = visible_locations_for_request(request)
+    return BatchRouteResponse(
+        options=_new_serialize_route_options(options),
+        routes=[
+            BatchRouteItemSchema(origin=origin, destination=destination, error=ROUTE_ERRORS[type(route)])
+            if isinstance(route, Exception) else
+            BatchRouteItemSchema(origin=origin, destination=destination,
+                                 result=route.serialize(locations=visible_locations))
+            for (origin, destination), route in zip(pairs, routes)
+        ],
+    )
+
+
+DISTANCE_MATRIX_MAX = 20000
+
+
+class DistanceMatrixParametersSchema(BaseSchema):
+    origins: list[AnyLocationID] = APIField(
+        title="origins",
+        description="one row of the matrix per origin",
+    )
+    destinations: list[AnyLocationID] = APIField(
+        title="destinations",
+        description="one column of the matrix per destination",
+    )
+    options_override: Optional[UpdateRouteOptionsSchema] = APIField(
+        None,
+        title="override routing options",
+    )
+
+
+class DistanceMatrixResponse(BaseSchema):
+    options: RouteOptionsSchema
+    origins: list[AnyLocationID]
+    destinations: list[AnyLocationID]
+    distances: list[list[Union[
+        Annotated[float, APIField(title="distance", description="distance in meters")],
+        Annotated[None, APIField(title="null", description="no route found")],
+    ]]] = APIField(
+        title="distances",
+        description="distance matrix, one row per origin, one column per destination",
+    )
+    durations: list[list[Union[
+        Annotated[int, APIField(title="duration", description="duration in seconds")],
+        Annotated[None, APIField(title="null", description="no route found")],
+    ]]] = APIField(
+        title="durations",
+        description="duration matrix, one row per origin, one column per destination",
+    )
+
+
+@routing_api_router.post('/matrix/', summary="query distance matrix",
+                         description="query travel distances and durations from each origin to each destination",
+                         auth=APIKeyAuth(is_readonly=True),
+                         response={200: DistanceMatrixResponse, **validate_responses, **auth_responses})
+def get_distance_matrix(request, parameters: DistanceMatrixParametersSchema):
+    if not parameters.origins or not parameters.destinations:
+        raise APIRequestValidationFailed("Origins and destinations can't be empty.")
+    if len(parameters.origins) * len(parameters.destinations) > DISTANCE_MATRIX_MAX:
+        raise APIRequestValidationFailed("The matrix can have at most %d entries." % DISTANCE_MATRIX_MAX)
+
+    locations = get_locations_for_request(set(chain(parameters.origins, parameters.destinations)), request)
+
+    options = RouteOptions.get_for_request(request)
+    if parameters.options_override is not None:
+        _new_update_route_options(options, parameters.options_override)
+
+    distances, durations = Router.load().distance_matrix(
+        origins=[locations[origin] for origin in parameters.origins],
+        destinations=[locations[destination] for destination in parameters.destinations],
+        permissions=AccessPermission.get_for_request(request),
+        options=options,
+    )
+
+    increment_cache_key('apistats__route_matrix')
+
+    return DistanceMatrixResponse(
+        options=_new_serialize_route_options(options),
+        origins=parameters.origins,
+        destinations=parameters.destinations,
+        distances=[[None if np.isnan(distance) else round(float(distance), 2) for distance in row]
+                   for row in distances],
+        durations=[[None if np.isnan(duration) else round(duration) for duration in row]
+                   for row in durations],
+    )
+
+
 if settings.METRICS:
     from c3nav.mapdata.metrics import APIStatsCollector
     APIStatsCollector.add_stat('route')
     APIStatsCollector.add_stat('route_tuple', ['origin', 'destination'])
     APIStatsCollector.add_stat('route_origin', ['origin'])
     APIStatsCollector.add_stat('route_destination', ['destination'])
+    APIStatsCollector.add_stat('route_batch')
+    APIStatsCollector.add_stat('route_matrix')
 
 
 def _new_serialize_route_options(options):
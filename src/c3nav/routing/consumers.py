@@ -0,0 +1,100 @@
+import json
+from datetime import timedelta
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from pydantic import ValidationError
+
+from c3nav.api.auth import APIKeyAuth
+from c3nav.api.exceptions import APIKeyInvalid, APIPermissionDenied
+from c3nav.mapdata.models.access import AccessPermission, AccessRestriction
+from c3nav.routing.api.positioning import (LOCATE_BATCH_MAX, BatchLocateRequestSchema, LocateRequestSchema,
+                                           increment_locate_stats)
+from c3nav.routing.locator import Locator
+from c3nav.routing.router import Router
+
+
+class LocateConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Streaming variant of the locate API for continuous position updates.
+    Authentication is the same as for the locate API: an API key in the X-API-Key header, or in the key query
+    parameter for browsers, which can't set headers on websockets. Anonymous keys are read-only and rejected.
+    Permissions and restrictions are resolved again for every map update, and when a permission expires or after
+    two minutes at the latest.
+    Each message contains either one scan like the locate API or a list of scans like the batch locate API,
+    an optional "id" is sent back with the result.
+    """
+    auth = APIKeyAuth()
+
+    async def connect(self):
+        try:
+            self.request = await database_sync_to_async(self._authenticate)()
+        except (APIKeyInvalid, APIPermissionDenied):
+            await self.close()
+            return
+        self.permissions = None
+        self.permissions_expire = None
+        self.router = None
+        self.restrictions = None
+        await self.accept()
+
+    def _authenticate(self):
+        key = dict(self.scope["headers"]).get(b"x-api-key", b"").decode() or None
+        if key is None:
+            key = parse_qs(self.scope["query_string"].decode()).get("key", (None, ))[0]
+        # these are all the request attributes APIKeyAuth and AccessPermission.get_for_request need
+        request = SimpleNamespace(method="POST", session=self.scope["session"])
+        self.auth.authenticate(request, key)
+        return request
+
+    def _update_permissions(self):
+        # same as AccessPermission.get_for_request, but we also need to know until when they are valid
+        permissions = AccessPermission.get_for_request_with_expire_date(self.request)
+        self.permissions = set(permissions.keys()) | AccessRestriction.get_all_public()
+        self.permissions_expire = min((expire_date for expire_date in permissions.values() if expire_date),
+                                      default=timezone.now()+timedelta(seconds=120))
+
+    async def receive_json(self, content, **kwargs):
+        if not isinstance(content, dict):
+            await self.send_json({"error": "invalid message"})
+            return
+
+        response = {"id": content["id"]} if "id" in content else {}
+        try:
+            if "scans" in content:
+                scans = BatchLocateRequestSchema.model_validate(content).dict()["scans"]
+                if len(scans) > LOCATE_BATCH_MAX:
+                    raise ValueError("At most %d scans can be located at once." % LOCATE_BATCH_MAX)
+            else:
+                scans = [LocateRequestSchema.model_validate(content).dict()]
+        except (ValidationError, ValueError) as e:
+            response["error"] = str(e)
+            await self.send_json(response)
+            return
+
+        locations = await database_sync_to_async(self._locate)([scan["wifi_peers"] for scan in scans])
+        if "scans" in content:
+            response["locations"] = locations
+        else:
+            response["location"] = locations[0]
+        await self.send_json(response)
+
+    def _locate(self, raw_scans):
+        router = Router.load()
+        if router is not self.router or timezone.now() >= self.permissions_expire:
+            self._update_permissions()
+            self.router = router
+            self.restrictions = router.get_restrictions(self.permissions)
+
+        locations = Locator.load().locate_many(raw_scans, self.permissions, restrictions=self.restrictions)
+        increment_locate_stats(locations)
+        return [location.serialize(simple_geometry=True) if location else None for location in locations]
+
+    @classmethod
+    async def encode_json(cls, content):
+        # locations contain lazy translation strings
+        return json.dumps(content, cls=DjangoJSONEncoder)
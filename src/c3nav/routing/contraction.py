@@ -0,0 +1,286 @@
+import hashlib
+import heapq
+import logging
+import pickle
+from collections import deque
+
+import numpy as np
+from django.conf import settings
+from django.utils.functional import cached_property
+
+from c3nav.mapdata.models import MapUpdate
+
+try:
+    from asgiref.local import Local as LocalContext
+except ImportError:
+    from threading import local as LocalContext
+
+logger = logging.getLogger('c3nav')
+
+
+class ContractionHierarchy:
+    """
+    Contraction hierarchy over the router graph for one set of edge weights.
+    Every node only keeps its edges to higher ranked nodes, shortcuts remember the node they bypass, so that a
+    bidirectional upward search can answer point-to-point queries while only settling very few nodes.
+    """
+    def __init__(self, num_nodes, up_indptr, up_to, up_weights, down_indptr, down_from, down_weights, middles):
+        self.num_nodes = num_nodes
+        # edges from each node to higher ranked nodes
+        self.up_indptr = up_indptr
+        self.up_to = up_to
+        self.up_weights = up_weights
+        # edges from higher ranked nodes to each node
+        self.down_indptr = down_indptr
+        self.down_from = down_from
+        self.down_weights = down_weights
+        # (from_node, to_node) -> contracted node for every shortcut
+        self.middles = middles
+
+    @classmethod
+    def build(cls, graph, weights, witness_limit=64):
+        """
+        contract all nodes of the graph in edge difference order.
+        :param graph: RouterGraph
+        :param weights: edge weights, excluded edges are np.inf
+        :param witness_limit: maximum number of settled nodes in each witness search
+        """
+        num_nodes = graph.num_nodes
+        out_edges = [{} for i in range(num_nodes)]
+        in_edges = [{} for i in range(num_nodes)]
+        for from_node, to_node, weight in zip(graph.from_nodes.tolist(), graph.to_nodes.tolist(), weights.tolist()):
+            if from_node == to_node or not np.isfinite(weight):
+                continue
+            out_edges[from_node][to_node] = weight
+            in_edges[to_node][from_node] = weight
+
+        middles = {}
+        up_edges = [()] * num_nodes
+        down_edges = [()] * num_nodes
+        contracted_neighbors = [0] * num_nodes
+
+        def find_shortcuts(node):
+            shortcuts = []
+            for from_node, in_weight in in_edges[node].items():
+                targets = {to_node: in_weight + out_weight
+                           for to_node, out_weight in out_edges[node].items() if to_node != from_node}
+                if not targets:
+                    continue
+                distances = cls._witness_search(out_edges, from_node, node, targets, witness_limit)
+                shortcuts.extend((from_node, to_node, weight) for to_node, weight in targets.items()
+                                 if distances.get(to_node, np.inf) > weight)
+            return shortcuts
+
+        def priority(node, shortcuts):
+            # edge difference plus number of already contracted neighbors
+            return len(shortcuts) - len(in_edges[node]) - len(out_edges[node]) + contracted_neighbors[node]
+
+        heap = [(priority(node, find_shortcuts(node)), node) for node in range(num_nodes)]
+        heapq.heapify(heap)
+        while heap:
+            old_priority, node = heapq.heappop(heap)
+            # lazy update: only contract this node if its priority is still the lowest
+            shortcuts = find_shortcuts(node)
+            new_priority = priority(node, shortcuts)
+            if heap and new_priority > heap[0][0]:
+                heapq.heappush(heap, (new_priority, node))
+                continue
+
+            up_edges[node] = tuple(out_edges[node].items())
+            down_edges[node] = tuple(in_edges[node].items())
+            for to_node in out_edges[node]:
+                del in_edges[to_node][node]
+                contracted_neighbors[to_node] += 1
+            for from_node in in_edges[node]:
+                del out_edges[from_node][node]
+                contracted_neighbors[from_node] += 1
+            out_edges[node] = {}
+            in_edges[node] = {}
+
+            for from_node, to_node, weight in shortcuts:
+                if weight < out_edges[from_node].get(to_node, np.inf):
+                    out_edges[from_node][to_node] = weight
+                    in_edges[to_node][from_node] = weight
+                    middles[(from_node, to_node)] = node
+
+        up_indptr, up_to, up_weights = cls._to_csr(up_edges)
+        down_indptr, down_from, down_weights = cls._to_csr(down_edges)
+        return cls(num_nodes, up_indptr, up_to, up_weights, down_indptr, down_from, down_weights, middles)
+
+    @staticmethod
+    def _witness_search(out_edges, source, excluded, targets, limit):
+        max_weight = max(targets.values())
+        distances = {source: 0}
+        heap = [(0, source)]
+        remaining = set(targets)
+        settled = 0
+        while heap and remaining and settled < limit:
+            distance, node = heapq.heappop(heap)
+            if distance > max_weight:
+                break
+            if distance > distances[node]:
+                continue
+            remaining.discard(node)
+            settled += 1
+            for next_node, weight in out_edges[node].items():
+                if next_node == excluded:
+                    continue
+                next_distance = distance + weight
+                if next_distance < distances.get(next_node, np.inf):
+                    distances[next_node] = next_distance
+                    heapq.heappush(heap, (next_distance, next_node))
+        return distances
+
+    @staticmethod
+    def _to_csr(edges):
+        indptr = np.zeros(len(edges)+1, dtype=np.int32)
+        np.cumsum(np.fromiter((len(node_edges) for node_edges in edges), dtype=np.int32, count=len(edges)),
+                  out=indptr[1:])
+        nodes = np.fromiter((node for node_edges in edges for node, weight in node_edges),
+                            dtype=np.int32, count=indptr[-1])
+        weights = np.fromiter((weight for node_edges in edges for node, weight in node_edges),
+                              dtype=np.float64, count=indptr[-1])
+        return indptr, nodes, weights
+
+    @cached_property
+    def _adjacency(self):
+        return (self.up_indptr.tolist(), self.up_to.tolist(), self.up_weights.tolist(),
+                self.down_indptr.tolist(), self.down_from.tolist(), self.down_weights.tolist())
+
+    def __getstate__(self):
+        result = self.__dict__.copy()
+        result.pop('_adjacency', None)
+        return result
+
+    def query(self, origins, destinations):
+        """
+        bidirectional upward search between the nearest pair of origin and destination nodes
+        :return: (origin node, destination node, path nodes) or None if no destination is reachable
+        """
+        up_indptr, up_to, up_weights, down_indptr, down_from, down_weights = self._adjacency
+        searches = (
+            ({node: 0 for node in origins}, {node: None for node in origins},
+             [(0, node) for node in origins], up_indptr, up_to, up_weights),
+            ({node: 0 for node in destinations}, {node: None for node in destinations},
+             [(0, node) for node in destinations], down_indptr, down_from, down_weights),
+        )
+        for distances, predecessors, heap, indptr, nodes, weights in searches:
+            heapq.heapify(heap)
+
+        best_distance = np.inf
+        meeting_node = None
+        while True:
+            # continue with the direction that has the closer next node
+            tops = tuple((search[2][0][0] if search[2] else np.inf) for search in searches)
+            if min(tops) >= best_distance:
+                break
+            direction = 0 if tops[0] <= tops[1] else 1
+            distances, predecessors, heap, indptr, nodes, weights = searches[direction]
+            other_distances = searches[1-direction][0]
+
+            distance, node = heapq.heappop(heap)
+            if distance > distances[node]:
+                continue
+            if node in other_distances and distance + other_distances[node] < best_distance:
+                best_distance = distance + other_distances[node]
+                meeting_node = node
+            for i in range(indptr[node], indptr[node+1]):
+                next_node = nodes[i]
+                next_distance = distance + weights[i]
+                if next_distance < distances.get(next_node, np.inf):
+                    distances[next_node] = next_distance
+                    predecessors[next_node] = node
+                    heapq.heappush(heap, (next_distance, next_node))
+
+        if meeting_node is None:
+            return None
+
+        # walk back to the origin and forward to the destination, then unpack all shortcuts
+        forward_predecessors, backward_predecessors = searches[0][1], searches[1][1]
+        path_nodes = deque((meeting_node, ))
+        while forward_predecessors[path_nodes[0]] is not None:
+            path_nodes.appendleft(forward_predecessors[path_nodes[0]])
+        while backward_predecessors[path_nodes[-1]] is not None:
+            path_nodes.append(backward_predecessors[path_nodes[-1]])
+
+        unpacked = deque((path_nodes[0], ))
+        for from_node, to_node in zip(tuple(path_nodes)[:-1], tuple(path_nodes)[1:]):
+            unpacked.extend(self._unpack_edge(from_node, to_node))
+        return unpacked[0], unpacked[-1], tuple(unpacked)
+
+    def _unpack_edge(self, from_node, to_node):
+        # returns all nodes of the edge without the first one
+        result = deque()
+        stack = [(from_node, to_node)]
+        while stack:
+            from_node, to_node = stack.pop()
+            middle = self.middles.get((from_node, to_node))
+            if middle is None:
+                result.append(to_node)
+            else:
+                stack.append((middle, to_node))
+                stack.append((from_node, middle))
+        return result
+
+
+class RouterHierarchies:
+    """
+    Contraction hierarchies for the most common routing profiles, built during map update processing.
+    """
+    profiles = tuple((mode, walk_speed)
+                     for mode in ('shortest', 'fastest')
+                     for walk_speed in ('slow', 'default', 'fast'))
+
+    def __init__(self, hierarchies):
+        # (restrictions cache key, options key) -> ContractionHierarchy
+        self.hierarchies = hierarchies
+
+    @classmethod
+    def rebuild(cls, update, router):
+        from c3nav.mapdata.models.access import AccessPermission
+        from c3nav.routing.models import RouteOptions
+        restrictions = router.get_restrictions(AccessPermission.get_for_request(None))
+
+        hierarchies = {}
+        built = {}
+        for mode, walk_speed in cls.profiles:
+            options = RouteOptions()
+            options.update({'mode': mode, 'walk_speed': walk_speed})
+            weights = router.get_edge_weights(restrictions, options)
+            # profiles with identical weights share one hierarchy
+            weights_key = hashlib.sha256(weights.tobytes()).hexdigest()
+            if weights_key not in built:
+                logger.info('Contracting router graph for %s/%s...' % (mode, walk_speed))
+                built[weights_key] = ContractionHierarchy.build(router.graph, weights)
+            hierarchies[(restrictions.cache_key, options.serialize_string())] = built[weights_key]
+
+        router_hierarchies = cls(hierarchies)
+        pickle.dump(router_hierarchies, open(cls.build_filename(update), 'wb'))
+        return router_hierarchies
+
+    @classmethod
+    def build_filename(cls, update):
+        return settings.CACHE_ROOT / ('router_ch_%s.pickle' % MapUpdate.build_cache_key(*update))
+
+    @classmethod
+    def load_nocache(cls, update):
+        try:
+            return pickle.load(open(cls.build_filename(update), 'rb'))
+        except FileNotFoundError:
+            return cls({})
+
+    cached = LocalContext()
+
+    class NoUpdate:
+        pass
+
+    @classmethod
+    def load(cls):
+        update = MapUpdate.last_processed_update()
+        if getattr(cls.cached, 'update', cls.NoUpdate) != update:
+            cls.cached.update = update
+            cls.cached.data = cls.load_nocache(update)
+        return cls.cached.data
+
+    def get(self, restrictions, options):
+        return self.hierarchies.get((restrictions.cache_key, options.serialize_string()))
@@ -0,0 +1,212 @@
+import heapq
+import math
+from collections import deque
+
+import numpy as np
+from django.utils.functional import cached_property
+
+
+class RouterGraph:
+    """
+    Sparse routing graph.
+    Edges are stored as flat arrays in CSR order (sorted by origin node, then by destination node), so memory scales
+    with the number of edges instead of the square of the number of nodes.
+    """
+    def __init__(self, num_nodes, indptr, from_nodes, to_nodes, distances, waytypes, rises, restrictions,
+                 slow_downs=None):
+        self.num_nodes = num_nodes
+        self.indptr = indptr
+        self.from_nodes = from_nodes
+        self.to_nodes = to_nodes
+        self.distances = distances
+        self.waytypes = waytypes
+        self.rises = rises
+        self.restrictions = restrictions
+        # factor for the distance of each edge that only applies to routing, distances stay the real lengths
+        self.slow_downs = np.ones(len(to_nodes), dtype=np.float32) if slow_downs is None else slow_downs
+
+    @classmethod
+    def from_edges(cls, num_nodes, edges):
+        """
+        build graph from RouterEdge objects, edges have to be unique per (from_node, to_node).
+        """
+        edges = tuple(edges)
+        return cls.from_arrays(
+            num_nodes,
+            from_nodes=np.fromiter((edge.from_node for edge in edges), dtype=np.int32, count=len(edges)),
+            to_nodes=np.fromiter((edge.to_node for edge in edges), dtype=np.int32, count=len(edges)),
+            distances=np.fromiter((edge.distance for edge in edges), dtype=np.float32, count=len(edges)),
+            waytypes=np.fromiter((edge.waytype for edge in edges), dtype=np.uint16, count=len(edges)),
+            rises=np.fromiter((np.nan if edge.rise is None else edge.rise for edge in edges),
+                              dtype=np.float32, count=len(edges)),
+            restrictions=np.fromiter((edge.access_restriction or 0 for edge in edges),
+                                     dtype=np.int32, count=len(edges)),
+        )
+
+    @classmethod
+    def from_arrays(cls, num_nodes, from_nodes, to_nodes, distances, waytypes, rises, restrictions):
+        """
+        build graph from edge arrays in any order. rises are np.nan if unknown, restrictions are 0 if there is none.
+        if there are multiple edges with the same (from_node, to_node), the last one is kept.
+        """
+        from_nodes = np.asarray(from_nodes, dtype=np.int32)
+        to_nodes = np.asarray(to_nodes, dtype=np.int32)
+
+        order = np.lexsort((np.arange(len(from_nodes)), to_nodes, from_nodes))
+        keys = from_nodes[order].astype(np.int64) * num_nodes + to_nodes[order]
+        order = order[np.append(keys[1:] != keys[:-1], True)] if len(order) else order
+
+        from_nodes = from_nodes[order]
+        indptr = np.zeros(num_nodes+1, dtype=np.int32)
+        np.cumsum(np.bincount(from_nodes, minlength=num_nodes), out=indptr[1:])
+        return cls(num_nodes, indptr, from_nodes, to_nodes[order],
+                   np.asarray(distances, dtype=np.float32)[order], np.asarray(waytypes, dtype=np.uint16)[order],
+                   np.asarray(rises, dtype=np.float32)[order], np.asarray(restrictions, dtype=np.int32)[order])
+
+    def __len__(self):
+        return len(self.to_nodes)
+
+    @property
+    def shape(self):
+        return self.num_nodes, self.num_nodes
+
+    @property
+    def upwards(self):
+        return self.rises > 0
+
+    def node_mask(self, nodes):
+        """
+        get a boolean array over all nodes that is True for the given node indices
+        """
+        mask = np.zeros(self.num_nodes, dtype=bool)
+        if nodes:
+            mask[np.fromiter(nodes, dtype=np.int32)] = True
+        return mask
+
+    def edges_touching(self, nodes):
+        """
+        get a boolean array over all edges that is True for edges starting or ending at one of the given nodes
+        """
+        mask = self.node_mask(nodes)
+        return mask[self.from_nodes] | mask[self.to_nodes]
+
+    def edges_within(self, nodes):
+        """
+        get a boolean array over all edges that is True for edges starting and ending at one of the given nodes
+        """
+        mask = self.node_mask(nodes)
+        return mask[self.from_nodes] & mask[self.to_nodes]
+
+    def edges_with_restriction(self, pk):
+        return np.flatnonzero(self.restrictions == pk).astype(np.uint32)
+
+    @cached_property
+    def _adjacency(self):
+        return self.indptr.tolist(), self.to_nodes.tolist()
+
+    @cached_property
+    def _edge_keys(self):
+        # edges are sorted by (from_node, to_node), so these keys are sorted as well
+        return self.from_nodes.astype(np.int64) * self.num_nodes + self.to_nodes
+
+    def __getstate__(self):
+        result = self.__dict__.copy()
+        result.pop('_adjacency', None)
+        result.pop('_edge_keys', None)
+        return result
+
+    def get_edges(self, from_nodes, to_nodes):
+        """
+        get the edge indices for arrays of from and to nodes, all of these edges have to exist
+        """
+        keys = np.asarray(from_nodes, dtype=np.int64) * self.num_nodes + np.asarray(to_nodes, dtype=np.int64)
+        edges = np.searchsorted(self._edge_keys, keys)
+        if keys.size and (edges.max() >= len(self) or (self._edge_keys[edges] != keys).any()):
+            raise KeyError('edge does not exist')
+        return edges
+
+    def heuristic_factor(self, weights, coordinates):
+        """
+        get the largest factor so that factor*euclidean distance never overestimates the weight of any edge,
+        which makes it an admissible and consistent A* heuristic for these weights.
+        """
+        lengths = np.linalg.norm(coordinates[self.to_nodes] - coordinates[self.from_nodes], axis=1)
+        relevant = np.isfinite(weights) & (lengths > 0)
+        if not relevant.any():
+            return 0
+        return max(float(np.min(weights[relevant] / lengths[relevant])), 0)
+
+    def search(self, weights, origins, destinations, coordinates=None):
+        """
+        multi-source dijkstra search that stops as soon as the nearest destination is settled.
+        if node coordinates are given, it becomes an A* search with a euclidean heuristic.
+        :param weights: edge weights, excluded edges are np.inf
+        :param origins: origin node indices
+        :param destinations: destination node indices
+        :param coordinates: optional (num_nodes, 3) array of node coordinates
+        :return: (origin node, destination node, path nodes) or None if no destination is reachable
+        """
+        factor = self.heuristic_factor(weights, coordinates) if coordinates is not None else 0
+
+        indptr, to_nodes = self._adjacency
+        # plain python floats are much faster to access one by one and add up in double precision
+        weights = np.asarray(weights, dtype=np.float64).tolist()
+        destinations = set(destinations)
+
+        if factor:
+            node_coordinates = np.asarray(coordinates, dtype=np.float64).tolist()
+            destination_coordinates = tuple(node_coordinates[node] for node in destinations)
+        estimates = {}
+
+        def heuristic(node):
+            if not factor:
+                return 0
+            estimate = estimates.get(node)
+            if estimate is None:
+                node_coordinate = node_coordinates[node]
+                estimate = factor * min(math.dist(node_coordinate, destination_coordinate)
+                                        for destination_coordinate in destination_coordinates)
+                estimates[node] = estimate
+            return estimate
+
+        distances = {}
+        predecessors = {}
+        heap = []
+        for node in origins:
+            distances[node] = 0
+            predecessors[node] = None
+            heap.append((heuristic(node), 0, node))
+        heapq.heapify(heap)
+
+        settled = set()
+        while heap:
+            priority, distance, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            settled.add(node)
+            if node in destinations:
+                path_nodes = deque((node, ))
+                while predecessors[path_nodes[0]] is not None:
+                    path_nodes.appendleft(predecessors[path_nodes[0]])
+                return path_nodes[0], node, tuple(path_nodes)
+            for i in range(indptr[node], indptr[node+1]):
+                next_node = to_nodes[i]
+                next_distance = distance + weights[i]
+                if next_distance < distances.get(next_node, math.inf):
+                    distances[next_node] = next_distance
+                    predecessors[next_node] = node
+                    heapq.heappush(heap, (next_distance + heuristic(next_node), next_distance, next_node))
+        return None
+
+    def as_csgraph(self, weights):
+        """
+        get a scipy sparse matrix for scipy.sparse.csgraph with the given edge weights.
+        edges with a non-finite weight are left out.
+        """
+        from scipy.sparse import csr_matrix
+        finite = np.isfinite(weights)
+        if finite.all():
+            return csr_matrix((weights, self.to_nodes, self.indptr), shape=self.shape)
+        indptr = np.zeros(self.num_nodes+1, dtype=np.int32)
+        np.cumsum(np.bincount(self.from_nodes[finite], minlength=self.num_nodes), out=indptr[1:])
+        return csr_matrix((weights[finite], self.to_nodes[finite], indptr), shape=self.shape)
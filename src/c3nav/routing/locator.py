@@ -69,6 +69,16 @@ class Locator:
     xyz: np.array = field(default_factory=(lambda: np.empty((0,))))
     spaces: dict[int, "LocatorSpace"] = field(default_factory=dict)
 
+    # all measurement points of all spaces: rssi per peer (0 if not measured) and the space index of each point
+    point_rssi: np.array = field(default_factory=(lambda: np.zeros((0, 0), dtype=np.int8)))
+    point_spaces: np.array = field(default_factory=(lambda: np.zeros((0, ), dtype=np.int32)))
+    point_xy: np.array = field(default_factory=(lambda: np.zeros((0, 2), dtype=np.float64)))
+    # pks of the spaces by space index, and which peers are known in each space
+    space_pks: np.array = field(default_factory=(lambda: np.zeros((0, ), dtype=np.int32)))
+    space_peers: np.array = field(default_factory=(lambda: np.zeros((0, 0), dtype=bool)))
+    # (peer dimensions, point indices, k-d tree over their signal levels, missing distances) by space index, knn only
+    space_trees: list[tuple] = field(default_factory=list)
+
     @classmethod
     def rebuild(cls, update, router):
         locator = cls()
@@ -108,6 +118,50 @@ class Locator:
             if new_space.points:
                 self.spaces[space.pk] = new_space
 
+        self._build_point_matrix()
+
+    def _build_point_matrix(self):
+        spaces = tuple(self.spaces.values())
+        points = tuple((i, point) for i, space in enumerate(spaces) for point in space.points)
+
+        self.point_rssi = np.zeros((len(points), len(self.peers)), dtype=np.int8)
+        for i, (space_i, point) in enumerate(points):
+            for peer_id, value in point.values.items():
+                if value.rssi:
+                    # rssi values are negative, 0 means not measured
+                    self.point_rssi[i, peer_id] = min(max(int(value.rssi), -128), -1)
+        self.point_spaces = np.array(tuple(space_i for space_i, point in points), dtype=np.int32)
+        self.point_xy = np.array(tuple((point.x, point.y) for space_i, point in points),
+                                 dtype=np.float64).reshape((-1, 2))
+
+        self.space_pks = np.array(tuple(space.pk for space in spaces), dtype=np.int32)
+        self.space_peers = np.zeros((len(spaces), len(self.peers)), dtype=bool)
+        for i, space in enumerate(spaces):
+            self.space_peers[i, tuple(space.peer_ids)] = True
+
+        if settings.LOCATE_MODE == 'knn':
+            self._build_space_trees()
+
+    def _build_space_trees(self):
+        """
+        build a k-d tree for the measurement points of each space, so every point is in exactly one tree.
+        it uses the signal levels that get_best_points scores, for the peers that are measured most often in the space.
+        spaces with only a few points don't get a tree, scoring all of them is faster.
+        """
+        from scipy.spatial import cKDTree
+        measured = self.point_rssi != 0
+        self.space_trees = []
+        for space_i in range(len(self.space_pks)):
+            points = np.flatnonzero(self.point_spaces == space_i)
+            if len(points) < knn_tree_min_points:
+                self.space_trees.append((None, points, None, None))
+                continue
+            dimensions = np.argsort(-measured[points].sum(axis=0), kind='stable')[:knn_tree_dimensions]
+            levels = get_signal_levels(self.point_rssi[np.ix_(points, dimensions)])
+            # largest distance contribution of each dimension if it is missing in a scan and queried as no signal
+            missing_distances = ((levels - no_signal)**2).max(axis=0).astype(np.float64)
+            self.space_trees.append((dimensions, points, cKDTree(levels.astype(np.float64)), missing_distances))
+
     def get_peer_id(self, identifier: LocatorPeerIdentifier, create=False) -> Optional[int]:
         peer_id = self.peer_lookup.get(identifier, None)
         if peer_id is None and create:
@@ -192,41 +246,149 @@ class Locator:
         }
 
     def locate(self, raw_scan_data: list[LocateRequestWifiPeerSchema], permissions=None):
-        # todo: support for ibeacons
-        scan_data = self.convert_raw_scan_data(raw_scan_data)
-        if not scan_data:
-            return None
+        return self.locate_many((raw_scan_data, ), permissions)[0]
+
+    def locate_many(self, raw_scans: Sequence[list[LocateRequestWifiPeerSchema]], permissions=None,
+                    restrictions=None):
+        """
+        locate many scans at once, the router and the restrictions are only resolved once.
+        :param restrictions: restrictions for these permissions, if they have already been resolved
+        """
+        router = Router.load()
+        if restrictions is None:
+            restrictions = router.get_restrictions(permissions)
+
+        results = []
+        for raw_scan_data in raw_scans:
+            # todo: support for ibeacons
+            scan_data = self.convert_raw_scan_data(raw_scan_data)
+            if not scan_data:
+                results.append(None)
+                continue
+
+            result = self.locate_range(scan_data, permissions)
+            if result is None:
+                if settings.LOCATE_MODE == 'knn':
+                    result = self.locate_knn(scan_data, permissions, router=router, restrictions=restrictions)
+                else:
+                    result = self.locate_rssi(scan_data, permissions, router=router, restrictions=restrictions)
+            results.append(result)
+        return results
+
+    def get_best_points(self, scan_data: ScanData, restrictions, num=1,
+                        candidates=None) -> tuple[np.array, np.array]:
+        """
+        score all measurement points (or the given candidate point indices) against the scan data in one pass.
+        only points in accessible spaces that know the peer with the strongest signal are considered.
+        :return: (point indices, scores) of the best points, best first
+        """
+        best_peer_id = max(scan_data.items(), key=lambda v: v[1].rssi)[0]
+        peer_ids = np.fromiter(scan_data.keys(), dtype=np.int32, count=len(scan_data))
+        values = np.fromiter((value.rssi for value in scan_data.values()), dtype=np.int64, count=len(scan_data))
+
+        accessible_spaces = self.space_peers[:, best_peer_id].copy()
+        if restrictions.spaces:
+            accessible_spaces &= ~np.isin(self.space_pks, tuple(restrictions.spaces))
+        if candidates is None:
+            candidates = np.flatnonzero(accessible_spaces[self.point_spaces])
+        else:
+            candidates = candidates[accessible_spaces[self.point_spaces[candidates]]]
+
+        levels = get_signal_levels(self.point_rssi[np.ix_(candidates, peer_ids)])
+        scores = np.sum((levels - values)**2, axis=1) / len(scan_data)
+        if not candidates.size:
+            return candidates, scores
+
+        if num < candidates.size:
+            # keep everything up to the num-th best score, so ties are resolved by point order below
+            threshold = np.partition(scores, num-1)[num-1]
+            keep = scores <= threshold
+            candidates, scores = candidates[keep], scores[keep]
+        order = np.lexsort((candidates, scores))[:num]
+        return candidates[order], scores[order]
+
+    def get_nearest_points(self, scan_data: ScanData, restrictions, num) -> tuple[np.array, np.array]:
+        """
+        like get_best_points, but only scores the nearest points in the k-d trees of the accessible spaces that know
+        the peer with the strongest signal. the tree distance without the dimensions that are missing in the scan is
+        a lower bound of the score. spaces where the points that were not queried could still be better than the
+        found ones are scored completely, so the result is the same as with get_best_points.
+        """
+        if not self.space_trees:
+            return self.get_best_points(scan_data, restrictions, num)
 
-        result = self.locate_range(scan_data, permissions)
-        if result is not None:
+        best_peer_id = max(scan_data.items(), key=lambda v: v[1].rssi)[0]
+        accessible_spaces = self.space_peers[:, best_peer_id].copy()
+        if restrictions.spaces:
+            accessible_spaces &= ~np.isin(self.space_pks, tuple(restrictions.spaces))
+
+        # query vector for all peers, the ones that are missing in the scan are queried as no signal
+        peer_ids = np.fromiter(scan_data.keys(), dtype=np.int32, count=len(scan_data))
+        vector = np.full(len(self.peers), no_signal, dtype=np.float64)
+        vector[peer_ids] = tuple(value.rssi for value in scan_data.values())
+        missing = np.ones(len(self.peers), dtype=bool)
+        missing[peer_ids] = False
+
+        k = num * knn_prefilter_factor
+        candidates = {}
+        # lowest score that any point of a space that was not queried can have
+        bounds = {}
+        for space_i in np.flatnonzero(accessible_spaces).tolist():
+            dimensions, points, kdtree, missing_distances = self.space_trees[space_i]
+            if kdtree is None or k >= len(points):
+                candidates[space_i] = points
+                continue
+            distances, found = kdtree.query(vector[dimensions], k=k)
+            candidates[space_i] = points[np.atleast_1d(found)]
+            bounds[space_i] = ((np.atleast_1d(distances)[-1]**2 - missing_distances[missing[dimensions]].sum())
+                               / len(scan_data))
+
+        result = self.get_best_points(scan_data, restrictions, num,
+                                      candidates=np.concatenate((np.zeros((0, ), dtype=np.int64),
+                                                                 *candidates.values())))
+        worst_score = result[1][-1] if result[0].size == num else np.inf
+        uncertain = [space_i for space_i, bound in bounds.items() if bound <= worst_score]
+        if not uncertain:
             return result
+        candidates.update((space_i, self.space_trees[space_i][1]) for space_i in uncertain)
+        return self.get_best_points(scan_data, restrictions, num, candidates=np.concatenate(tuple(candidates.values())))
 
-        return self.locate_rssi(scan_data, permissions)
+    def locate_rssi(self, scan_data: ScanData, permissions=None, router=None, restrictions=None):
+        if router is None:
+            router = Router.load()
+        if restrictions is None:
+            restrictions = router.get_restrictions(permissions)
 
-    def locate_rssi(self, scan_data: ScanData, permissions=None):
-        router = Router.load()
-        restrictions = router.get_restrictions(permissions)
+        points, scores = self.get_best_points(scan_data, restrictions)
+        if not points.size:
+            return None
 
-        # get visible spaces
-        spaces = tuple(space for pk, space in self.spaces.items() if pk not in restrictions.spaces)
+        point = points[0]
+        location = CustomLocation(router.spaces[int(self.space_pks[self.point_spaces[point]])].level,
+                                  float(self.point_xy[point, 0]), float(self.point_xy[point, 1]),
+                                  permissions=permissions, icon='my_location')
+        location.score = scores[0]
+        return location
 
-        # find best point
-        best_peer_id = max(scan_data.items(), key=lambda v: v[1].rssi)[0]
-        best_location = None
-        best_score = float('inf')
-        for space in spaces:
-            point, score = space.get_best_point(scan_data, needed_peer_id=best_peer_id)
-            if point is None:
-                continue
-            if score < best_score:
-                location = CustomLocation(router.spaces[space.pk].level, point.x, point.y,
-                                          permissions=permissions, icon='my_location')
-                best_location = location
-                best_score = score
+    def locate_knn(self, scan_data: ScanData, permissions=None, router=None, restrictions=None):
+        if router is None:
+            router = Router.load()
+        if restrictions is None:
+            restrictions = router.get_restrictions(permissions)
 
-        best_location.score = best_score
+        points, scores = self.get_nearest_points(scan_data, restrictions, settings.LOCATE_KNN_K)
+        if not points.size:
+            return None
+
+        # weighted centroid of the best points on the level of the best point
+        spaces = tuple(router.spaces[pk] for pk in self.space_pks[self.point_spaces[points]].tolist())
+        same_level = np.array(tuple(space.level_id == spaces[0].level_id for space in spaces))
+        weights = 1 / (np.sqrt(scores[same_level]) + 1)
+        x, y = np.average(self.point_xy[points[same_level]], weights=weights, axis=0).tolist()
 
-        return best_location
+        location = CustomLocation(spaces[0].level, x, y, permissions=permissions, icon='my_location')
+        location.score = scores[0]
+        return location
 
     @cached_property
     def least_squares_func(self):
@@ -364,7 +526,21 @@ class Locator:
         return location
 
 
-no_signal = int(-90)**2
+no_signal_rssi = -90
+no_signal = int(no_signal_rssi)**2
+
+
+def get_signal_levels(rssi):
+    # measured levels are squared rssi values, peers that were not measured count as no signal
+    rssi = rssi.astype(np.int64)
+    return np.where(rssi != 0, rssi**2, no_signal)
+
+
+# peers used as k-d tree dimensions, spaces with fewer points than this don't get a tree,
+# and how many nearest points per needed result are queried
+knn_tree_dimensions = 8
+knn_tree_min_points = 1000
+knn_prefilter_factor = 8
 
 
 @dataclass
@@ -372,54 +548,11 @@ class LocatorSpace:
     pk: int
     points: list[LocatorPoint]
     peer_ids: frozenset[int]
-    peer_lookup: dict[int, int]
-    levels: np.array
 
     @classmethod
     def create(cls, pk: int, points: Sequence[LocatorPoint]):
-        peer_set = reduce(operator.or_, (frozenset(point.values.keys()) for point in points), frozenset())
-        peers = tuple(peer_set)
-        peer_lookup = {peer_id: i for i, peer_id in enumerate(peers)}
-        levels = np.full((len(points), len(peers)), fill_value=no_signal, dtype=np.int64)
-        for i, point in enumerate(points):
-            for peer_id, value in point.values.items():
-                levels[i][peer_lookup[peer_id]] = int(value.rssi)**2
-
         return cls(
             pk=pk,
             points=list(points),
-            peer_ids=peer_set,
-            peer_lookup=peer_lookup,
-            levels=levels,
-        )
-
-    def get_best_point(self, scan_values: ScanData,
-                       needed_peer_id=None) -> tuple[LocatorPoint, float] | tuple[None, None]:
-        # check if this space knows the needed peer id, otherwise no results here
-        if needed_peer_id not in self.peer_ids:
-            return None, None
-
-        # peers that this space knows
-        peer_ids = frozenset(scan_values.keys()) & self.peer_ids
-        penalty = 0
-        for peer_id, value in scan_values.items():
-            if peer_id not in self.peer_ids:
-                penalty += (value.rssi - no_signal)**2
-
-        peers = tuple(self.peer_lookup[peer_id] for peer_id in peer_ids)
-        values = np.array(tuple(scan_values[peer_id].rssi for peer_id in peer_ids), dtype=np.int64)
-
-        # acceptable points need to have a value for the needed_peer_id
-        points = tuple(
-            np.argwhere(self.levels[:, self.peer_lookup[needed_peer_id]] > 0).ravel()
+            peer_ids=reduce(operator.or_, (frozenset(point.values.keys()) for point in points), frozenset()),
         )
-        if not points:
-            return None, None
-
-        scores = (np.sum(
-            (self.levels[np.array(points, dtype=np.uint32).reshape((-1, 1)), peers] - values)**2,
-            axis=1
-        )+penalty) / len(scan_values)
-        best_point_i = np.argmin(scores).ravel()[0]
-        best_point = points[best_point_i]
-        return self.points[best_point], scores[best_point_i]
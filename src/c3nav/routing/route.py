@@ -1,6 +1,6 @@
 # flake8: noqa
 import copy
-from collections import OrderedDict, deque
+from collections import OrderedDict, deque, namedtuple
 
 import numpy as np
 from django.utils.functional import cached_property
@@ -18,63 +18,104 @@ def describe_location(location, locations):
     return result
 
 
+# compact representation of a route: one entry per node, origin and destination additions included.
+# the edge values (distance, waytype, rise) describe the edge leading to that node, distance is nan if there is none.
+# additional nodes that are not part of the graph have the node index -1 and are found in extra_nodes by position.
+RoutePath = namedtuple('RoutePath', ('nodes', 'distances', 'waytypes', 'rises', 'extra_nodes'))
+
+
 class Route:
     def __init__(self, router, origin, destination, path_nodes, options,
                  origin_addition, destination_addition, origin_xyz, destination_xyz):
         self.router = router
         self.origin = origin
         self.destination = destination
-        self.path_nodes = path_nodes
+        self.path_nodes = np.asarray(path_nodes, dtype=np.int32)
         self.options = options
         self.origin_addition = origin_addition
         self.destination_addition = destination_addition
         self.origin_xyz = origin_xyz
         self.destination_xyz = destination_xyz
 
-    def serialize(self, locations):
-        nodes = [[node, None] for node in self.path_nodes]
+    @cached_property
+    def path(self):
+        # gather all edge values of the path in one step
+        graph = self.router.graph
+        path_nodes = self.path_nodes
+        edges = graph.get_edges(path_nodes[:-1], path_nodes[1:])
+        nodes = [path_nodes]
+        distances = [(np.nan, ), graph.distances[edges]]
+        waytypes = [(0, ), graph.waytypes[edges]]
+        rises = [(np.nan, ), graph.rises[edges]]
+        extra_nodes = {}
+
         if self.origin_addition and any(self.origin_addition):
-            nodes.insert(0, (self.origin_addition[0], None))
-            nodes[1][1] = self.origin_addition[1]
-        if self.destination_addition and any(self.destination_addition):
-            nodes.append(self.destination_addition)
+            node, edge = self.origin_addition
+            extra_nodes[0] = node
+            nodes.insert(0, (-1, ))
+            distances[0] = (np.nan, edge.distance)
+            waytypes[0] = (0, edge.waytype)
+            rises[0] = (np.nan, np.nan if edge.rise is None else edge.rise)
 
+        if self.destination_addition and any(self.destination_addition):
+            node, edge = self.destination_addition
+            extra_nodes[len(path_nodes) + len(extra_nodes)] = node
+            nodes.append((-1, ))
+            distances.append((edge.distance, ))
+            waytypes.append((edge.waytype, ))
+            rises.append((np.nan if edge.rise is None else edge.rise, ))
+
+        return RoutePath(
+            nodes=np.concatenate(nodes).astype(np.int32),
+            distances=np.concatenate(distances).astype(np.float64),
+            waytypes=np.concatenate(waytypes).astype(np.uint16),
+            rises=np.concatenate(rises).astype(np.float64),
+            extra_nodes=extra_nodes,
+        )
+
+    def _get_node(self, i):
+        # get the node object of the path entry with this position
+        node = self.path.nodes[i]
+        return self.path.extra_nodes[i] if node < 0 else self.router.nodes[node]
+
+    def _get_end_distances(self):
+        # additional distances from the origin and to the destination point, if they are custom locations
+        origin_distance = 0
         if self.origin_xyz is not None:
-            node = nodes[0][0]
-            if not hasattr(node, 'xyz'):
-                node = self.router.nodes[node]
-            origin_distance = np.linalg.norm(node.xyz - self.origin_xyz)
-        else:
-            origin_distance = 0
+            origin_distance = np.linalg.norm(self._get_node(0).xyz - self.origin_xyz)
 
+        destination_distance = 0
         if self.destination_xyz is not None:
-            node = nodes[-1][0]
-            if not hasattr(node, 'xyz'):
-                node = self.router.nodes[node]
-            destination_distance = np.linalg.norm(node.xyz - self.destination_xyz)
-        else:
-            destination_distance = 0
+            destination_distance = np.linalg.norm(self._get_node(len(self.path.nodes)-1).xyz - self.destination_xyz)
+
+        return origin_distance, destination_distance
+
+    def _get_durations(self):
+        # duration for each entry of the path, zero where there is no edge
+        path = self.path
+        return self.router.get_edge_durations(path.distances, path.waytypes, path.rises, self.options)
+
+    def get_distance_and_duration(self):
+        # same distance and duration as in serialize(), without building any route items
+        origin_distance, destination_distance = self._get_end_distances()
+        end_distance = origin_distance + destination_distance
+        return (float(end_distance + np.nansum(self.path.distances)),
+                float(end_distance * self.options.walk_factor + self._get_durations().sum()))
+
+    def serialize(self, locations):
+        path = self.path
+        origin_distance, destination_distance = self._get_end_distances()
+        distance, duration = self.get_distance_and_duration()
 
         items = deque()
-        last_node = None
         last_item = None
-        walk_factor = self.options.walk_factor
-        distance = origin_distance
-        duration = origin_distance * walk_factor
-        for i, (node, edge) in enumerate(nodes):
-            if edge is None:
-                edge = self.router.edges[last_node, node] if last_node else None
-            node_obj = self.router.nodes[node] if isinstance(node, (int, np.int32, np.int64)) else node
-            item = RouteItem(self, node_obj, edge, last_item)
-            if edge:
-                distance += edge.distance
-                duration += item.router_waytype.get_duration(edge, walk_factor)
+        has_edge = (~np.isnan(path.distances)).tolist()
+        for i, (node, waytype, rise) in enumerate(zip(path.nodes.tolist(), path.waytypes.tolist(),
+                                                      path.rises.tolist())):
+            node_obj = path.extra_nodes[i] if node < 0 else self.router.nodes[node]
+            item = RouteItem(self, node_obj, has_edge[i], waytype, rise, last_item)
             items.append(item)
             last_item = item
-            last_node = node
-
-        distance += destination_distance
-        duration += destination_distance * walk_factor
 
         # descriptions for waytypes
         next_item = None
@@ -90,10 +131,10 @@ class Route:
                 if item.waytype.icon_name:
                     icon = item.waytype.icon_name
                     if item.waytype.up_separate:
-                        icon += '-up' if item.edge.rise > 0 else '-down'
+                        icon += '-up' if item.rise > 0 else '-down'
                 icon += '.svg'
                 description = item.waytype.description
-                if item.waytype.up_separate and item.edge.rise > 0:
+                if item.waytype.up_separate and item.rise > 0:
                     description = item.waytype.description_up
                 # noinspection PyComparisonWithNone
                 if (item.waytype.level_change_description != False and last_primary_level and
@@ -139,8 +180,8 @@ class Route:
         for item in reversed(items):
             if item.descriptions:
                 break
-            if item.edge:
-                remaining_distance += item.edge.distance
+            if item.has_edge:
+                remaining_distance += path.distances[item.i]
         if remaining_distance:
             item.descriptions.append(
                 ('more_vert', _('%d m remaining to your destination.') % max(remaining_distance, 1))
@@ -198,22 +239,20 @@ class Route:
 
 
 class RouteItem:
-    def __init__(self, route, node, edge, last_item):
+    def __init__(self, route, node, has_edge, waytype_id, rise, last_item):
         self.route = route
         self.node = node
-        self.edge = edge
+        self.i = last_item.i + 1 if last_item else 0
+        self.has_edge = has_edge
+        self.waytype_id = waytype_id
+        self.rise = rise
         self.last_item = last_item
         self.descriptions = []
 
     @cached_property
     def waytype(self):
-        if self.edge and self.edge.waytype:
-            return self.route.router.waytypes[self.edge.waytype]
-
-    @cached_property
-    def router_waytype(self):
-        if self.edge:
-            return self.route.router.waytypes[self.edge.waytype]
+        if self.has_edge and self.waytype_id:
+            return self.route.router.waytypes[self.waytype_id]
 
     @cached_property
     def space(self):
@@ -235,11 +274,8 @@ class RouteItem:
         result = OrderedDict((
             ('id', self.node.pk),
             ('coordinates', (self.node.x, self.node.y, self.node.altitude)),
-            ('waytype', (self.route.router.waytypes[self.edge.waytype].serialize(detailed=False)
-                         if self.edge and self.edge.waytype else None)),
+            ('waytype', self.waytype.serialize(detailed=False) if self.waytype else None),
         ))
-        if self.waytype:
-            result['waytype'] = self.waytype.serialize(detailed=False)
 
         if self.new_space:
             result['space'] = describe_location(self.space, locations)
@@ -2,25 +2,31 @@ import logging
 import operator
 import pickle
 from collections import deque, namedtuple
-from functools import reduce
+from copy import copy
+from functools import partial, reduce
 from itertools import chain
 from typing import Optional
 
 import numpy as np
+import shapely
 from django.conf import settings
-from django.core.cache import cache
 from django.utils.functional import cached_property
 from shapely import prepared
 from shapely.geometry import LineString, Point
 from shapely.ops import unary_union
+from shapely.strtree import STRtree
 
 from c3nav.mapdata.models import AltitudeArea, Area, GraphEdge, Level, LocationGroup, MapUpdate, Space, WayType
 from c3nav.mapdata.models.geometry.space import POI, CrossDescription, LeaveDescription
 from c3nav.mapdata.models.locations import CustomLocationProxyMixin
 from c3nav.mapdata.utils.geometry import assert_multipolygon, get_rings, good_representative_point, unwrap_geom
 from c3nav.mapdata.utils.locations import CustomLocation
+from c3nav.routing.contraction import RouterHierarchies
 from c3nav.routing.exceptions import LocationUnreachable, NoRouteFound, NotYetRoutable
+from c3nav.routing.graph import RouterGraph
 from c3nav.routing.route import Route
+from c3nav.routing.store import shortest_path_store
+from c3nav.routing.warmup import track_route_profile
 
 try:
     from asgiref.local import Local as LocalContext
@@ -33,7 +39,7 @@ logger = logging.getLogger('c3nav')
 class Router:
     filename = settings.CACHE_ROOT / 'router'
 
-    def __init__(self, levels, spaces, areas, pois, groups, restrictions, nodes, edges, waytypes, graph):
+    def __init__(self, levels, spaces, areas, pois, groups, restrictions, nodes, waytypes, graph):
         self.levels = levels
         self.spaces = spaces
         self.areas = areas
@@ -41,16 +47,60 @@ class Router:
         self.groups = groups
         self.restrictions = restrictions
         self.nodes = nodes
-        self.edges = edges
         self.waytypes = waytypes
         self.graph = graph
 
+    @property
+    def edges(self):
+        return RouterEdges(self.graph)
+
+    def __getstate__(self):
+        result = self.__dict__.copy()
+        for name in ('spaces_indexes', 'areas_indexes', 'pois_indexes'):
+            result.pop(name, None)
+        return result
+
+    @cached_property
+    def spaces_indexes(self):
+        # level -> spatial index over its spaces
+        return {pk: RouterGeometryIndex(tuple(self.spaces[space] for space in sorted(level.spaces)))
+                for pk, level in self.levels.items()}
+
+    @cached_property
+    def areas_indexes(self):
+        # space -> spatial index over its describable areas
+        return {pk: RouterGeometryIndex(tuple(area for area in (self.areas[area] for area in sorted(space.areas))
+                                              if area.can_describe))
+                for pk, space in self.spaces.items()}
+
+    @cached_property
+    def pois_indexes(self):
+        # space -> spatial index over its describable pois
+        return {pk: RouterGeometryIndex(tuple(poi for poi in (self.pois[poi] for poi in sorted(space.pois))
+                                              if poi.can_describe))
+                for pk, space in self.spaces.items()}
+
     @staticmethod
     def get_altitude_in_areas(areas, point):
         return max(area.get_altitudes(point)[0] for area in areas if area.geometry_prep.intersects(point))
 
     @classmethod
-    def rebuild(cls, update):
+    def rebuild(cls, update, previous_update=None, changed_areas=None):
+        """
+        rebuild the router and save it for the given update.
+        if the router of a previous update and the changed geometries per level since then are given,
+        geometry calculations are only repeated for spaces touched by these changes.
+        """
+        previous = None
+        if previous_update is not None and changed_areas is not None:
+            try:
+                previous = cls.load_nocache(previous_update)
+            except FileNotFoundError:
+                logger.info('Previous router not found, rebuilding everything.')
+            except (AttributeError, TypeError, pickle.UnpicklingError):
+                # routers pickled by an older version of this code can't be reused
+                logger.info('Previous router could not be loaded, rebuilding everything.')
+
         levels_query = Level.objects.prefetch_related('buildings', 'spaces', 'altitudeareas', 'groups',
                                                       'spaces__holes', 'spaces__columns', 'spaces__groups',
                                                       'spaces__obstacles', 'spaces__lineobstacles',
@@ -64,6 +114,7 @@ class Router:
         groups = {}
         restrictions = {}
         nodes = deque()
+        reused_spaces = 0
         for level in levels_query:
             buildings_geom = unary_union(tuple(unwrap_geom(building.geometry) for building in level.buildings.all()))
 
@@ -78,20 +129,48 @@ class Router:
                 )
 
             for space in level.spaces.all():
-                # create space geometries
-                accessible_geom = space.geometry.difference(unary_union(
-                    tuple(unwrap_geom(column.geometry)
-                          for column in space.columns.all()
-                          if column.access_restriction_id is None) +
-                    tuple(unwrap_geom(hole.geometry) for hole in space.holes.all()) +
-                    ((buildings_geom, ) if space.outside else ())
-                ))
-                obstacles_geom = unary_union(
-                    tuple(unwrap_geom(obstacle.geometry) for obstacle in space.obstacles.all()) +
-                    tuple(unwrap_geom(lineobstacle.buffered_geometry) for lineobstacle in space.lineobstacles.all())
+                space_nodes = tuple(RouterNode.from_graph_node(node, i)
+                                    for i, node in enumerate(space.graphnodes.all()))
+                for i, node in enumerate(space_nodes, start=len(nodes)):
+                    node.i = i
+                nodes.extend(space_nodes)
+
+                # reuse the geometry calculations of the previous router if nothing changed in this space
+                rebuild_key = (
+                    space.outside,
+                    float(level.base_altitude),
+                    tuple(sorted(column.pk for column in space.columns.all() if column.access_restriction_id is None)),
+                    tuple(sorted(node.pk for node in space_nodes)),
                 )
-                clear_geom = unary_union(tuple(get_rings(accessible_geom.difference(obstacles_geom))))
-                clear_geom_prep = prepared.prep(clear_geom)
+                previous_space = None
+                if previous is not None:
+                    previous_space = cls._get_unchanged_space(previous, space, rebuild_key, changed_areas)
+                node_mapping = {}
+                if previous_space is not None:
+                    nodes_lookup = {node.pk: node for node in space_nodes}
+                    for i in previous_space.nodes:
+                        previous_node = previous.nodes[i]
+                        node = nodes_lookup[previous_node.pk]
+                        node_mapping[i] = node.i
+                        node.altitude = previous_node.altitude
+                    accessible_geom = previous_space.src.geometry
+                    reused_spaces += 1
+                else:
+                    # create space geometries
+                    accessible_geom = space.geometry.difference(unary_union(
+                        tuple(unwrap_geom(column.geometry)
+                              for column in space.columns.all()
+                              if column.access_restriction_id is None) +
+                        tuple(unwrap_geom(hole.geometry) for hole in space.holes.all()) +
+                        ((buildings_geom, ) if space.outside else ())
+                    ))
+                    obstacles_geom = unary_union(
+                        tuple(unwrap_geom(obstacle.geometry) for obstacle in space.obstacles.all()) +
+                        tuple(unwrap_geom(lineobstacle.buffered_geometry)
+                              for lineobstacle in space.lineobstacles.all())
+                    )
+                    clear_geom = unary_union(tuple(get_rings(accessible_geom.difference(obstacles_geom))))
+                    clear_geom_prep = prepared.prep(clear_geom)
 
                 for group in space.groups.all():
                     groups.setdefault(group.pk, {}).setdefault('spaces', set()).add(space.pk)
@@ -99,15 +178,10 @@ class Router:
                 if space.access_restriction_id:
                     restrictions.setdefault(space.access_restriction_id, RouterRestriction()).spaces.add(space.pk)
 
-                space_nodes = tuple(RouterNode.from_graph_node(node, i)
-                                    for i, node in enumerate(space.graphnodes.all()))
-                for i, node in enumerate(space_nodes, start=len(nodes)):
-                    node.i = i
-                nodes.extend(space_nodes)
-
                 space_obj = space
                 space = RouterSpace(space)
                 space.nodes = set(node.i for node in space_nodes)
+                space.rebuild_key = rebuild_key
 
                 for area in space_obj.areas.all():
                     for group in area.groups.all():
@@ -115,8 +189,13 @@ class Router:
                     area._prefetched_objects_cache = {}
 
                     area = RouterArea(area)
-                    area_nodes = tuple(node for node in space_nodes if area.geometry_prep.intersects(node.point))
-                    area.nodes = set(node.i for node in area_nodes)
+                    previous_area = previous.areas.get(area.pk) if previous_space is not None else None
+                    if previous_area is not None and previous_area.pk in previous_space.areas:
+                        area.nodes = set(node_mapping[i] for i in previous_area.nodes)
+                        area_nodes = tuple(node for node in space_nodes if node.i in area.nodes)
+                    else:
+                        area_nodes = tuple(node for node in space_nodes if area.geometry_prep.intersects(node.point))
+                        area.nodes = set(node.i for node in area_nodes)
                     for node in area_nodes:
                         node.areas.add(area.pk)
                     if not area.nodes and space_nodes:
@@ -125,58 +204,11 @@ class Router:
                     areas[area.pk] = area
                     space.areas.add(area.pk)
 
-                for area in level.altitudeareas.all():
-                    if not space.geometry_prep.intersects(unwrap_geom(area.geometry)):
-                        continue
-                    for subgeom in assert_multipolygon(accessible_geom.intersection(unwrap_geom(area.geometry))):
-                        if subgeom.is_empty:
-                            continue
-                        area_clear_geom = unary_union(tuple(get_rings(subgeom.difference(obstacles_geom))))
-                        if area_clear_geom.is_empty:
-                            continue
-                        area = RouterAltitudeArea(subgeom, area_clear_geom,
-                                                  area.altitude, area.altitude2, area.point1, area.point2)
-                        area_nodes = tuple(node for node in space_nodes if area.geometry_prep.intersects(node.point))
-                        area.nodes = set(node.i for node in area_nodes)
-                        for node in area_nodes:
-                            altitude = area.get_altitude(node)
-                            if node.altitude is None or node.altitude < altitude:
-                                node.altitude = altitude
-
-                        space.altitudeareas.append(area)
-
-                for node in space_nodes:
-                    if node.altitude is not None:
-                        continue
-                    logger.warning('Node %d in space %d is not inside an altitude area' % (node.pk, space.pk))
-                    node_altitudearea = min(space.altitudeareas,
-                                            key=lambda a: a.geometry.distance(node.point), default=None)
-                    if node_altitudearea:
-                        node.altitude = node_altitudearea.get_altitude(node)
-                    else:
-                        node.altitude = float(level.base_altitude)
-                        logger.info('Space %d has no altitude areas' % space.pk)
-
-                for area in space.altitudeareas:
-                    # create fallback nodes
-                    if not area.nodes and space_nodes:
-                        fallback_point = good_representative_point(area.clear_geometry)
-                        fallback_node = RouterNode(None, None, fallback_point.x, fallback_point.y,
-                                                   space.pk, area.get_altitude(fallback_point))
-                        # todo: check waytypes here
-                        for node in space_nodes:
-                            line = LineString([(node.x, node.y), (fallback_node.x, fallback_node.y)])
-                            if line.length < 5 and not clear_geom_prep.intersects(line):
-                                area.fallback_nodes[node.i] = (
-                                    fallback_node,
-                                    RouterEdge(fallback_node, node, 0)
-                                )
-                        if not area.fallback_nodes:
-                            nearest_node = min(space_nodes, key=lambda node: fallback_point.distance(node.point))
-                            area.fallback_nodes[nearest_node.i] = (
-                                fallback_node,
-                                RouterEdge(fallback_node, nearest_node, 0)
-                            )
+                if previous_space is not None:
+                    space.altitudeareas = [area.remap_nodes(node_mapping) for area in previous_space.altitudeareas]
+                else:
+                    cls._build_altitudeareas(level, space, space_nodes, accessible_geom, obstacles_geom,
+                                             clear_geom_prep)
 
                 for poi in space_obj.pois.all():
                     for group in poi.groups.all():
@@ -184,12 +216,17 @@ class Router:
                     poi._prefetched_objects_cache = {}
 
                     poi = RouterPoint(poi)
-                    try:
-                        altitudearea = space.altitudearea_for_point(poi.geometry)
-                        poi.altitude = altitudearea.get_altitude(poi.geometry)
-                        poi_nodes = altitudearea.nodes_for_point(poi.geometry, all_nodes=nodes)
-                    except LocationUnreachable:
-                        poi_nodes = {}
+                    previous_poi = previous.pois.get(poi.pk) if previous_space is not None else None
+                    if previous_poi is not None and previous_poi.pk in previous_space.pois:
+                        poi.altitude = previous_poi.altitude
+                        poi_nodes = remap_nodes_addition(previous_poi.nodes_addition, node_mapping)
+                    else:
+                        try:
+                            altitudearea = space.altitudearea_for_point(poi.geometry)
+                            poi.altitude = altitudearea.get_altitude(poi.geometry)
+                            poi_nodes = altitudearea.nodes_for_point(poi.geometry, all_nodes=nodes)
+                        except LocationUnreachable:
+                            poi_nodes = {}
                     poi.nodes = set(i for i in poi_nodes.keys())
                     poi.nodes_addition = poi_nodes
                     pois[poi.pk] = poi
@@ -217,6 +254,9 @@ class Router:
             level.nodes = set(range(nodes_before_count, len(nodes)))
             levels[level.pk] = level
 
+        if previous is not None:
+            logger.info('Reused %d of %d spaces from previous router.' % (reused_spaces, len(spaces)))
+
         # add graph descriptions
         for description in LeaveDescription.objects.all():
             spaces[description.space_id].leave_descriptions[description.target_space_id] = description.description
@@ -234,45 +274,108 @@ class Router:
         waytypes = tuple(waytypes)
 
         # collect nodes
-        nodes = tuple(nodes)
-        nodes_lookup = {node.pk: node.i for node in nodes}
+        nodes = RouterNodes.from_nodes(nodes)
+        nodes_lookup = dict(zip(nodes.pks.tolist(), range(len(nodes))))
 
         # collect edges
-        edges = tuple(RouterEdge(from_node=nodes[nodes_lookup[edge.from_node_id]],
-                                 to_node=nodes[nodes_lookup[edge.to_node_id]],
-                                 waytype=waytypes_lookup[edge.waytype_id],
-                                 access_restriction=edge.access_restriction_id) for edge in GraphEdge.objects.all())
-        edges = {(edge.from_node, edge.to_node): edge for edge in edges}
-
-        # build graph matrix
-        graph = np.full(shape=(len(nodes), len(nodes)), fill_value=np.inf, dtype=np.float32)
-        for edge in edges.values():
-            index = (edge.from_node, edge.to_node)
-            graph[index] = edge.distance
-            waytype = waytypes[edge.waytype]
-            (waytype.upwards_indices if edge.rise > 0 else waytype.nonupwards_indices).append(index)
-            if edge.access_restriction:
-                restrictions.setdefault(edge.access_restriction, RouterRestriction()).edges.append(index)
-
-        # respect slow_down_factor
+        edges = tuple(GraphEdge.objects.values_list('from_node_id', 'to_node_id',
+                                                    'waytype_id', 'access_restriction_id'))
+        from_nodes = np.fromiter((nodes_lookup[edge[0]] for edge in edges), dtype=np.int32, count=len(edges))
+        to_nodes = np.fromiter((nodes_lookup[edge[1]] for edge in edges), dtype=np.int32, count=len(edges))
+        coordinates = nodes.xyz
+
+        # build sparse graph
+        graph = RouterGraph.from_arrays(
+            len(nodes), from_nodes, to_nodes,
+            distances=np.linalg.norm(coordinates[to_nodes] - coordinates[from_nodes], axis=1),
+            waytypes=np.fromiter((waytypes_lookup[edge[2]] for edge in edges), dtype=np.uint16, count=len(edges)),
+            rises=coordinates[to_nodes, 2] - coordinates[from_nodes, 2],
+            restrictions=np.fromiter((edge[3] or 0 for edge in edges), dtype=np.int32, count=len(edges)),
+        )
+
+        # respect slow_down_factor, only when routing, not for the distances shown to the user
         for area in areas.values():
             if area.slow_down_factor != 1:
-                area_nodes = np.array(tuple(area.nodes), dtype=np.uint32)
-                graph[area_nodes.reshape((-1, 1)), area_nodes] *= float(area.slow_down_factor)
+                graph.slow_downs[graph.edges_within(area.nodes)] *= float(area.slow_down_factor)
 
-        # finalize waytype matrixes
-        for waytype in waytypes:
-            waytype.upwards_indices = np.array(waytype.upwards_indices, dtype=np.uint32).reshape((-1, 2))
-            waytype.nonupwards_indices = np.array(waytype.nonupwards_indices, dtype=np.uint32).reshape((-1, 2))
+        # finalize restriction edge indices
+        for pk in np.unique(graph.restrictions[graph.restrictions != 0]).tolist():
+            restrictions.setdefault(pk, RouterRestriction())
+        for pk, restriction in restrictions.items():
+            restriction.edges = graph.edges_with_restriction(pk)
 
-        # finalize restriction edge matrixes
-        for restriction in restrictions.values():
-            restriction.edges = np.array(restriction.edges, dtype=np.uint32).reshape((-1, 2))
-
-        router = cls(levels, spaces, areas, pois, groups, restrictions, nodes, edges, waytypes, graph)
+        router = cls(levels, spaces, areas, pois, groups, restrictions, nodes, waytypes, graph)
         pickle.dump(router, open(cls.build_filename(update), 'wb'))
         return router
 
+    @staticmethod
+    def _build_altitudeareas(level, space, space_nodes, accessible_geom, obstacles_geom, clear_geom_prep):
+        for area in level.altitudeareas.all():
+            if not space.geometry_prep.intersects(unwrap_geom(area.geometry)):
+                continue
+            for subgeom in assert_multipolygon(accessible_geom.intersection(unwrap_geom(area.geometry))):
+                if subgeom.is_empty:
+                    continue
+                area_clear_geom = unary_union(tuple(get_rings(subgeom.difference(obstacles_geom))))
+                if area_clear_geom.is_empty:
+                    continue
+                area = RouterAltitudeArea(subgeom, area_clear_geom,
+                                          area.altitude, area.altitude2, area.point1, area.point2)
+                area_nodes = tuple(node for node in space_nodes if area.geometry_prep.intersects(node.point))
+                area.nodes = set(node.i for node in area_nodes)
+                for node in area_nodes:
+                    altitude = area.get_altitude(node)
+                    if node.altitude is None or node.altitude < altitude:
+                        node.altitude = altitude
+
+                space.altitudeareas.append(area)
+
+        for node in space_nodes:
+            if node.altitude is not None:
+                continue
+            logger.warning('Node %d in space %d is not inside an altitude area' % (node.pk, space.pk))
+            node_altitudearea = min(space.altitudeareas,
+                                    key=lambda a: a.geometry.distance(node.point), default=None)
+            if node_altitudearea:
+                node.altitude = node_altitudearea.get_altitude(node)
+            else:
+                node.altitude = float(level.base_altitude)
+                logger.info('Space %d has no altitude areas' % space.pk)
+
+        for area in space.altitudeareas:
+            # create fallback nodes
+            if not area.nodes and space_nodes:
+                fallback_point = good_representative_point(area.clear_geometry)
+                fallback_node = RouterNode(None, None, fallback_point.x, fallback_point.y,
+                                           space.pk, area.get_altitude(fallback_point))
+                # todo: check waytypes here
+                for node in space_nodes:
+                    line = LineString([(node.x, node.y), (fallback_node.x, fallback_node.y)])
+                    if line.length < 5 and not clear_geom_prep.intersects(line):
+                        area.fallback_nodes[node.i] = (
+                            fallback_node,
+                            RouterEdge(fallback_node, node, 0)
+                        )
+                if not area.fallback_nodes:
+                    nearest_node = min(space_nodes, key=lambda node: fallback_point.distance(node.point))
+                    area.fallback_nodes[nearest_node.i] = (
+                        fallback_node,
+                        RouterEdge(fallback_node, nearest_node, 0)
+                    )
+
+    @staticmethod
+    def _get_unchanged_space(previous, space, rebuild_key, changed_areas):
+        """
+        get the space from the previous router if no changed geometry touches it, otherwise None
+        """
+        changed_area = changed_areas.get(space.level_id)
+        if changed_area is not None and changed_area.intersects(unwrap_geom(space.geometry)):
+            return None
+        previous_space = previous.spaces.get(space.pk)
+        if previous_space is None or getattr(previous_space, 'rebuild_key', None) != rebuild_key:
+            return None
+        return previous_space
+
     @classmethod
     def build_filename(cls, update):
         return settings.CACHE_ROOT / ('router_%s.pickle' % MapUpdate.build_cache_key(*update))
@@ -351,27 +454,55 @@ class Router:
         return result
 
     def space_for_point(self, level, point, restrictions) -> Optional['RouterSpace']:
-        point = Point(point.x, point.y)
-        level = self.levels[level]
+        return self.spaces_for_points(level, (point, ), restrictions)[0]
+
+    def spaces_for_points(self, level, points, restrictions) -> list[Optional['RouterSpace']]:
+        """
+        get the space for each of the given points on this level, using one spatial index query for all of them.
+        points that are not inside any space get the nearest space within 20 meters, or None.
+        """
+        index = self.spaces_indexes[level]
         excluded_spaces = restrictions.spaces if restrictions else ()
-        for space in level.spaces:
-            if space in excluded_spaces:
+        result = [None] * len(points)
+
+        point_indices, space_indices = index.containing(points)
+        for i, space in zip(point_indices.tolist(), space_indices.tolist()):
+            space = index.items[space]
+            if result[i] is None and space.pk not in excluded_spaces:
+                result[i] = space
+
+        for i, point in enumerate(points):
+            if result[i] is not None:
                 continue
-            if self.spaces[space].geometry_prep.contains(point):
-                return self.spaces[space]
-        spaces = (self.spaces[space] for space in level.spaces if space not in excluded_spaces)
-        spaces = ((space, space.geometry.distance(point)) for space in spaces)
-        spaces = tuple((space, distance) for space, distance in spaces if distance < 20)
-        if not spaces:
-            return None
-        return min(spaces, key=operator.itemgetter(1))[0]
+            spaces = tuple((space, distance) for space, distance in index.nearby(point, 20)
+                           if space.pk not in excluded_spaces)
+            if spaces:
+                result[i] = min(spaces, key=operator.itemgetter(1))[0]
+        return result
 
     def altitude_for_point(self, space: int, point: Point) -> float:
         return self.spaces[space].altitudearea_for_point(point).get_altitude(point)
 
     def describe_custom_location(self, location):
-        restrictions = self.get_restrictions(location.permissions)
-        space = self.space_for_point(level=location.level.pk, point=location, restrictions=restrictions)
+        return self.describe_custom_locations((location, ))[0]
+
+    def describe_custom_locations(self, locations):
+        """
+        describe many custom locations at once. restrictions are only evaluated once per level and permissions,
+        spaces are looked up with one spatial index query per level.
+        """
+        result = [None] * len(locations)
+        groups = {}
+        for i, location in enumerate(locations):
+            groups.setdefault((location.level.pk, frozenset(location.permissions)), []).append(i)
+        for (level, permissions), indices in groups.items():
+            restrictions = self.get_restrictions(permissions)
+            spaces = self.spaces_for_points(level, tuple(locations[i] for i in indices), restrictions)
+            for i, space in zip(indices, spaces):
+                result[i] = self._describe_custom_location(locations[i], space, restrictions)
+        return result
+
+    def _describe_custom_location(self, location, space, restrictions):
         if not space:
             return CustomLocationDescription(space=space, altitude=None, areas=(), near_area=None, near_poi=None,
                                              nearby=())
@@ -380,10 +511,10 @@ class Router:
         except LocationUnreachable:
             altitude = None
         areas, near_area, nearby_areas = space.areas_for_point(
-            areas=self.areas, point=location, restrictions=restrictions
+            index=self.areas_indexes[space.pk], point=location, restrictions=restrictions
         )
         near_poi, nearby_pois = space.poi_for_point(
-            pois=self.pois, point=location, restrictions=restrictions
+            index=self.pois_indexes[space.pk], point=location, restrictions=restrictions
         )
         nearby = tuple(sorted(
             tuple(location for location in nearby_areas+nearby_pois if location[0].can_search),
@@ -404,18 +535,13 @@ class Router:
         from scipy.sparse.csgraph import shortest_path
         return shortest_path
 
-    def shortest_path(self, restrictions, options):
-        options_key = options.serialize_string()
-        cache_key = 'router:shortest_path:%s:%s:%s' % (MapUpdate.current_processed_cache_key(),
-                                                       restrictions.cache_key,
-                                                       options_key)
-        result = cache.get(cache_key)
-        if result:
-            distances, predecessors = result
-            return (np.frombuffer(distances, dtype=np.float64).reshape(self.graph.shape),
-                    np.frombuffer(predecessors, dtype=np.int32).reshape(self.graph.shape))
-
-        graph = self.graph.copy()
+    def get_edge_weights(self, restrictions, options):
+        """
+        get the weight of every graph edge for these restrictions and options, excluded edges are np.inf
+        """
+        graph = self.graph
+        weights = graph.distances * graph.slow_downs
+        upwards = graph.upwards
 
         # speeds of waytypes, if relevant
         if options['mode'] == 'fastest':
@@ -424,28 +550,22 @@ class Router:
             self.waytypes[0].extra_seconds = 0
             self.waytypes[0].walk = True
 
-            for waytype in self.waytypes:
-                speed = float(waytype.speed)
-                speed_up = float(waytype.speed_up)
-                if waytype.walk:
-                    speed *= options.walk_factor
-                    speed_up *= options.walk_factor
-
-                for indices, dir_speed in ((waytype.nonupwards_indices, speed), (waytype.upwards_indices, speed_up)):
-                    indices = tuple(indices.transpose().tolist())
-                    values = graph[indices]
-                    values /= dir_speed
-                    if waytype.extra_seconds:
-                        values += int(waytype.extra_seconds)
-                    graph[indices] = values
+            walk_factors = np.array(tuple((options.walk_factor if waytype.walk else 1) for waytype in self.waytypes))
+            speeds = np.array(tuple(float(waytype.speed) for waytype in self.waytypes)) * walk_factors
+            speeds_up = np.array(tuple(float(waytype.speed_up) for waytype in self.waytypes)) * walk_factors
+            extra_seconds = np.array(tuple(int(waytype.extra_seconds) for waytype in self.waytypes))
+
+            weights /= np.where(upwards, speeds_up[graph.waytypes], speeds[graph.waytypes]).astype(np.float32)
+            weights += extra_seconds[graph.waytypes].astype(np.float32)
 
         # avoid waytypes as specified in settings
-        for waytype in self.waytypes[1:]:
+        avoid_up = np.zeros(len(self.waytypes), dtype=bool)
+        avoid_down = np.zeros(len(self.waytypes), dtype=bool)
+        for i, waytype in enumerate(self.waytypes[1:], start=1):
             value = options.get('waytype_%s' % waytype.pk, 'allow')
-            if value in ('avoid', 'avoid_up'):
-                graph[tuple(waytype.upwards_indices.transpose().tolist())] *= 100000
-            if value in ('avoid', 'avoid_down'):
-                graph[tuple(waytype.nonupwards_indices.transpose().tolist())] *= 100000
+            avoid_up[i] = value in ('avoid', 'avoid_up')
+            avoid_down[i] = value in ('avoid', 'avoid_down')
+        weights[np.where(upwards, avoid_up[graph.waytypes], avoid_down[graph.waytypes])] *= 100000
 
         # prefer/avoid restrictions
         restrictions_setting = options.get("restrictions", "normal")
@@ -453,46 +573,70 @@ class Router:
             if restrictions_setting == "avoid":
                 factor = 100000
             else:
-                graph *= 100000
+                weights *= 100000
                 factor = 1/100000
             all_restrictions = RouterRestrictionSet(self.restrictions)
-            space_nodes = tuple(reduce(operator.or_, (self.spaces[space].nodes
-                                                      for space in all_restrictions.spaces), set()))
-            graph[space_nodes, :] *= factor
-            graph[:, space_nodes] *= factor
-            if restrictions.additional_nodes:
-                graph[tuple(restrictions.additional_nodes), :] *= factor
-                graph[:, tuple(restrictions.additional_nodes)] *= factor
-            graph[tuple(restrictions.edges.transpose().tolist())] *= factor
+            space_nodes = graph.node_mask(reduce(operator.or_, (self.spaces[space].nodes
+                                                                for space in all_restrictions.spaces), set()))
+            additional_nodes = graph.node_mask(restrictions.additional_nodes)
+            # factor is applied once for each restricted end of an edge and once more for restricted edges
+            exponent = (space_nodes[graph.from_nodes].astype(np.int32) + space_nodes[graph.to_nodes] +
+                        additional_nodes[graph.from_nodes] + additional_nodes[graph.to_nodes])
+            exponent[restrictions.edges] += 1
+            weights *= np.power(factor, exponent, dtype=np.float64).astype(np.float32)
 
         # exclude spaces and edges
-        space_nodes = tuple(reduce(operator.or_, (self.spaces[space].nodes for space in restrictions.spaces), set()))
-        graph[space_nodes, :] = np.inf
-        graph[:, space_nodes] = np.inf
-        if restrictions.additional_nodes:
-            graph[tuple(restrictions.additional_nodes), :] = np.inf
-            graph[:, tuple(restrictions.additional_nodes)] = np.inf
-        graph[tuple(restrictions.edges.transpose().tolist())] = np.inf
+        weights[graph.edges_touching(reduce(operator.or_, (self.spaces[space].nodes
+                                                           for space in restrictions.spaces), set()))] = np.inf
+        weights[graph.edges_touching(restrictions.additional_nodes)] = np.inf
+        weights[restrictions.edges] = np.inf
+
+        return weights
+
+    def shortest_path(self, restrictions, options, update=None):
+        """
+        get the all-pairs shortest path result, computing it if it's not in the store yet.
+        :param update: map update to store the result for, if not the last processed one. used for warming up.
+        """
+        if update is None:
+            # only permissions for restrictions of this router make a difference for routing
+            track_route_profile(self.restrictions.keys() - restrictions.restrictions.keys(), options)
+            update_cache_key = MapUpdate.current_processed_cache_key()
+        else:
+            update_cache_key = MapUpdate.build_cache_key(*update)
+        key = shortest_path_store.build_key(update_cache_key, restrictions.cache_key, options.serialize_string())
+        result = shortest_path_store.get(key)
+        if result is not None:
+            return result
+
+        graph = self.graph.as_csgraph(self.get_edge_weights(restrictions, options))
 
         distances, predecessors = self.shortest_path_func(graph, directed=True, return_predecessors=True)
-        cache.set(cache_key, (distances.astype(np.float64).tobytes(),
-                              predecessors.astype(np.int32).tobytes()), 600)
-        return distances, predecessors
+        return shortest_path_store.set(key, distances.astype(np.float64), predecessors.astype(np.int32))
 
     def get_restrictions(self, permissions):
         return RouterRestrictionSet({
             pk: restriction for pk, restriction in self.restrictions.items() if pk not in permissions
         })
 
-    def get_route(self, origin, destination, permissions, options):
-        restrictions = self.get_restrictions(permissions)
-
-        # get possible origins and destinations
-        origins = self.get_locations(origin, restrictions)
-        destinations = self.get_locations(destination, restrictions)
-
-        # calculate shortest path matrix
-        distances, predecessors = self.shortest_path(restrictions, options=options)
+    @cached_property
+    def node_coordinates(self):
+        return self.nodes.xyz
+
+    def get_path_finder(self, restrictions, options):
+        """
+        get a function that finds the best path between two RouterLocations for these restrictions and options.
+        everything that does not depend on origin and destination is only prepared once.
+        """
+        hierarchy = RouterHierarchies.load().get(restrictions, options) if settings.ROUTING_CONTRACTION else None
+        if hierarchy is not None:
+            return partial(self.find_path_contraction, hierarchy)
+        if settings.ROUTING_SEARCH == 'all_pairs':
+            return partial(self.find_path_all_pairs, self.shortest_path(restrictions, options))
+        return partial(self.find_path_search, self.get_edge_weights(restrictions, options))
+
+    def find_path_all_pairs(self, shortest_paths, origins, destinations):
+        distances, predecessors = shortest_paths
 
         # find shortest path for our origins and destinations
         origin_nodes = np.array(tuple(origins.nodes))
@@ -507,17 +651,186 @@ class Router:
         if distances[origin_node, destination_node] == np.inf:
             raise NoRouteFound
 
-        # get best origin and destination
-        origin = origins.get_location_for_node(origin_node)
-        destination = destinations.get_location_for_node(destination_node)
-
-        # recreate path
+        # recreate path, only reading the predecessor row of the origin node
+        origin_node, destination_node = int(origin_node), int(destination_node)
+        predecessors = predecessors[origin_node]
         path_nodes = deque((destination_node, ))
         last_node = destination_node
         while last_node != origin_node:
-            last_node = predecessors[origin_node, last_node]
+            last_node = int(predecessors[last_node])
             path_nodes.appendleft(last_node)
-        path_nodes = tuple(path_nodes)
+        return origin_node, destination_node, tuple(path_nodes)
+
+    def find_path_search(self, weights, origins, destinations):
+        # search from all origins at once until the nearest destination is reached
+        result = self.graph.search(
+            weights, origins.nodes, destinations.nodes,
+            coordinates=(self.node_coordinates if settings.ROUTING_SEARCH == 'astar' else None),
+        )
+        if result is None:
+            raise NoRouteFound
+        return result
+
+    def find_path_contraction(self, hierarchy, origins, destinations):
+        result = hierarchy.query(origins.nodes, destinations.nodes)
+        if result is None:
+            raise NoRouteFound
+        return result
+
+    def get_route(self, origin, destination, permissions, options):
+        restrictions = self.get_restrictions(permissions)
+
+        # get possible origins and destinations
+        origins = self.get_locations(origin, restrictions)
+        destinations = self.get_locations(destination, restrictions)
+
+        return self._get_route(origins, destinations, self.get_path_finder(restrictions, options), options)
+
+    def get_routes(self, pairs, permissions, options):
+        """
+        get routes for many (origin, destination) pairs with the same permissions and options.
+        restrictions, locations and shortest path data are only looked up once.
+        :return: list with one Route per pair, or the exception (NotYetRoutable, LocationUnreachable or
+                 NoRouteFound) if there is no route for that pair
+        """
+        restrictions = self.get_restrictions(permissions)
+        find_path = self.get_path_finder(restrictions, options)
+
+        # positions and other dynamic locations have their own pks, which can collide with location slug pks
+        locations = {}
+
+        def get_locations(location):
+            key = (type(location), location.pk)
+            result = locations.get(key)
+            if result is None:
+                try:
+                    result = self.get_locations(location, restrictions)
+                except (NotYetRoutable, LocationUnreachable) as e:
+                    result = e
+                locations[key] = result
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        results = []
+        for origin, destination in pairs:
+            try:
+                results.append(self._get_route(get_locations(origin), get_locations(destination),
+                                               find_path, options))
+            except (NotYetRoutable, LocationUnreachable, NoRouteFound) as e:
+                results.append(e)
+        return results
+
+    def distance_matrix(self, origins, destinations, permissions, options):
+        """
+        get travel distances and durations from each origin to each destination without building any routes.
+        there is one one-to-many search per origin, distances and durations are summed up along its path tree.
+        :return: (distances, durations) arrays with one row per origin and one column per destination,
+                 np.nan where there is no route
+        """
+        from scipy.sparse.csgraph import dijkstra
+
+        restrictions = self.get_restrictions(permissions)
+        graph = self.graph
+        csgraph = graph.as_csgraph(self.get_edge_weights(restrictions, options).astype(np.float64))
+        edge_durations = self.get_edge_durations(graph.distances, graph.waytypes, graph.rises, options)
+
+        def get_locations(location):
+            try:
+                return self.get_locations(location, restrictions)
+            except (NotYetRoutable, LocationUnreachable):
+                return None
+
+        destination_locations = tuple(get_locations(destination) for destination in destinations)
+        distances = np.full((len(origins), len(destinations)), np.nan)
+        durations = np.full((len(origins), len(destinations)), np.nan)
+        for i, origin in enumerate(origins):
+            origin_locations = get_locations(origin)
+            if origin_locations is None:
+                continue
+            costs, predecessors, sources = dijkstra(csgraph, directed=True, indices=tuple(origin_locations.nodes),
+                                                    return_predecessors=True, min_only=True)
+            path_distances, path_durations = self._sum_along_paths(predecessors, graph.distances, edge_durations)
+
+            for j, locations in enumerate(destination_locations):
+                if locations is None:
+                    continue
+                destination_nodes = np.array(tuple(locations.nodes))
+                destination_node = int(destination_nodes[costs[destination_nodes].argmin()])
+                if not np.isfinite(costs[destination_node]):
+                    continue
+                origin_node = int(sources[destination_node])
+                origin_distance, origin_duration = self._get_end_distance_and_duration(
+                    origin_locations, origin_node, options
+                )
+                destination_distance, destination_duration = self._get_end_distance_and_duration(
+                    locations, destination_node, options
+                )
+                distances[i, j] = path_distances[destination_node] + origin_distance + destination_distance
+                durations[i, j] = path_durations[destination_node] + origin_duration + destination_duration
+        return distances, durations
+
+    def _sum_along_paths(self, predecessors, *edge_values):
+        """
+        sum up edge values from the root to every node of a shortest path tree from scipy.sparse.csgraph,
+        for all nodes at once, by pointer jumping.
+        """
+        nodes = np.arange(len(predecessors))
+        reached = predecessors >= 0
+        edges = self.graph.get_edges(predecessors[reached], nodes[reached])
+        parents = np.where(reached, predecessors, nodes)
+        sums = []
+        for values in edge_values:
+            node_sums = np.zeros(len(predecessors))
+            node_sums[reached] = values[edges]
+            sums.append(node_sums)
+
+        # every step doubles the length of the path segment that each sum covers, roots point to themselves
+        while (parents[parents] != parents).any():
+            for node_sums in sums:
+                node_sums += node_sums[parents]
+            parents = parents[parents]
+        return sums
+
+    def _get_end_distance_and_duration(self, locations, node, options):
+        """
+        distance and duration that a route starting or ending at this node adds beyond the graph,
+        like in Route: the edge to the addition node and the way to the custom location
+        """
+        location = locations.get_location_for_node(node)
+        distance = duration = 0
+        end_node = self.nodes[node]
+        addition = location.nodes_addition.get(node)
+        if addition and any(addition):
+            end_node, edge = addition
+            distance += edge.distance
+            duration += self.get_edge_durations(np.array((edge.distance, )), np.array((edge.waytype, )),
+                                                np.array((np.nan if edge.rise is None else edge.rise, )),
+                                                options)[0]
+        if isinstance(location, RouterPoint):
+            end_distance = np.linalg.norm(end_node.xyz - location.xyz)
+            distance += end_distance
+            duration += end_distance * options.walk_factor
+        return float(distance), float(duration)
+
+    def get_edge_durations(self, distances, waytypes, rises, options):
+        """
+        get the walking duration of edges with these distances, waytype indices and rises, zero where distance is nan
+        """
+        speeds = np.array(tuple((float(waytype.speed) if waytype.src else 1) for waytype in self.waytypes))
+        speeds_up = np.array(tuple((float(waytype.speed_up) if waytype.src else 1) for waytype in self.waytypes))
+        extra_seconds = np.array(tuple((float(waytype.extra_seconds) if waytype.src else 0)
+                                       for waytype in self.waytypes))
+
+        speeds = np.where(rises > 0, speeds_up[waytypes], speeds[waytypes]) * options.walk_factor
+        return np.where(np.isnan(distances), 0, distances / speeds + extra_seconds[waytypes])
+
+    def _get_route(self, origins, destinations, find_path, options):
+        origin_node, destination_node, path_nodes = find_path(origins, destinations)
+
+        # get best origin and destination
+        origin = origins.get_location_for_node(origin_node)
+        destination = destinations.get_location_for_node(destination_node)
 
         origin_addition = origin.nodes_addition.get(origin_node)
         destination_addition = destination.nodes_addition.get(destination_node)
@@ -570,24 +883,32 @@ class RouterSpace(BaseRouterProxy):
         self.leave_descriptions = {}
         self.cross_descriptions = {}
 
+    @cached_property
+    def altitudeareas_index(self):
+        return RouterGeometryIndex(self.altitudeareas)
+
+    def __getstate__(self):
+        result = super().__getstate__()
+        result.pop('altitudeareas_index', None)
+        return result
+
     def altitudearea_for_point(self, point):
         point = Point(point.x, point.y)
         if not self.altitudeareas:
             raise LocationUnreachable
-        for area in self.altitudeareas:
-            if area.geometry_prep.intersects(point):
-                return area
-        return min(self.altitudeareas, key=lambda area: area.geometry.distance(point))
+        index = self.altitudeareas_index
+        intersecting = index.intersecting(point)
+        if len(intersecting):
+            return index.items[intersecting[0]]
+        return index.items[index.nearest(point)]
 
-    def areas_for_point(self, areas, point, restrictions):
+    def areas_for_point(self, index, point, restrictions):
         point = Point(point.x, point.y)
-        areas = {pk: area for pk, area in areas.items()
-                 if pk in self.areas and area.can_describe and area.access_restriction_id not in restrictions}
 
-        nearby = ((area, area.geometry.distance(point)) for area in areas.values())
-        nearby = tuple((area, distance) for area, distance in nearby if distance < 20)
+        nearby = tuple((area, distance) for area, distance in index.nearby(point, 20)
+                       if area.access_restriction_id not in restrictions)
 
-        contained = tuple(area for area in areas.values() if area.geometry_prep.contains(point))
+        contained = tuple(area for area, distance in nearby if distance == 0 and area.geometry_prep.contains(point))
         if contained:
             return tuple(sorted(contained, key=lambda area: area.geometry.area)), None, nearby
 
@@ -596,13 +917,11 @@ class RouterSpace(BaseRouterProxy):
             return (), None, nearby
         return (), min(near, key=operator.itemgetter(1))[0], nearby
 
-    def poi_for_point(self, pois, point, restrictions):
+    def poi_for_point(self, index, point, restrictions):
         point = Point(point.x, point.y)
-        pois = {pk: poi for pk, poi in pois.items()
-                if pk in self.pois and poi.can_describe and poi.access_restriction_id not in restrictions}
 
-        nearby = ((poi, poi.geometry.distance(point)) for poi in pois.values())
-        nearby = tuple((poi, distance) for poi, distance in nearby if distance < 20)
+        nearby = tuple((poi, distance) for poi, distance in index.nearby(point, 20)
+                       if poi.access_restriction_id not in restrictions)
 
         near = tuple((poi, distance) for poi, distance in nearby if distance < 5)
         if not near:
@@ -614,6 +933,48 @@ class RouterArea(BaseRouterProxy):
     pass
 
 
+class RouterGeometryIndex:
+    """
+    Spatial index (STRtree) over the geometries of router objects, for fast point lookups.
+    Results are always in the order of the given items.
+    """
+    def __init__(self, items):
+        self.items = tuple(items)
+        self.geometries = np.array(tuple(unwrap_geom(item.geometry) for item in self.items), dtype=object)
+        self.tree = STRtree(self.geometries)
+
+    def containing(self, points):
+        """
+        get (point indices, item indices) of all items containing one of the points, sorted by point and item
+        """
+        points = shapely.points(tuple((point.x, point.y) for point in points))
+        point_indices, item_indices = self.tree.query(points, predicate='within')
+        order = np.lexsort((item_indices, point_indices))
+        return point_indices[order], item_indices[order]
+
+    def intersecting(self, point):
+        """
+        get sorted indices of all items intersecting the point
+        """
+        return np.sort(self.tree.query(point, predicate='intersects'))
+
+    def nearest(self, point):
+        """
+        get the index of the item nearest to the point
+        """
+        return int(self.tree.nearest(point))
+
+    def nearby(self, point, max_distance):
+        """
+        get (item, distance) for all items closer than max_distance to the point
+        """
+        point = Point(point.x, point.y)
+        indices = np.sort(self.tree.query(point, predicate='dwithin', distance=max_distance))
+        distances = shapely.distance(self.geometries[indices], point)
+        return tuple((self.items[i], distance) for i, distance in zip(indices.tolist(), distances.tolist())
+                     if distance < max_distance)
+
+
 class RouterPoint(BaseRouterProxy):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -643,6 +1004,13 @@ class RouterAltitudeArea:
     def clear_geometry_prep(self):
         return prepared.prep(self.clear_geometry)
 
+    def remap_nodes(self, mapping):
+        area = RouterAltitudeArea(self.geometry, self.clear_geometry,
+                                  self.altitude, self.altitude2, self.point1, self.point2)
+        area.nodes = set(mapping[i] for i in self.nodes)
+        area.fallback_nodes = remap_nodes_addition(self.fallback_nodes, mapping)
+        return area
+
     def get_altitude(self, point):
         # noinspection PyTypeChecker,PyCallByClass
         return AltitudeArea.get_altitudes(self, (point.x, point.y))[0]
@@ -672,7 +1040,25 @@ class RouterAltitudeArea:
         return result
 
 
+def remap_nodes_addition(nodes_addition, mapping):
+    """
+    translate the node indices of a nodes_addition dict from a previous router
+    """
+    result = {}
+    for i, (node, edge) in nodes_addition.items():
+        if edge is not None:
+            edge = copy(edge)
+            edge.to_node = mapping[edge.to_node]
+        result[mapping[i]] = (node, edge)
+    return result
+
+
 class RouterNode:
+    """
+    Mutable node used while building the router, and for fallback nodes that are not part of the graph.
+    """
+    __slots__ = ('i', 'pk', 'x', 'y', 'space', 'altitude', 'areas')
+
     def __init__(self, i, pk, x, y, space, altitude=None, areas=None):
         self.i = i
         self.pk = pk
@@ -686,16 +1072,117 @@ class RouterNode:
     def from_graph_node(cls, node, i):
         return cls(i, node.pk, node.geometry.x, node.geometry.y, node.space_id)
 
-    @cached_property
+    @property
     def point(self):
         return Point(self.x, self.y)
 
-    @cached_property
+    @property
     def xyz(self):
         return np.array((self.x, self.y, self.altitude))
 
 
+class RouterNodes:
+    """
+    Columnar storage of all graph nodes. Area membership is stored in CSR form: the areas of node i are
+    areas[areas_indptr[i]:areas_indptr[i+1]]. Indexing returns a lightweight RouterNodeView.
+    """
+    def __init__(self, pks, x, y, altitudes, spaces, areas_indptr, areas):
+        self.pks = pks
+        self.x = x
+        self.y = y
+        self.altitudes = altitudes
+        self.spaces = spaces
+        self.areas_indptr = areas_indptr
+        self.areas = areas
+
+    @classmethod
+    def from_nodes(cls, nodes):
+        nodes = tuple(nodes)
+        areas_indptr = np.zeros(len(nodes)+1, dtype=np.int32)
+        np.cumsum(np.fromiter((len(node.areas) for node in nodes), dtype=np.int32, count=len(nodes)),
+                  out=areas_indptr[1:])
+        return cls(
+            pks=np.fromiter((node.pk for node in nodes), dtype=np.int32, count=len(nodes)),
+            x=np.fromiter((node.x for node in nodes), dtype=np.float64, count=len(nodes)),
+            y=np.fromiter((node.y for node in nodes), dtype=np.float64, count=len(nodes)),
+            altitudes=np.fromiter((np.nan if node.altitude is None else node.altitude for node in nodes),
+                                  dtype=np.float64, count=len(nodes)),
+            spaces=np.fromiter((node.space for node in nodes), dtype=np.int32, count=len(nodes)),
+            areas_indptr=areas_indptr,
+            areas=np.fromiter((area for node in nodes for area in sorted(node.areas)),
+                              dtype=np.int32, count=areas_indptr[-1]),
+        )
+
+    def __len__(self):
+        return len(self.pks)
+
+    def __getitem__(self, i):
+        i = operator.index(i)
+        if not -len(self) <= i < len(self):
+            raise IndexError('node index out of range')
+        return RouterNodeView(self, i % len(self))
+
+    def __iter__(self):
+        return (RouterNodeView(self, i) for i in range(len(self)))
+
+    @property
+    def xyz(self):
+        return np.column_stack((self.x, self.y, self.altitudes))
+
+    def get_areas(self, i):
+        return self.areas[self.areas_indptr[i]:self.areas_indptr[i+1]]
+
+
+class RouterNodeView:
+    """
+    Read-only node object backed by RouterNodes.
+    """
+    __slots__ = ('nodes', 'i')
+
+    def __init__(self, nodes, i):
+        self.nodes = nodes
+        self.i = i
+
+    @property
+    def pk(self):
+        return int(self.nodes.pks[self.i])
+
+    @property
+    def x(self):
+        return float(self.nodes.x[self.i])
+
+    @property
+    def y(self):
+        return float(self.nodes.y[self.i])
+
+    @property
+    def space(self):
+        return int(self.nodes.spaces[self.i])
+
+    @property
+    def altitude(self):
+        altitude = float(self.nodes.altitudes[self.i])
+        return None if np.isnan(altitude) else altitude
+
+    @property
+    def areas(self):
+        return frozenset(self.nodes.get_areas(self.i).tolist())
+
+    @property
+    def point(self):
+        return Point(self.x, self.y)
+
+    @property
+    def xyz(self):
+        return np.array((self.nodes.x[self.i], self.nodes.y[self.i], self.nodes.altitudes[self.i]))
+
+
 class RouterEdge:
+    """
+    Edge that is not part of the graph, used to connect fallback nodes.
+    """
+    __slots__ = ('from_node', 'to_node', 'waytype', 'access_restriction', 'rise', 'distance')
+
     def __init__(self, from_node, to_node, waytype, access_restriction=None, rise=None, distance=None):
         self.from_node = from_node.i
         self.to_node = to_node.i
@@ -710,11 +1197,67 @@ class RouterEdge:
         self.distance = distance if distance is not None else np.linalg.norm(to_node.xyz - from_node.xyz)
 
 
+class RouterEdges:
+    """
+    Mapping of (from_node, to_node) to RouterEdgeView objects backed by the RouterGraph edge arrays.
+    """
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __len__(self):
+        return len(self.graph)
+
+    def __getitem__(self, nodes):
+        from_node, to_node = nodes
+        return RouterEdgeView(self.graph, int(self.graph.get_edges((from_node, ), (to_node, ))[0]))
+
+    def __contains__(self, nodes):
+        try:
+            self[nodes]
+        except KeyError:
+            return False
+        return True
+
+
+class RouterEdgeView:
+    """
+    Read-only edge object backed by RouterGraph.
+    """
+    __slots__ = ('graph', 'i')
+
+    def __init__(self, graph, i):
+        self.graph = graph
+        self.i = i
+
+    @property
+    def from_node(self):
+        return int(self.graph.from_nodes[self.i])
+
+    @property
+    def to_node(self):
+        return int(self.graph.to_nodes[self.i])
+
+    @property
+    def distance(self):
+        return float(self.graph.distances[self.i])
+
+    @property
+    def waytype(self):
+        return int(self.graph.waytypes[self.i])
+
+    @property
+    def rise(self):
+        rise = float(self.graph.rises[self.i])
+        return None if np.isnan(rise) else rise
+
+    @property
+    def access_restriction(self):
+        return int(self.graph.restrictions[self.i]) or None
+
+
 class RouterWayType:
     def __init__(self, waytype):
         self.src = waytype
-        self.upwards_indices = deque()
-        self.nonupwards_indices = deque()
 
     def __getattr__(self, name):
         if name in ('__getstate__', '__setstate__'):
@@ -749,7 +1292,7 @@ class RouterRestriction:
     def __init__(self, spaces=None):
         self.spaces = spaces if spaces else set()
         self.additional_nodes = set()
-        self.edges = deque()
+        self.edges = np.array((), dtype=np.uint32)
 
 
 class RouterRestrictionSet:
@@ -768,8 +1311,8 @@ class RouterRestrictionSet:
     @cached_property
     def edges(self):
         if not self.restrictions:
-            return np.array((), dtype=np.uint32).reshape((-1, 2))
-        return np.vstack(tuple(restriction.edges for restriction in self.restrictions.values()))
+            return np.array((), dtype=np.uint32)
+        return np.concatenate(tuple(restriction.edges for restriction in self.restrictions.values()))
 
     @cached_property
     def cache_key(self):
@@ -0,0 +1,102 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import suppress
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+
+
+class ShortestPathStore:
+    """
+    File-backed store for all-pairs shortest path results.
+    Results are saved as .npy files and opened as read-only memory maps, so all workers on one host share the same
+    pages from the page cache. The directory is kept below a maximum size by evicting least recently used results.
+    """
+    def __init__(self, path: Path, max_size: int, max_open=8):
+        self.path = path
+        self.max_size = max_size
+        self.max_open = max_open
+        # memory maps can be shared between threads, the lock guards the lru order
+        self._opened = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def build_key(update_cache_key, restrictions_cache_key, options_key):
+        return '%s_%s' % (update_cache_key, hashlib.sha256(
+            ('%s:%s' % (restrictions_cache_key, options_key)).encode()
+        ).hexdigest()[:32])
+
+    def _filenames(self, key):
+        return self.path / ('%s.distances.npy' % key), self.path / ('%s.predecessors.npy' % key)
+
+    def get(self, key):
+        """
+        get (distances, predecessors) as read-only memory maps or None
+        """
+        with self._lock:
+            result = self._opened.get(key)
+            if result is not None:
+                self._opened.move_to_end(key)
+                return result
+
+        distances_filename, predecessors_filename = self._filenames(key)
+        try:
+            result = (np.load(distances_filename, mmap_mode='r'),
+                      np.load(predecessors_filename, mmap_mode='r'))
+            # mark as recently used
+            os.utime(distances_filename)
+            os.utime(predecessors_filename)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        with self._lock:
+            self._opened[key] = result
+            self._opened.move_to_end(key)
+            while len(self._opened) > self.max_open:
+                self._opened.popitem(last=False)
+        return result
+
+    def set(self, key, distances, predecessors):
+        """
+        save the result atomically and evict old results, returns the memory mapped result
+        """
+        self.path.mkdir(exist_ok=True)
+        for filename, data in zip(self._filenames(key), (distances, predecessors)):
+            # unique temporary file, other threads or processes might be saving the same result
+            with tempfile.NamedTemporaryFile(dir=self.path, prefix=filename.name + '.', suffix='.tmp',
+                                             delete=False) as f:
+                try:
+                    np.save(f, data)
+                except BaseException:
+                    f.close()
+                    os.unlink(f.name)
+                    raise
+            os.replace(f.name, filename)
+        self.evict()
+        result = self.get(key)
+        return (distances, predecessors) if result is None else result
+
+    def evict(self):
+        results = {}
+        for filename in self.path.glob('*.npy'):
+            with suppress(FileNotFoundError):
+                stat = filename.stat()
+                key = filename.name.split('.')[0]
+                mtime, size, filenames = results.get(key, (0, 0, ()))
+                results[key] = (max(mtime, stat.st_mtime), size + stat.st_size, filenames + (filename, ))
+        total_size = sum(size for mtime, size, filenames in results.values())
+        for mtime, size, filenames in sorted(results.values(), key=lambda item: item[0]):
+            if total_size <= self.max_size:
+                break
+            for filename in filenames:
+                with suppress(FileNotFoundError):
+                    filename.unlink()
+            total_size -= size
+
+
+shortest_path_store = ShortestPathStore(settings.CACHE_ROOT / 'shortest_paths',
+                                        max_size=settings.ROUTING_STORE_SIZE * 1024 * 1024)
@@ -0,0 +1,7 @@
+from django.urls import path
+
+from c3nav.routing.consumers import LocateConsumer
+
+websocket_urlpatterns = [
+    path('locate/ws', LocateConsumer.as_asgi()),
+]
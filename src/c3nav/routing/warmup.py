@@ -0,0 +1,68 @@
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger('c3nav')
+
+PROFILE_STATS_PREFIX = 'routing_warmup__'
+PROFILE_CACHE_KEY = 'routing:warmup:profile:%s'
+
+
+def track_route_profile(permissions, options):
+    """
+    count how often the all-pairs shortest paths for this permissions and options combination are requested.
+    counts go through the stats buffer, the profile itself is only stored if it is not in the cache yet.
+    """
+    from c3nav.mapdata.utils.cache.stats import increment_cache_key
+
+    profile = (tuple(sorted(permissions)), options.serialize_string())
+    profile_hash = hashlib.sha256(repr(profile).encode()).hexdigest()[:32]
+    # also stores the profile again if the cache evicted it
+    cache.add(PROFILE_CACHE_KEY % profile_hash, profile, None)
+    increment_cache_key(PROFILE_STATS_PREFIX + profile_hash)
+
+
+def get_route_profiles(num):
+    """
+    get the most requested (access permission pks, options string) combinations
+    """
+    from c3nav.mapdata.utils.cache.stats import get_stats, stats_buffer
+
+    stats_buffer.flush()
+    counts = get_stats(prefix=PROFILE_STATS_PREFIX)
+    profile_keys = [PROFILE_CACHE_KEY % name[len(PROFILE_STATS_PREFIX):]
+                    for name, count in sorted(counts.items(), key=lambda item: item[1], reverse=True)[:num]]
+    profiles = cache.get_many(profile_keys)
+    return [profiles[key] for key in profile_keys if key in profiles]
+
+
+def warm_up_router(update, router, num_profiles=None):
+    """
+    precompute all-pairs shortest paths for the default options without permissions and the most requested
+    profiles, so that no route request has to wait for them.
+    """
+    from c3nav.mapdata.models.access import AccessPermission
+    from c3nav.routing.models import RouteOptions
+
+    if settings.ROUTING_SEARCH != 'all_pairs':
+        logger.info('Routing does not use all-pairs shortest paths, no warm-up needed.')
+        return
+
+    if num_profiles is None:
+        num_profiles = settings.ROUTING_WARMUP_PROFILES
+
+    profiles = [(router.get_restrictions(AccessPermission.get_for_request(None)), RouteOptions())]
+    for permissions, options_string in get_route_profiles(num_profiles):
+        # restrictions are resolved now, so restrictions added since the profile was tracked apply too
+        profiles.append((router.get_restrictions(set(permissions)), RouteOptions.unserialize_string(options_string)))
+
+    done = set()
+    for restrictions, options in profiles:
+        key = (restrictions.cache_key, options.serialize_string())
+        if key in done:
+            continue
+        done.add(key)
+        logger.info('Precomputing shortest paths for %s...' % options.serialize_string())
+        router.shortest_path(restrictions, options, update=update)
@@ -175,9 +175,33 @@ IMAGE_RENDERER = config.get('c3nav', 'image_renderer', fallback='svg')
 SVG_RENDERER = config.get('c3nav', 'svg_renderer', fallback='rsvg-convert')
 
 CACHE_TILES = config.getboolean('c3nav', 'cache_tiles', fallback=not DEBUG)
+METATILE_SIZE = config.getint('c3nav', 'metatile_size', fallback=1)
+if METATILE_SIZE < 1:
+    raise ImproperlyConfigured('metatile_size has to be at least 1.')
+# where to cache tiles: 'files' uses one directory per tile in TILES_ROOT, 'packed' one SQLite file in TILES_ROOT
+TILE_STORE = config.get('c3nav', 'tile_store', fallback='files')
+if TILE_STORE not in ('files', 'packed'):
+    raise ImproperlyConfigured('tile_store has to be one of files, packed.')
+# render outdated tiles up to this zoom level in a celery task after map updates were processed
+SEED_TILES = config.getboolean('c3nav', 'seed_tiles', fallback=False)
+SEED_TILES_MAX_ZOOM = config.getint('c3nav', 'seed_tiles_max_zoom', fallback=2)
+# maximum number of tiles per second to render in that task, 0 means no limit
+SEED_TILES_RATE = config.getfloat('c3nav', 'seed_tiles_rate', fallback=0)
 CACHE_PREVIEWS = config.getboolean('c3nav', 'cache_previews', fallback=not DEBUG)
 CACHE_RESOLUTION = config.getint('c3nav', 'cache_resolution', fallback=4)
 
+# how to find routes: 'all_pairs' computes and caches the all-pairs shortest path matrix per restrictions and options,
+# 'dijkstra' and 'astar' search the graph on demand for each route request
+ROUTING_SEARCH = config.get('c3nav', 'routing_search', fallback='all_pairs')
+if ROUTING_SEARCH not in ('all_pairs', 'dijkstra', 'astar'):
+    raise ImproperlyConfigured('routing_search has to be one of all_pairs, dijkstra, astar.')
+# maximum size in megabytes of all-pairs shortest path results kept in CACHE_ROOT/shortest_paths
+ROUTING_STORE_SIZE = config.getint('c3nav', 'routing_store_size', fallback=2048)
+# build contraction hierarchies for the default routing profiles during map update processing
+ROUTING_CONTRACTION = config.getboolean('c3nav', 'routing_contraction', fallback=False)
+# number of most used restrictions/options combinations to precompute all-pairs shortest paths for after map updates
+ROUTING_WARMUP_PROFILES = config.getint('c3nav', 'routing_warmup_profiles', fallback=4)
+
 IMPRINT_LINK = config.get('c3nav', 'imprint_link', fallback=None)
 IMPRINT_PATRONS = config.get('c3nav', 'imprint_patrons', fallback=None)
 IMPRINT_TEAM = config.get('c3nav', 'imprint_team', fallback=None)
@@ -395,6 +419,9 @@ with suppress(ImportError):
     import django_extensions  # noqa
     INSTALLED_APPS.append('django_extensions')
 
+# api stats are counted in each process and added to the shared stats in the cache at most every this many seconds
+STATS_FLUSH_INTERVAL = config.getint('c3nav', 'stats_flush_interval', fallback=10)
+
 METRICS = config.getboolean('c3nav', 'metrics', fallback=False)
 if METRICS:
     try:
@@ -608,6 +635,16 @@ BASE_THEME = {
 
 WIFI_SSIDS = [n for n in config.get('c3nav', 'wifi_ssids', fallback='').split(',') if n]
 
+# how to locate by signal strength: 'best' returns the best matching measurement point,
+# 'knn' the weighted centroid of the best matching measurement points
+LOCATE_MODE = config.get('c3nav', 'locate_mode', fallback='best')
+if LOCATE_MODE not in ('best', 'knn'):
+    raise ImproperlyConfigured('locate_mode has to be one of best, knn.')
+# number of measurement points to interpolate between in knn mode
+LOCATE_KNN_K = config.getint('c3nav', 'locate_knn_k', fallback=4)
+if LOCATE_KNN_K < 1:
+    raise ImproperlyConfigured('locate_knn_k has to be at least 1.')
+
 
 # Projection
 PROJECTION_PROJ4 = config.get('projection', 'proj4', fallback=None)
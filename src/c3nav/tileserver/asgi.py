@@ -0,0 +1,265 @@
+import asyncio
+import logging
+import os
+import pickle
+import time
+import zlib
+
+import aiomcache
+import httpx
+from aiomcache.exceptions import ClientException
+
+from c3nav.mapdata.utils.cache import CachePackage
+from c3nav.tileserver.server import TileNotFound, TileServer, UpstreamResponse
+
+logger = logging.getLogger('c3nav')
+
+# value flags used by pylibmc, so both variants can share the same memcached server
+PYLIBMC_FLAG_PICKLE = 1 << 0
+PYLIBMC_FLAG_INTEGER = 1 << 1
+PYLIBMC_FLAG_LONG = 1 << 2
+PYLIBMC_FLAG_ZLIB = 1 << 3
+PYLIBMC_FLAG_TEXT = 1 << 4
+
+
+async def decode_pylibmc_value(value, flags):
+    if flags & PYLIBMC_FLAG_ZLIB:
+        value = zlib.decompress(value)
+    if flags & PYLIBMC_FLAG_PICKLE:
+        return pickle.loads(value)
+    if flags & (PYLIBMC_FLAG_INTEGER | PYLIBMC_FLAG_LONG):
+        return int(value)
+    if flags & PYLIBMC_FLAG_TEXT:
+        return value.decode()
+    return value
+
+
+class AsyncTileServer(TileServer):
+    """
+    ASGI variant of the tileserver, run it with an ASGI server, e.g. uvicorn c3nav.tileserver.asgi:application
+    Memcached and upstream requests don't block, so one process can serve lots of concurrent requests.
+    Cache packages are still downloaded by the reload thread and announced to all workers via memcached.
+    """
+    def __init__(self):
+        super().__init__()
+
+        servers = os.environ.get('C3NAV_MEMCACHED_SERVER', '127.0.0.1').split(',')
+        if len(servers) > 1:
+            raise Exception('The ASGI tileserver only supports one C3NAV_MEMCACHED_SERVER.')
+        host, _, port = servers[0].partition(':')
+        self.memcached_address = (host, int(port or 11211))
+        self.memcached_pool_size = int(os.environ.get('C3NAV_MEMCACHED_POOL_SIZE', 16))
+
+        # clients are created in the event loop of the ASGI server
+        self.async_cache = None
+        self.http_client = None
+
+        # tiles that are currently requested from upstream by this process
+        self.async_inflight = {}
+
+    def setup_async_clients(self):
+        if self.async_cache is not None:
+            return
+        host, port = self.memcached_address
+        self.async_cache = aiomcache.Client(host, port, pool_size=self.memcached_pool_size,
+                                            get_flag_handler=decode_pylibmc_value)
+        self.http_client = httpx.AsyncClient(
+            headers=self.auth_headers,
+            auth=(self.http_auth.username, self.http_auth.password) if self.http_auth else None,
+            limits=httpx.Limits(max_connections=self.upstream_concurrency,
+                                max_keepalive_connections=self.upstream_concurrency),
+            # requests wait for a free connection instead of failing
+            timeout=httpx.Timeout(30, pool=None),
+        )
+
+    async def close_async_clients(self):
+        if self.async_cache is None:
+            return
+        await self.http_client.aclose()
+        await self.async_cache.close()
+        self.async_cache = None
+        self.http_client = None
+
+    async def respond(self, send, status, headers, body=b''):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.encode(), value.encode()) for name, value in (self.get_date_header(), *headers)],
+        })
+        await send({
+            'type': 'http.response.body',
+            'body': body,
+        })
+
+    async def respond_text(self, send, status, text):
+        await self.respond(send, status, (('Content-Type', 'text/plain'),
+                                          ('Content-Length', str(len(text)))), text)
+
+    async def deliver_tile_async(self, send, etag, data):
+        await self.respond(send, 200, (('Content-Type', 'image/png'),
+                                       ('Content-Length', str(len(data))),
+                                       ('Cache-Control', 'no-cache'),
+                                       ('ETag', etag)), data)
+
+    async def liveness_check_response_async(self, send):
+        await self.get_cache_package_async()
+        await self.respond_text(send, 200, b'OK')
+
+    async def readiness_check_response_async(self, send):
+        try:
+            last_check = await self.async_cache.get(b'cache_package_last_successful_check')
+        except (ClientException, OSError):
+            ready, text = False, b'memcached error'
+        else:
+            ready, text = self.check_last_successful_check(last_check)
+        await self.respond_text(send, 200 if ready else 500, text)
+
+    async def get_cache_package_async(self):
+        try:
+            cache_package_filename = await self.async_cache.get(b'cache_package_filename')
+        except (ClientException, OSError) as e:
+            logger.warning('memcached error in get_cache_package_async(): %s' % e)
+            cache_package_filename = None
+
+        if cache_package_filename is None:
+            logger.warning('cache_package_filename went missing.')
+            return self.cache_package
+        if self.cache_package_filename != cache_package_filename:
+            logger.debug('Loading new cache package in worker.')
+            self.cache_package = await asyncio.to_thread(CachePackage.open_flat, cache_package_filename)
+            self.cache_package_filename = cache_package_filename
+        return self.cache_package
+
+    async def get_tile_async(self, cache_key, url):
+        # concurrent requests for the same tile share one upstream request
+        task = self.async_inflight.get(cache_key)
+        first = task is None
+        if first:
+            task = asyncio.ensure_future(self.fetch_tile_async(cache_key, url))
+            self.async_inflight[cache_key] = task
+            task.add_done_callback(lambda t: self.async_inflight.pop(cache_key, None))
+
+        try:
+            # don't cancel the upstream request for everyone else if this client goes away
+            response = await asyncio.shield(task)
+        except Exception as e:
+            logger.error('Requesting tile from upstream failed: %s' % e)
+            return None
+        return response if first else response._replace(source='inflight')
+
+    async def fetch_tile_async(self, cache_key, url):
+        # same memcached lock as the WSGI variant, so they can be used side by side
+        lock_key = ('render_lock:' + cache_key).encode()
+        cache_key = cache_key.encode()
+        locked = False
+        deadline = time.time() + self.render_lock_timeout
+        while True:
+            locked = await self.async_cache.add(lock_key, b'1', exptime=self.render_lock_timeout)
+            cached_result = await self.async_cache.get(cache_key)
+            if cached_result is not None or locked or time.time() > deadline:
+                break
+            await asyncio.sleep(0.05)
+
+        try:
+            if cached_result is not None:
+                return UpstreamResponse(200, 'OK', 'image/png', cached_result, 'memcached')
+
+            r = await self.http_client.get(url)
+            response = UpstreamResponse(r.status_code, r.reason_phrase,
+                                        r.headers.get('Content-Type', 'text/plain'), r.content, 'upstream')
+            if response.status_code == 200 and response.content_type == 'image/png':
+                await self.async_cache.set(cache_key, response.content)
+            return response
+        finally:
+            if locked:
+                await self.async_cache.delete(lock_key)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.setup_async_clients()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close_async_clients()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported scope type: %s' % scope['type'])
+
+        # servers without lifespan support
+        self.setup_async_clients()
+
+        path_info = scope['path']
+
+        if path_info == '/health' or path_info == '/health/live':
+            return await self.liveness_check_response_async(send)
+
+        if path_info == '/health/ready':
+            return await self.readiness_check_response_async(send)
+
+        if path_info == '/metrics':
+            text = self.get_metrics_text()
+            return await self.respond(send, 200, (('Content-Type', 'text/plain; version=0.0.4'),
+                                                  ('Content-Length', str(len(text)))), text)
+
+        try:
+            tile = self.parse_tile_path(path_info)
+        except TileNotFound as e:
+            return await self.respond_text(send, 404, e.args[0])
+
+        try:
+            cache_package = await self.get_cache_package_async()
+        except Exception as e:
+            logger.error('get_cache_package_async() failed: %s' % e)
+            return await self.respond_text(send, 500, b'internal server error')
+
+        headers = {}
+        for name, value in scope['headers']:
+            headers.setdefault(name.decode('latin-1'), []).append(value.decode('latin-1'))
+        cookie = '; '.join(headers.get('cookie', ())) or None
+
+        try:
+            tile_request = self.build_tile_request(cache_package, path_info, *tile, cookie=cookie)
+        except TileNotFound as e:
+            return await self.respond_text(send, 404, e.args[0])
+
+        # check browser cache
+        if tile_request.etag in headers.get('if-none-match', ()):
+            self.count_tile('browser', tile[1])
+            return await self.respond(send, 304, (('Content-Length', '0'),
+                                                  ('ETag', tile_request.etag)))
+
+        if self.local_cache is not None:
+            cached_result = self.local_cache.get(tile_request.cache_key)
+            if cached_result is not None:
+                self.count_tile('local', tile[1])
+                return await self.deliver_tile_async(send, tile_request.etag, cached_result)
+
+        cached_result = await self.async_cache.get(tile_request.cache_key.encode())
+        if cached_result is not None:
+            self.count_tile('memcached', tile[1])
+            if self.local_cache is not None:
+                self.local_cache.set(tile_request.cache_key, cached_result)
+            return await self.deliver_tile_async(send, tile_request.etag, cached_result)
+
+        r = await self.get_tile_async(tile_request.cache_key, self.upstream_base+tile_request.upstream_path)
+        if r is None:
+            return await self.respond_text(send, 500, b'internal server error')
+
+        if r.status_code == 200 and r.content_type == 'image/png':
+            self.count_tile(r.source, tile[1])
+            if self.local_cache is not None:
+                self.local_cache.set(tile_request.cache_key, r.content)
+            return await self.deliver_tile_async(send, tile_request.etag, r.content)
+
+        await self.respond(send, r.status_code, (('Content-Length', str(len(r.content))),
+                                                 ('Content-Type', r.content_type)), r.content)
+
+
+application = AsyncTileServer()
@@ -0,0 +1,520 @@
+import base64
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict, namedtuple
+from datetime import datetime
+from email.utils import formatdate
+from io import BytesIO
+
+import pylibmc
+import requests
+from pyzstd import decompress as zstd_decompress
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+
+from c3nav.mapdata.utils.cache import CachePackage
+from c3nav.mapdata.utils.tiles import (build_access_cache_key, build_base_cache_key, build_tile_etag, get_tile_bounds,
+                                       parse_tile_access_cookie)
+
+loglevel = logging.DEBUG if os.environ.get('C3NAV_DEBUG', False) else os.environ.get('C3NAV_LOGLEVEL', 'INFO').upper()
+
+logging.basicConfig(level=loglevel,
+                    format='[%(asctime)s] [%(process)s] [%(levelname)s] %(name)s: %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S %z')
+
+logger = logging.getLogger('c3nav')
+
+if os.environ.get('C3NAV_LOGFILE'):
+    logging.basicConfig(filename=os.environ['C3NAV_LOGFILE'])
+
+# source is where the response came from: upstream, memcached (rendered for another worker) or inflight (shared
+# upstream request of this process)
+UpstreamResponse = namedtuple('UpstreamResponse', ('status_code', 'reason', 'content_type', 'content', 'source'))
+TileRequest = namedtuple('TileRequest', ('etag', 'cache_key', 'upstream_path'))
+
+
+class TileNotFound(Exception):
+    pass
+
+
+class TileLRUCache:
+    """
+    Size-limited in-process cache of tile data, the least recently used tiles are evicted first.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.get(key)
+            if value is not None:
+                self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_size:
+            return
+        with self.lock:
+            old_value = self.data.pop(key, None)
+            if old_value is not None:
+                self.size -= len(old_value)
+            self.data[key] = value
+            self.size += len(value)
+            while self.size > self.max_size:
+                old_key, old_value = self.data.popitem(last=False)
+                self.size -= len(old_value)
+
+
+class InflightRequest:
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+
+
+class TileServer:
+    def __init__(self):
+        self.path_regex = re.compile(r'^/(\d+)/(-?\d+)/(-?\d+)/(-?\d+)(/(-?\d+))?.png$')
+
+        self.cookie_regex = re.compile(r'(^| )c3nav_tile_access="?([^;" ]+)"?')
+
+        try:
+            self.upstream_base = os.environ['C3NAV_UPSTREAM_BASE'].strip('/')
+        except KeyError:
+            raise Exception('C3NAV_UPSTREAM_BASE needs to be set.')
+
+        try:
+            self.data_dir = os.environ.get('C3NAV_DATA_DIR', 'data')
+        except KeyError:
+            raise Exception('C3NAV_DATA_DIR needs to be set.')
+
+        if not os.path.exists(self.data_dir):
+            os.mkdir(self.data_dir)
+
+        self.tile_secret = os.environ.get('C3NAV_TILE_SECRET', None)
+        if not self.tile_secret:
+            tile_secret_file = None
+            try:
+                tile_secret_file = os.environ['C3NAV_TILE_SECRET_FILE']
+                self.tile_secret = open(tile_secret_file).read().strip()
+            except KeyError:
+                raise Exception('C3NAV_TILE_SECRET or C3NAV_TILE_SECRET_FILE need to be set.')
+            except FileNotFoundError:
+                raise Exception('The C3NAV_TILE_SECRET_FILE (%s) does not exist.' % tile_secret_file)
+
+        self.reload_interval = int(os.environ.get('C3NAV_RELOAD_INTERVAL', 60))
+
+        self.http_auth = os.environ.get('C3NAV_HTTP_AUTH', None)
+        if self.http_auth:
+            self.http_auth = HTTPBasicAuth(*self.http_auth.split(':', 1))
+
+        self.auth_headers = {'X-Tile-Secret': base64.b64encode(self.tile_secret.encode()).decode()}
+
+        # keep-alive connections to upstream, with a bounded number of concurrent requests per process
+        self.upstream_concurrency = int(os.environ.get('C3NAV_UPSTREAM_CONCURRENCY', 8))
+        self.upstream_semaphore = threading.BoundedSemaphore(self.upstream_concurrency)
+        self.upstream_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.upstream_concurrency)
+        self.upstream_session.mount('http://', adapter)
+        self.upstream_session.mount('https://', adapter)
+
+        # tiles that are currently requested from upstream by this process
+        self.inflight = {}
+        self.inflight_lock = threading.Lock()
+
+        # how long other workers wait for a tile that is already being rendered before requesting it themselves
+        self.render_lock_timeout = int(os.environ.get('C3NAV_RENDER_LOCK_TIMEOUT', 30))
+
+        # hottest tiles are served from memory without asking memcached, size in megabytes
+        local_cache_size = int(float(os.environ.get('C3NAV_LOCAL_CACHE_SIZE', 64)) * 1024 * 1024)
+        self.local_cache = TileLRUCache(local_cache_size) if local_cache_size > 0 else None
+
+        # delivered tiles by zoom level and where they came from: browser (304), local, memcached, inflight or upstream
+        self.tile_stats = Counter()
+        self.tile_stats_lock = threading.Lock()
+
+        self.cache_clients = threading.local()
+
+        self.cache_package = None
+        self.cache_package_etag = None
+        self.cache_package_filename = None
+
+        cache = self.get_cache_client()
+
+        wait = 1
+        while True:
+            success = self.load_cache_package(cache=cache)
+            if success:
+                logger.info('Cache package successfully loaded.')
+                break
+            logger.info('Retrying after %s seconds...' % wait)
+            time.sleep(wait)
+            wait = min(10, wait*2)
+
+        threading.Thread(target=self.update_cache_package_thread, daemon=True).start()
+
+    @staticmethod
+    def get_cache_client():
+        servers = os.environ.get('C3NAV_MEMCACHED_SERVER', '127.0.0.1').split(',')
+        return pylibmc.Client(servers, binary=True, behaviors={"tcp_nodelay": True, "ketama": True})
+
+    def update_cache_package_thread(self):
+        cache = self.get_cache_client()  # different thread → different client!
+        while True:
+            time.sleep(self.reload_interval)
+            self.load_cache_package(cache=cache)
+
+    def get_date_header(self):
+        return 'Date', formatdate(timeval=time.time(), localtime=False, usegmt=True)
+
+    def load_cache_package(self, cache):
+        logger.debug('Downloading cache package from upstream...')
+        try:
+            headers = self.auth_headers.copy()
+            if self.cache_package_etag is not None:
+                headers['If-None-Match'] = self.cache_package_etag
+            r = self.upstream_session.get(self.upstream_base+'/map/cache/package.tar.zst',
+                                          headers=headers, auth=self.http_auth)
+
+            if r.status_code == 403:
+                logger.error('Rejected cache package download with Error 403. Tile secret is probably incorrect.')
+                return False
+
+            if r.status_code == 401:
+                logger.error('Rejected cache package download with Error 401. You have HTTP Auth active.')
+                return False
+
+            if r.status_code == 304:
+                if self.cache_package is not None:
+                    logger.debug('Not modified.')
+                    cache['cache_package_filename'] = self.cache_package_filename
+                    cache.set('cache_package_last_successful_check', time.time())
+                    return True
+                logger.error('Unexpected not modified.')
+                return False
+
+            r.raise_for_status()
+        except Exception as e:
+            logger.error('Cache package download failed: %s' % e)
+            return False
+
+        logger.debug('Receiving and loading new cache package...')
+
+        try:
+            with BytesIO(zstd_decompress(r.content)) as f:
+                self.cache_package = CachePackage.read(f)
+            self.cache_package_etag = r.headers.get('ETag', None)
+        except Exception as e:
+            logger.error('Cache package parsing failed: %s' % e)
+            return False
+
+        try:
+            self.cache_package_filename = os.path.join(
+                self.data_dir,
+                datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')+'.package'
+            )
+            self.cache_package.save_flat(self.cache_package_filename)
+            self.cache_package = CachePackage.open_flat(self.cache_package_filename)
+            cache.set('cache_package_filename', self.cache_package_filename)
+            cache.set('cache_package_last_successful_check', time.time())
+        except Exception as e:
+            self.cache_package_etag = None
+            logger.error('Saving cache package failed: %s' % e)
+            return False
+
+        self.delete_old_cache_packages()
+        return True
+
+    def delete_old_cache_packages(self, keep=2):
+        # workers that still use an older package keep it mapped even after it was deleted
+        filenames = sorted(filename for filename in os.listdir(self.data_dir)
+                           if filename.endswith('.package') or filename.endswith('.pickle'))
+        for filename in filenames[:-keep]:
+            try:
+                os.remove(os.path.join(self.data_dir, filename))
+            except OSError as e:
+                logger.warning('Deleting old cache package %s failed: %s' % (filename, e))
+
+    def not_found(self, start_response, text):
+        start_response('404 Not Found', [self.get_date_header(),
+                                         ('Content-Type', 'text/plain'),
+                                         ('Content-Length', str(len(text)))])
+        return [text]
+
+    def internal_server_error(self, start_response, text=b'internal server error'):
+        start_response('500 Internal Server Error', [self.get_date_header(),
+                                                     ('Content-Type', 'text/plain'),
+                                                     ('Content-Length', str(len(text)))])
+        return [text]
+
+    def deliver_tile(self, start_response, etag, data):
+        start_response('200 OK', [self.get_date_header(),
+                                  ('Content-Type', 'image/png'),
+                                  ('Content-Length', str(len(data))),
+                                  ('Cache-Control', 'no-cache'),
+                                  ('ETag', etag)])
+        return [data]
+
+    def count_tile(self, source, zoom):
+        with self.tile_stats_lock:
+            self.tile_stats[(source, zoom)] += 1
+
+    def get_metrics_text(self):
+        # prometheus text format, counts are per process
+        with self.tile_stats_lock:
+            tile_stats = sorted(self.tile_stats.items(), key=lambda item: (item[0][0], item[0][1]))
+        lines = [
+            '# HELP c3nav_tileserver_tiles_total Delivered tiles by cache layer that served them and zoom level.',
+            '# TYPE c3nav_tileserver_tiles_total counter',
+            *('c3nav_tileserver_tiles_total{source="%s",zoom="%d"} %d' % (source, zoom, count)
+              for (source, zoom), count in tile_stats),
+        ]
+        if self.local_cache is not None:
+            lines.extend((
+                '# HELP c3nav_tileserver_local_cache_bytes Size of the tiles in the in-process cache.',
+                '# TYPE c3nav_tileserver_local_cache_bytes gauge',
+                'c3nav_tileserver_local_cache_bytes %d' % self.local_cache.size,
+                '# HELP c3nav_tileserver_local_cache_tiles Number of tiles in the in-process cache.',
+                '# TYPE c3nav_tileserver_local_cache_tiles gauge',
+                'c3nav_tileserver_local_cache_tiles %d' % len(self.local_cache),
+            ))
+        return ('\n'.join(lines) + '\n').encode()
+
+    def metrics_response(self, start_response):
+        text = self.get_metrics_text()
+        start_response('200 OK', [self.get_date_header(),
+                                  ('Content-Type', 'text/plain; version=0.0.4'),
+                                  ('Content-Length', str(len(text)))])
+        return [text]
+
+    def liveness_check_response(self, start_response):
+        self.get_cache_package()
+        text = b'OK'
+        start_response('200 OK', [self.get_date_header(),
+                                  ('Content-Type', 'text/plain'),
+                                  ('Content-Length', str(len(text)))])
+        return [text]
+
+    def check_last_successful_check(self, last_check):
+        if last_check is None or last_check <= (time.time() - self.reload_interval * 3):
+            if last_check:
+                text = f'last successful cache package check was {time.time() - last_check}s ago.'
+                return False, text.encode('utf-8')
+            return False, b'last successful cache package check is unknown'
+        return True, b'OK'
+
+    def readiness_check_response(self, start_response):
+        try:
+            last_check = self.cache.get('cache_package_last_successful_check')
+        except pylibmc.Error:
+            ready, text = False, b'memcached error'
+        else:
+            ready, text = self.check_last_successful_check(last_check)
+        start_response(('200' if ready else '500') + ' OK', [self.get_date_header(),
+                                                             ('Content-Type', 'text/plain'),
+                                                             ('Content-Length', str(len(text)))])
+        return [text]
+
+    def get_cache_package(self):
+        try:
+            cache_package_filename = self.cache.get('cache_package_filename')
+        except pylibmc.Error as e:
+            logger.warning('pylibmc error in get_cache_package(): %s' % e)
+            cache_package_filename = None
+
+        if cache_package_filename is None:
+            logger.warning('cache_package_filename went missing.')
+            return self.cache_package
+        if self.cache_package_filename != cache_package_filename:
+            logger.debug('Loading new cache package in worker.')
+            self.cache_package = CachePackage.open_flat(cache_package_filename)
+            self.cache_package_filename = cache_package_filename
+        return self.cache_package
+
+    def parse_tile_path(self, path_info):
+        match = self.path_regex.match(path_info)
+        if match is None:
+            raise TileNotFound(b'invalid tile path.')
+
+        level, zoom, x, y, _, theme = match.groups()
+        if theme is None:
+            theme = 0
+
+        zoom = int(zoom)
+        if not (-2 <= zoom <= 5):
+            raise TileNotFound(b'zoom out of bounds.')
+
+        return int(level), zoom, int(x), int(y), int(theme)
+
+    def build_tile_request(self, cache_package, path_info, level, zoom, x, y, theme_id, cookie=None):
+        # check if bounds are valid
+        minx, miny, maxx, maxy = get_tile_bounds(zoom, x, y)
+        if not cache_package.bounds_valid(minx, miny, maxx, maxy):
+            raise TileNotFound(b'coordinates out of bounds.')
+
+        # get level
+        theme = None if theme_id == 0 else theme_id
+        level_data = cache_package.levels.get((level, theme))
+        if level_data is None:
+            raise TileNotFound(b'invalid level or theme.')
+
+        # build cache keys
+        last_update = level_data.history.last_update(minx, miny, maxx, maxy)
+        base_cache_key = build_base_cache_key(last_update)
+
+        # decode access permissions
+        access_permissions = set()
+        access_cache_key = '0'
+
+        if cookie:
+            cookie = self.cookie_regex.search(cookie)
+            if cookie:
+                cookie = cookie.group(2)
+                access_permissions = (parse_tile_access_cookie(cookie, self.tile_secret) &
+                                      set(level_data.restrictions[minx:maxx, miny:maxy]))
+                access_cache_key = build_access_cache_key(access_permissions)
+
+        tile_etag = build_tile_etag(level, zoom, x, y, theme_id, base_cache_key, access_cache_key, self.tile_secret)
+        return TileRequest(
+            etag=tile_etag,
+            cache_key=path_info+'_'+tile_etag,
+            upstream_path='/map/%d/%d/%d/%d/%d/%s.png' % (level, zoom, x, y, theme_id, access_cache_key),
+        )
+
+    def get_tile(self, cache_key, url):
+        """
+        get a tile from upstream, making sure that only one request for it is sent at a time.
+        other requests for the same tile in this process wait for the first one and reuse its response.
+        """
+        with self.inflight_lock:
+            inflight = self.inflight.get(cache_key)
+            first = inflight is None
+            if first:
+                inflight = self.inflight[cache_key] = InflightRequest()
+
+        if not first:
+            inflight.event.wait()
+            if inflight.response is None:
+                return None
+            return inflight.response._replace(source='inflight')
+
+        try:
+            inflight.response = self.fetch_tile(cache_key, url)
+        except Exception as e:
+            logger.error('Requesting tile from upstream failed: %s' % e)
+        finally:
+            with self.inflight_lock:
+                del self.inflight[cache_key]
+            inflight.event.set()
+        return inflight.response
+
+    def fetch_tile(self, cache_key, url):
+        # other workers use a lock in memcached, whoever gets it requests the tile, the others wait for the result
+        cache = self.cache
+        lock_key = 'render_lock:' + cache_key
+        locked = False
+        deadline = time.time() + self.render_lock_timeout
+        while True:
+            locked = cache.add(lock_key, 1, time=self.render_lock_timeout)
+            cached_result = cache.get(cache_key)
+            if cached_result is not None or locked or time.time() > deadline:
+                break
+            time.sleep(0.05)
+
+        try:
+            if cached_result is not None:
+                return UpstreamResponse(200, 'OK', 'image/png', cached_result, 'memcached')
+
+            with self.upstream_semaphore:
+                r = self.upstream_session.get(url, headers=self.auth_headers, auth=self.http_auth)
+            response = UpstreamResponse(r.status_code, r.reason,
+                                        r.headers.get('Content-Type', 'text/plain'), r.content, 'upstream')
+            if response.status_code == 200 and response.content_type == 'image/png':
+                cache.set(cache_key, response.content)
+            return response
+        finally:
+            if locked:
+                cache.delete(lock_key)
+
+    @property
+    def cache(self):
+        # pylibmc clients can't be shared between threads or forked processes, each one gets its own client
+        if getattr(self.cache_clients, 'pid', None) != os.getpid():
+            self.cache_clients.pid = os.getpid()
+            self.cache_clients.client = self.get_cache_client()
+        return self.cache_clients.client
+
+    def __call__(self, env, start_response):
+        path_info = env['PATH_INFO']
+
+        if path_info == '/health' or path_info == '/health/live':
+            return self.liveness_check_response(start_response)
+
+        if path_info == '/health/ready':
+            return self.readiness_check_response(start_response)
+
+        if path_info == '/metrics':
+            return self.metrics_response(start_response)
+
+        try:
+            tile = self.parse_tile_path(path_info)
+        except TileNotFound as e:
+            return self.not_found(start_response, e.args[0])
+
+        # do this to be thread safe
+        try:
+            cache_package = self.get_cache_package()
+        except Exception as e:
+            logger.error('get_cache_package() failed: %s' % e)
+            return self.internal_server_error(start_response)
+
+        try:
+            tile_request = self.build_tile_request(cache_package, path_info, *tile, cookie=env.get('HTTP_COOKIE', None))
+        except TileNotFound as e:
+            return self.not_found(start_response, e.args[0])
+
+        # check browser cache
+        if env.get('HTTP_IF_NONE_MATCH') == tile_request.etag:
+            self.count_tile('browser', tile[1])
+            start_response('304 Not Modified', [self.get_date_header(),
+                                                ('Content-Length', '0'),
+                                                ('ETag', tile_request.etag)])
+            return [b'']
+
+        if self.local_cache is not None:
+            cached_result = self.local_cache.get(tile_request.cache_key)
+            if cached_result is not None:
+                self.count_tile('local', tile[1])
+                return self.deliver_tile(start_response, tile_request.etag, cached_result)
+
+        cached_result = self.cache.get(tile_request.cache_key)
+        if cached_result is not None:
+            self.count_tile('memcached', tile[1])
+            if self.local_cache is not None:
+                self.local_cache.set(tile_request.cache_key, cached_result)
+            return self.deliver_tile(start_response, tile_request.etag, cached_result)
+
+        r = self.get_tile(tile_request.cache_key, self.upstream_base+tile_request.upstream_path)
+        if r is None:
+            return self.internal_server_error(start_response)
+
+        if r.status_code == 200 and r.content_type == 'image/png':
+            self.count_tile(r.source, tile[1])
+            if self.local_cache is not None:
+                self.local_cache.set(tile_request.cache_key, r.content)
+            return self.deliver_tile(start_response, tile_request.etag, r.content)
+
+        start_response('%d %s' % (r.status_code, r.reason), [
+            self.get_date_header(),
+            ('Content-Length', str(len(r.content))),
+            ('Content-Type', r.content_type)
+        ])
+        return [r.content]
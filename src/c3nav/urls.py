@@ -43,6 +43,12 @@ if settings.SERVE_ANYTHING:
             path('mesh/', URLRouter(c3nav.mesh.urls.websocket_urlpatterns)),
         ]
 
+    if settings.SERVE_API:
+        import c3nav.routing.urls
+        websocket_urlpatterns += [
+            path('api/v2/positioning/', URLRouter(c3nav.routing.urls.websocket_urlpatterns)),
+        ]
+
     if settings.DEBUG:
         with suppress(ImportError):
             import debug_toolbar